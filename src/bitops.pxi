@@ -76,6 +76,61 @@ cdef inline uint32_t bitsetsubtract(uint64_t *dest,
 	return result
 
 
+# Fused operations on three operands; store result, return cardinality
+cdef inline uint32_t bitsetunionintersect(uint64_t *dest,
+		uint64_t *src1, uint64_t *src2) noexcept nogil:
+	"""dest gets the union of dest and the intersection of src1 and src2.
+
+	:returns: number of set bits in result."""
+	cdef size_t n
+	cdef uint64_t res1, res2
+	cdef uint32_t result = 0
+	for n in range(0, <size_t>(BLOCKSIZE // BITSIZE), 2):
+		res1 = dest[n] | (src1[n] & src2[n])
+		res2 = dest[n + 1] | (src1[n + 1] & src2[n + 1])
+		dest[n] = res1
+		dest[n + 1] = res2
+		result += bit_popcount(res1)
+		result += bit_popcount(res2)
+	return result
+
+
+cdef inline uint32_t bitsetunionsubtract(uint64_t *dest,
+		uint64_t *src1, uint64_t *src2) noexcept nogil:
+	"""dest gets the union of dest and src1 - src2.
+
+	:returns: number of set bits in result."""
+	cdef size_t n
+	cdef uint64_t res1, res2
+	cdef uint32_t result = 0
+	for n in range(0, <size_t>(BLOCKSIZE // BITSIZE), 2):
+		res1 = dest[n] | (src1[n] & ~src2[n])
+		res2 = dest[n + 1] | (src1[n + 1] & ~src2[n + 1])
+		dest[n] = res1
+		dest[n + 1] = res2
+		result += bit_popcount(res1)
+		result += bit_popcount(res2)
+	return result
+
+
+cdef inline uint32_t bitsetintersectunion(uint64_t *dest,
+		uint64_t *src1, uint64_t *src2) noexcept nogil:
+	"""dest gets the intersection of dest and the union of src1 and src2.
+
+	:returns: number of set bits in result."""
+	cdef size_t n
+	cdef uint64_t res1, res2
+	cdef uint32_t result = 0
+	for n in range(0, <size_t>(BLOCKSIZE // BITSIZE), 2):
+		res1 = dest[n] & (src1[n] | src2[n])
+		res2 = dest[n + 1] & (src1[n + 1] | src2[n + 1])
+		dest[n] = res1
+		dest[n + 1] = res2
+		result += bit_popcount(res1)
+		result += bit_popcount(res2)
+	return result
+
+
 # Only store result, no cardinality
 cdef inline void bitsetintersectnocard(uint64_t *dest,
 		uint64_t *src1, uint64_t *src2) noexcept nogil:
@@ -126,6 +181,15 @@ cdef inline void bitsetsubtractnocard(uint64_t *dest,
 
 
 # Count cardinality only
+cdef inline uint32_t bitsetcount(uint64_t *src) noexcept nogil:
+	"""Return the number of set bits in a bitmap of ``BLOCKSIZE`` bits."""
+	cdef uint32_t result = 0
+	cdef size_t n
+	for n in range(<size_t>(BLOCKSIZE // BITSIZE)):
+		result += bit_popcount(src[n])
+	return result
+
+
 cdef inline uint32_t bitsetintersectcount(
 		uint64_t *src1, uint64_t *src2) noexcept nogil:
 	"""return the cardinality of the intersection of dest and src.
@@ -139,6 +203,17 @@ cdef inline uint32_t bitsetintersectcount(
 	return result
 
 
+cdef inline uint32_t bitsetintersectsubtractcount(
+		uint64_t *src1, uint64_t *src2, uint64_t *src3) noexcept nogil:
+	"""return the cardinality of the intersection of src1 and src2,
+	minus src3."""
+	cdef uint32_t result = 0
+	cdef size_t n
+	for n in range(<size_t>(BLOCKSIZE // BITSIZE)):
+		result += bit_popcount(src1[n] & src2[n] & ~src3[n])
+	return result
+
+
 # Other operations
 cdef inline int iteratesetbits(uint64_t *vec,
 		uint64_t *cur, int *idx) noexcept nogil:
@@ -296,6 +371,52 @@ cdef inline bint bitdisjoint(uint64_t *vec1, uint64_t *vec2) noexcept nogil:
 	return True
 
 
+cdef inline uint32_t bitsetruns(uint64_t *vec,
+		uint32_t *starts, uint32_t *stops) noexcept nogil:
+	"""Store the runs of consecutive set bits in vec as ranges
+	``[starts[n], stops[n])``.
+
+	Runs are found with one ``ctz`` per boundary, by alternately scanning
+	for the next 1-bit and the next 0-bit.
+	:returns: the number of runs; at most ``BLOCKSIZE // 2``."""
+	cdef uint64_t ones = ~(<uint64_t>0)
+	cdef uint64_t cur = vec[0]
+	cdef uint32_t n = 0, idx = 0
+	while True:
+		while not cur:  # skip slots without 1-bits
+			idx += 1
+			if idx >= <uint32_t>(BLOCKSIZE // BITSIZE):
+				return n
+			cur = vec[idx]
+		starts[n] = idx * BITSIZE + bit_ctz(cur)
+		cur = ~vec[idx] & (ones << (starts[n] % BITSIZE))
+		while not cur:  # skip slots without 0-bits
+			idx += 1
+			if idx >= <uint32_t>(BLOCKSIZE // BITSIZE):
+				stops[n] = BLOCKSIZE
+				return n + 1
+			cur = ~vec[idx]
+		stops[n] = idx * BITSIZE + bit_ctz(cur)
+		cur = vec[idx] & (ones << (stops[n] % BITSIZE))
+		n += 1
+
+
+cdef inline void bitsetrange(uint64_t *vec,
+		uint32_t start, uint32_t stop) noexcept nogil:
+	"""Set the bits ``start <= n < stop`` of vec, where ``start < stop``."""
+	cdef uint64_t ones = ~(<uint64_t>0)
+	cdef uint64_t first = ones << (start % BITSIZE)
+	cdef uint64_t last = ones >> (BITSIZE - 1 - (stop - 1) % BITSIZE)
+	cdef uint32_t a = BITSLOT(start), b = BITSLOT(stop - 1), n
+	if a == b:
+		vec[a] |= first & last
+		return
+	vec[a] |= first
+	for n in range(a + 1, b):
+		vec[n] = ones
+	vec[b] |= last
+
+
 cdef inline int select64(uint64_t w, int i) except -1:
 	"""Given a 64-bit int w, return the position of the ith 1-bit."""
 	cdef uint64_t part1 = w & 0xFFFFFFFFUL
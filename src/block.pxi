@@ -151,6 +151,110 @@ cdef void block_initrange(
 			n += step
 
 
+cdef void block_initsorted(
+		Block *self, uint32_t *elems, uint32_t length) noexcept nogil:
+	"""Allocate block and set elements from a sorted array without
+	duplicates; only the low bits of the elements are used."""
+	cdef uint32_t n, m = 0
+	self.cardinality = length
+	if length == BLOCKSIZE:
+		self.buf.sparse = NULL
+		self.capacity = 0
+		self.state = INVERTED
+	elif length < MAXARRAYLENGTH:
+		self.buf.sparse = allocsparse(length)
+		self.capacity = length
+		self.state = POSITIVE
+		for n in range(length):
+			self.buf.sparse[n] = lowbits(elems[n])
+	elif length > BLOCKSIZE - MAXARRAYLENGTH:
+		self.buf.sparse = allocsparse(BLOCKSIZE - length)
+		self.capacity = BLOCKSIZE - length
+		self.state = INVERTED
+		for n in range(BLOCKSIZE):
+			if m < length and lowbits(elems[m]) == n:
+				m += 1
+			else:
+				self.buf.sparse[n - m] = n
+	else:
+		self.buf.dense = allocdense()
+		self.capacity = BITMAPSIZE // sizeof(uint16_t)
+		self.state = DENSE
+		memset(self.buf.dense, 0, BITMAPSIZE)
+		for n in range(length):
+			SETBIT(self.buf.dense, lowbits(elems[n]))
+
+
+cdef void block_initranges(Block *self, uint32_t *starts, uint32_t *stops,
+		uint32_t length, uint32_t cardinality) noexcept nogil:
+	"""Allocate block and set elements from sorted, disjoint ranges
+	``[starts[n], stops[n])`` within ``0..BLOCKSIZE``, with a total of
+	``cardinality`` elements."""
+	cdef uint32_t n, a, m = 0, prev = 0
+	self.cardinality = cardinality
+	if cardinality == BLOCKSIZE:
+		self.buf.sparse = NULL
+		self.capacity = 0
+		self.state = INVERTED
+	elif cardinality < MAXARRAYLENGTH:
+		self.buf.sparse = allocsparse(cardinality)
+		self.capacity = cardinality
+		self.state = POSITIVE
+		for n in range(length):
+			for a in range(starts[n], stops[n]):
+				self.buf.sparse[m] = a
+				m += 1
+	elif cardinality > BLOCKSIZE - MAXARRAYLENGTH:
+		self.buf.sparse = allocsparse(BLOCKSIZE - cardinality)
+		self.capacity = BLOCKSIZE - cardinality
+		self.state = INVERTED
+		for n in range(length):
+			for a in range(prev, starts[n]):
+				self.buf.sparse[m] = a
+				m += 1
+			prev = stops[n]
+		for a in range(prev, BLOCKSIZE):
+			self.buf.sparse[m] = a
+			m += 1
+	else:
+		self.buf.dense = allocdense()
+		self.capacity = BITMAPSIZE // sizeof(uint16_t)
+		self.state = DENSE
+		memset(self.buf.dense, 0, BITMAPSIZE)
+		for n in range(length):
+			bitsetrange(self.buf.dense, starts[n], stops[n])
+
+
+cdef uint32_t block_runs(Block *self, uint32_t *starts,
+		uint32_t *stops) noexcept nogil:
+	"""Store the runs of consecutive elements in block as ranges
+	``[starts[n], stops[n])``; return the number of runs, which is at most
+	``BLOCKSIZE // 2``."""
+	cdef uint32_t n, m = 0, size
+	if self.state == DENSE:
+		return bitsetruns(self.buf.dense, starts, stops)
+	elif self.state == POSITIVE:
+		for n in range(self.cardinality):
+			if m and stops[m - 1] == self.buf.sparse[n]:
+				stops[m - 1] += 1
+			else:
+				starts[m] = self.buf.sparse[n]
+				stops[m] = starts[m] + 1
+				m += 1
+	elif self.state == INVERTED:  # runs are the gaps between absent elements
+		size = BLOCKSIZE - self.cardinality
+		starts[0] = 0
+		for n in range(size):
+			if self.buf.sparse[n] > starts[m]:
+				stops[m] = self.buf.sparse[n]
+				m += 1
+			starts[m] = self.buf.sparse[n] + 1
+		if starts[m] < BLOCKSIZE:
+			stops[m] = BLOCKSIZE
+			m += 1
+	return m
+
+
 cdef void block_clamp(
 		Block *result, Block *src, uint16_t start, uint32_t stop):
 	"""Copy ``src`` to ``result`` but restrict elements to range
@@ -162,14 +266,9 @@ cdef void block_clamp(
 	if src.state == DENSE or src.state == INVERTED:
 		buf = block_asdense(src)
 		if stop - start < MAXARRAYLENGTH:
-			idx = BITNSLOTS(BLOCKSIZE) - 1
-			cur = buf.dense[idx] & (BITMASK(stop + 1) - 1)
-			elem = reviteratesetbits(buf.dense, &cur, &idx)
-			stop = min(stop, elem + 1)
 			idx = BITSLOT(start)
 			cur = buf.dense[idx] & ~(BITMASK(start) - 1)
 			elem = iteratesetbits(buf.dense, &cur, &idx)
-			start = max(start, elem)
 			# FIXME pessimistic allocation; count set bits?
 			alloc = min(stop - start, src.cardinality)
 			convertalloc(result, POSITIVE, alloc)
@@ -368,9 +467,12 @@ cdef void block_xor(Block *result, Block *self, Block *other) noexcept nogil:
 		block_convert(result)
 	elif self.state == POSITIVE and other.state == INVERTED:
 		convertalloc(result, DENSE, BITMAPSIZE // sizeof(uint16_t))
-		result.cardinality = self.cardinality
+		# a ^ b == ~(a ^ ~b), and other stores the elements of ~b
+		memset(result.buf.dense, 0xff, BITMAPSIZE)
+		result.cardinality = BLOCKSIZE
 		for n in range(self.cardinality):
-			SETBIT(result.buf.dense, self.buf.sparse[n])
+			togglebitcard(
+					result.buf.dense, self.buf.sparse[n], &result.cardinality)
 		for n in range(<size_t>(BLOCKSIZE - other.cardinality)):
 			togglebitcard(
 					result.buf.dense, other.buf.sparse[n], &result.cardinality)
@@ -603,7 +705,7 @@ cdef void block_ior(Block *self, Block *other) noexcept nogil:
 				other.buf.sparse, self.buf.sparse,
 				BLOCKSIZE - other.cardinality, self.cardinality,
 				buf.sparse)
-		self.buf.sparse = buf.sparse
+		replacearray(self, buf, BLOCKSIZE - other.cardinality)
 		self.state = INVERTED
 		self.cardinality = BLOCKSIZE - length
 		trimcapacity(self, length)
@@ -720,7 +822,7 @@ cdef void block_isub(Block *self, Block *other) noexcept nogil:
 		self.state = POSITIVE
 		trimcapacity(self, self.cardinality)
 	elif self.state == INVERTED and other.state == POSITIVE:
-		alloc = 2 * BLOCKSIZE - (self.cardinality + other.cardinality)
+		alloc = BLOCKSIZE - self.cardinality + other.cardinality
 		buf.sparse = allocsparse(alloc)
 		length = union2by2(
 				self.buf.sparse, other.buf.sparse,
@@ -912,6 +1014,103 @@ cdef void block_andorlen(Block *self, Block *other,
 			- intersection_result[0])
 
 
+cdef uint64_t *block_denseview(Block *self, uint64_t *scratch) noexcept nogil:
+	"""Return the bitmap of a dense block, or store the elements of an
+	array block as a bitmap in preallocated ``scratch`` and return that."""
+	cdef uint32_t n
+	if self.state == DENSE:
+		return self.buf.dense
+	elif self.state == POSITIVE:
+		memset(scratch, 0, BITMAPSIZE)
+		for n in range(self.cardinality):
+			SETBIT(scratch, self.buf.sparse[n])
+	else:  # self.state == INVERTED:
+		memset(scratch, 255, BITMAPSIZE)
+		for n in range(BLOCKSIZE - self.cardinality):
+			CLEARBIT(scratch, self.buf.sparse[n])
+	return scratch
+
+
+cdef void block_iorand(Block *self, Block *a, Block *b, bint andnot,
+		Block *tmp, uint64_t *scratch) noexcept nogil:
+	"""In-place ``self |= a & b``, or if andnot is True, ``self |= a - b``.
+
+	:param tmp: a block that may be preallocated, used when the
+		intersection or difference is small.
+	:param scratch: two preallocated bitmaps."""
+	if a.state == POSITIVE or (b.state == POSITIVE and not andnot):
+		if andnot:
+			block_sub(tmp, a, b)
+		else:
+			block_and(tmp, a, b)
+		if tmp.cardinality:
+			block_ior(self, tmp)
+		return
+	if self.state != DENSE:
+		block_todense(self)
+	if andnot:
+		self.cardinality = bitsetunionsubtract(self.buf.dense,
+				block_denseview(a, scratch),
+				block_denseview(b, &(scratch[BITNSLOTS(BLOCKSIZE)])))
+	else:
+		self.cardinality = bitsetunionintersect(self.buf.dense,
+				block_denseview(a, scratch),
+				block_denseview(b, &(scratch[BITNSLOTS(BLOCKSIZE)])))
+	block_convert(self)
+
+
+cdef void block_iandor(Block *self, Block *a, Block *b,
+		uint64_t *scratch) noexcept nogil:
+	"""In-place ``self &= a | b``.
+
+	:param scratch: two preallocated bitmaps."""
+	cdef uint32_t n, m = 0
+	if self.state == POSITIVE:
+		for n in range(self.cardinality):
+			if (block_contains(a, self.buf.sparse[n])
+					or block_contains(b, self.buf.sparse[n])):
+				self.buf.sparse[m] = self.buf.sparse[n]
+				m += 1
+		self.cardinality = m
+		return
+	if self.state != DENSE:
+		block_todense(self)
+	self.cardinality = bitsetintersectunion(self.buf.dense,
+			block_denseview(a, scratch),
+			block_denseview(b, &(scratch[BITNSLOTS(BLOCKSIZE)])))
+	block_convert(self)
+
+
+cdef uint32_t block_andandnotlen(Block *a, Block *b, Block *c,
+		uint64_t *scratch) noexcept nogil:
+	"""Return ``len(a & b - c)``.
+
+	:param scratch: three preallocated bitmaps."""
+	cdef Block *tmp
+	cdef uint32_t n, result = 0
+	if b.state == POSITIVE and a.state != POSITIVE:
+		tmp = a
+		a = b
+		b = tmp
+	if a.state == POSITIVE:
+		for n in range(a.cardinality):
+			if (block_contains(b, a.buf.sparse[n])
+					and not block_contains(c, a.buf.sparse[n])):
+				result += 1
+		return result
+	elif c.state == POSITIVE:
+		result = block_andlen(a, b)
+		for n in range(c.cardinality):
+			if (block_contains(a, c.buf.sparse[n])
+					and block_contains(b, c.buf.sparse[n])):
+				result -= 1
+		return result
+	return bitsetintersectsubtractcount(
+			block_denseview(a, scratch),
+			block_denseview(b, &(scratch[BITNSLOTS(BLOCKSIZE)])),
+			block_denseview(c, &(scratch[2 * BITNSLOTS(BLOCKSIZE)])))
+
+
 cdef int block_rank(Block *self, uint16_t x) noexcept nogil:
 	"""Number of 1-bits in this bitmap ``<= x``."""
 	cdef int result = 0, leftover
@@ -960,6 +1159,69 @@ cdef int block_select(Block *self, uint16_t i) except -1:
 				self.buf.sparse, 0, BLOCKSIZE - self.cardinality, i)
 
 
+cdef int block_nextge(Block *self, uint16_t x) noexcept nogil:
+	"""Return smallest element ``>= x`` in block, or -1 if none."""
+	cdef int n, size
+	cdef uint64_t cur
+	if self.state == DENSE:
+		n = BITSLOT(x)
+		cur = self.buf.dense[n] & (~0ULL << (x & (BITSIZE - 1)))
+		while cur == 0:
+			n += 1
+			if n >= <int>(BLOCKSIZE // BITSIZE):
+				return -1
+			cur = self.buf.dense[n]
+		return n * BITSIZE + bit_ctz(cur)
+	elif self.state == POSITIVE:
+		n = binarysearch(self.buf.sparse, 0, self.cardinality, x)
+		if n >= 0:
+			return x
+		n = -n - 1
+		return self.buf.sparse[n] if n < <int>self.cardinality else -1
+	elif self.state == INVERTED:  # skip run of absent elements from x
+		size = BLOCKSIZE - self.cardinality
+		n = binarysearch(self.buf.sparse, 0, size, x)
+		if n < 0:
+			return x
+		while (n + 1 < size
+				and self.buf.sparse[n + 1] == self.buf.sparse[n] + 1):
+			n += 1
+		return -1 if self.buf.sparse[n] == BLOCKSIZE - 1 else (
+				self.buf.sparse[n] + 1)
+	return -1
+
+
+cdef int block_prevle(Block *self, uint16_t x) noexcept nogil:
+	"""Return largest element ``<= x`` in block, or -1 if none."""
+	cdef int n, size
+	cdef uint64_t cur
+	if self.state == DENSE:
+		n = BITSLOT(x)
+		cur = self.buf.dense[n] & (
+				~0ULL >> (BITSIZE - 1 - (x & (BITSIZE - 1))))
+		while cur == 0:
+			n -= 1
+			if n < 0:
+				return -1
+			cur = self.buf.dense[n]
+		return n * BITSIZE + BITSIZE - 1 - bit_clz(cur)
+	elif self.state == POSITIVE:
+		n = binarysearch(self.buf.sparse, 0, self.cardinality, x)
+		if n >= 0:
+			return x
+		n = -n - 1
+		return self.buf.sparse[n - 1] if n > 0 else -1
+	elif self.state == INVERTED:  # skip run of absent elements up to x
+		size = BLOCKSIZE - self.cardinality
+		n = binarysearch(self.buf.sparse, 0, size, x)
+		if n < 0:
+			return x
+		while n > 0 and self.buf.sparse[n - 1] == self.buf.sparse[n] - 1:
+			n -= 1
+		return self.buf.sparse[n] - 1
+	return -1
+
+
 cdef Block *block_copy(Block *dest, Block *src) noexcept nogil:
 	"""Copy src to dest; dest may be preallocated."""
 	cdef size_t size = getsize(src)
@@ -969,6 +1231,44 @@ cdef Block *block_copy(Block *dest, Block *src) noexcept nogil:
 	return dest
 
 
+cdef uint32_t block_toarray(Block *self, uint16_t *out) noexcept nogil:
+	"""Store elements of block in sorted order in preallocated array
+	with room for ``self.cardinality`` elements; return the cardinality."""
+	cdef uint32_t n, m = 0
+	if self.state == DENSE:
+		extractsetbits(out, self.buf.dense)
+	elif self.state == POSITIVE:
+		memcpy(out, self.buf.sparse, self.cardinality * sizeof(uint16_t))
+	elif self.state == INVERTED:
+		for n in range(BLOCKSIZE):
+			if m < BLOCKSIZE - self.cardinality and self.buf.sparse[m] == n:
+				m += 1
+			else:
+				out[n - m] = n
+	return self.cardinality
+
+
+cdef void block_addcounts(Block *self, uint32_t *counts) noexcept nogil:
+	"""Increment ``counts[n]`` for each element n of this block."""
+	cdef uint32_t n, m = 0
+	cdef uint64_t cur
+	if self.state == DENSE:
+		for n in range(<uint32_t>(BLOCKSIZE // BITSIZE)):
+			cur = self.buf.dense[n]
+			while cur:
+				counts[n * BITSIZE + bit_ctz(cur)] += 1
+				cur ^= cur & -cur
+	elif self.state == POSITIVE:
+		for n in range(self.cardinality):
+			counts[self.buf.sparse[n]] += 1
+	elif self.state == INVERTED:
+		for n in range(BLOCKSIZE):
+			if m < BLOCKSIZE - self.cardinality and self.buf.sparse[m] == n:
+				m += 1
+			else:
+				counts[n] += 1
+
+
 cdef str block_repr(uint16_t key, Block *self, verbose):
 	verbosestr = ''
 	if verbose and self.state in (POSITIVE, INVERTED):
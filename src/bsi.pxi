@@ -0,0 +1,282 @@
+"""A bit-sliced index of unsigned integer attributes of rows."""
+
+
+cdef class BitSlicedIndex(object):
+	"""Map rows to unsigned 32-bit integer values, stored as one roaring
+	bitmap per bit of the values, plus a bitmap with the rows that have a
+	value.
+
+	Range predicates and aggregates are evaluated with a few bitmap
+	operations per bit, and may be restricted to a filter bitmap of rows.
+
+	>>> bsi = BitSlicedIndex.fromarrays([0, 1, 2, 5], [7, 3, 7, 12])
+	>>> bsi.le(7)
+	RoaringBitmap({0, 1, 2})
+	>>> bsi.sum(RoaringBitmap({0, 5}))
+	19
+	"""
+	cdef readonly RoaringBitmap ebm  # rows that have a value
+	cdef list slices  # slices[i] has the rows whose value has bit i set
+	cdef MultiRoaringBitmap _mrb  # if loaded from file
+
+	def __init__(self, ebm=None, slices=None):
+		"""
+		:param ebm: the rows that have a value.
+		:param slices: a sequence of bitmaps; the i-th bitmap should contain
+			the rows whose value has bit i set.
+		"""
+		self.ebm = RoaringBitmap() if ebm is None else ensurerb(ebm)
+		self.slices = [] if slices is None else [
+				ensurerb(a) for a in slices]
+		if len(self.slices) > 32:
+			raise ValueError('values should fit in 32 bits.')
+
+	@classmethod
+	def fromarrays(cls, rows, values):
+		"""Bulk load an index such that row ``rows[n]`` has value
+		``values[n]``.
+
+		:param rows: a sequence of unsigned 32-bit integers without
+			duplicates; preferably an ``array.array('I')`` or numpy array.
+		:param values: a sequence of unsigned 32-bit integers of the same
+			length as ``rows``."""
+		cdef BitSlicedIndex result
+		cdef array.array pairs, buf
+		cdef Py_buffer buffer1, buffer2
+		cdef char *ptr1 = NULL
+		cdef char *ptr2 = NULL
+		cdef Py_ssize_t size1 = 0, size2 = 0
+		cdef uint32_t *rowptr
+		cdef uint32_t *valptr
+		cdef uint64_t *data
+		cdef uint32_t *elems
+		cdef uint32_t maxval = 0, bit
+		cdef size_t n, m, numpairs
+		rows, values = asuint32(rows), asuint32(values)
+		if len(rows) != len(values):
+			raise ValueError('rows and values should have same length.')
+		numpairs = len(rows)
+		pairs = array.clone(ulonglongarray, numpairs, False)
+		data = <uint64_t *>pairs.data.as_ulonglongs
+		if numpairs:
+			if getbufptr(rows, &ptr1, &size1, &buffer1) != 0:
+				raise ValueError('could not get buffer from rows.')
+			if getbufptr(values, &ptr2, &size2, &buffer2) != 0:
+				releasebuf(&buffer1)
+				raise ValueError('could not get buffer from values.')
+			rowptr, valptr = <uint32_t *>ptr1, <uint32_t *>ptr2
+			with nogil:
+				for n in range(numpairs):
+					data[n] = ((<uint64_t>rowptr[n]) << 32) | valptr[n]
+					if valptr[n] > maxval:
+						maxval = valptr[n]
+				qsort(data, numpairs, sizeof(uint64_t), cmpuint64)
+			releasebuf(&buffer1)
+			releasebuf(&buffer2)
+		for n in range(1, numpairs):
+			if data[n] >> 32 == data[n - 1] >> 32:
+				raise ValueError('duplicate row %d' % (data[n] >> 32))
+		buf = array.clone(uintarray, numpairs, False)
+		elems = buf.data.as_uints
+		for n in range(numpairs):
+			elems[n] = data[n] >> 32
+		result = cls()
+		result.ebm._initsorted(elems, numpairs)
+		bit = 0
+		while bit < 32 and maxval >> bit:
+			m = 0
+			for n in range(numpairs):
+				if (data[n] >> bit) & 1:
+					elems[m] = data[n] >> 32
+					m += 1
+			result.slices.append(RoaringBitmap())
+			(<RoaringBitmap>result.slices[bit])._initsorted(elems, m)
+			bit += 1
+		return result
+
+	@classmethod
+	def fromfile(cls, filename):
+		"""Load an index written with ``tofile()`` using mmap."""
+		cdef BitSlicedIndex result
+		mrb = MultiRoaringBitmap.fromfile(filename)
+		result = cls(mrb[0], mrb[1:])
+		result._mrb = mrb
+		return result
+
+	def tofile(self, filename):
+		"""Write index to a file in the format of a MultiRoaringBitmap, with
+		the existence bitmap followed by the bit slices."""
+		MultiRoaringBitmap([self.ebm] + self.slices, filename=filename).close()
+
+	def close(self):
+		"""Close file, if any."""
+		if self._mrb is not None:
+			self._mrb.close()
+
+	def __len__(self):
+		return len(self.ebm)
+
+	def __contains__(self, uint32_t row):
+		return row in self.ebm
+
+	@property
+	def bitdepth(self):
+		"""The number of bit slices."""
+		return len(self.slices)
+
+	def get(self, uint32_t row, default=None):
+		"""Return value of row, or ``default`` if row has no value."""
+		cdef uint32_t result = 0, bit
+		if row not in self.ebm:
+			return default
+		for bit in range(len(self.slices)):
+			if row in self.slices[bit]:
+				result |= 1U << bit
+		return result
+
+	def __getitem__(self, uint32_t row):
+		result = self.get(row)
+		if result is None:
+			raise KeyError(row)
+		return result
+
+	def __setitem__(self, uint32_t row, uint32_t value):
+		cdef uint32_t bit
+		# shift a 64-bit value, since there may be 32 slices
+		while (<uint64_t>value) >> len(self.slices):
+			self.slices.append(RoaringBitmap())
+		self.ebm.add(row)
+		for bit in range(len(self.slices)):
+			if (value >> bit) & 1:
+				self.slices[bit].add(row)
+			else:
+				self.slices[bit].discard(row)
+
+	def __delitem__(self, uint32_t row):
+		if row not in self.ebm:
+			raise KeyError(row)
+		self.ebm.discard(row)
+		for rb in self.slices:
+			rb.discard(row)
+
+	cdef RoaringBitmap _rows(self, filter):
+		"""Return a new bitmap with the rows with a value in filter."""
+		if filter is None:
+			return RoaringBitmap(self.ebm)
+		return rb_and(self.ebm, ensurerb(filter))
+
+	cdef tuple _compare(self, uint64_t value, filter):
+		"""Return bitmaps with rows whose value is less than, equal to,
+		and greater than the given value."""
+		cdef RoaringBitmap lt = RoaringBitmap(), gt = RoaringBitmap()
+		cdef RoaringBitmap eq = self._rows(filter), rb
+		cdef int bit
+		if value >> len(self.slices):
+			# all rows have a value less than value; none are equal or greater
+			return eq, RoaringBitmap(), RoaringBitmap()
+		for bit in range(len(self.slices) - 1, -1, -1):
+			rb = self.slices[bit]
+			if (value >> bit) & 1:
+				rb_ior(lt, rb_sub(eq, rb))
+				rb_iand(eq, rb)
+			else:
+				rb_ior(gt, rb_and(eq, rb))
+				rb_isub(eq, rb)
+		return lt, eq, gt
+
+	def eq(self, uint64_t value, filter=None):
+		"""Return rows with a value equal to ``value``.
+
+		:param filter: if given, only consider rows in this bitmap."""
+		return self._compare(value, filter)[1]
+
+	def lt(self, uint64_t value, filter=None):
+		"""Return rows with a value less than ``value``."""
+		return self._compare(value, filter)[0]
+
+	def le(self, uint64_t value, filter=None):
+		"""Return rows with a value less than or equal to ``value``."""
+		lt, eq, _ = self._compare(value, filter)
+		return rb_ior(lt, eq)
+
+	def gt(self, uint64_t value, filter=None):
+		"""Return rows with a value greater than ``value``."""
+		return self._compare(value, filter)[2]
+
+	def ge(self, uint64_t value, filter=None):
+		"""Return rows with a value greater than or equal to ``value``."""
+		_, eq, gt = self._compare(value, filter)
+		return rb_ior(gt, eq)
+
+	def between(self, uint64_t start, uint64_t stop, filter=None):
+		"""Return rows with a value ``n`` s.t. ``start <= n <= stop``."""
+		return self.le(stop, self.ge(start, filter))
+
+	def sum(self, filter=None):
+		"""Return sum of values of rows in filter, or of all rows."""
+		cdef RoaringBitmap rows = self._rows(filter)
+		cdef uint64_t result = 0
+		cdef uint32_t bit
+		for bit in range(len(self.slices)):
+			result += rb_andlen(rows, self.slices[bit]) << bit
+		return result
+
+	def min(self, filter=None):
+		"""Return smallest value of rows in filter, or None if empty."""
+		cdef RoaringBitmap rows = self._rows(filter), tmp
+		cdef uint32_t result = 0
+		cdef int bit
+		if not rows:
+			return None
+		for bit in range(len(self.slices) - 1, -1, -1):
+			tmp = rb_sub(rows, self.slices[bit])
+			if tmp:
+				rows = tmp
+			else:
+				result |= 1U << bit
+		return result
+
+	def max(self, filter=None):
+		"""Return largest value of rows in filter, or None if empty."""
+		cdef RoaringBitmap rows = self._rows(filter), tmp
+		cdef uint32_t result = 0
+		cdef int bit
+		if not rows:
+			return None
+		for bit in range(len(self.slices) - 1, -1, -1):
+			tmp = rb_and(rows, self.slices[bit])
+			if tmp:
+				rows = tmp
+				result |= 1U << bit
+		return result
+
+	def topk(self, size_t k, filter=None):
+		"""Return the k rows in filter with the largest values.
+
+		:returns: a RoaringBitmap with ``min(k, len(rows))`` rows; ties at
+			the k-th largest value are broken in favor of smaller rows."""
+		cdef RoaringBitmap rows = self._rows(filter), tmp
+		cdef RoaringBitmap result = RoaringBitmap()
+		cdef size_t n
+		cdef int bit
+		if k == 0:
+			return result
+		if k >= len(rows):
+			return rows
+		for bit in range(len(self.slices) - 1, -1, -1):
+			tmp = rb_and(rows, self.slices[bit])
+			n = len(result) + len(tmp)
+			if n > k:
+				rows = tmp
+			elif n < k:
+				rb_ior(result, tmp)
+				rb_isub(rows, tmp)
+			else:
+				rb_ior(result, tmp)
+				return result
+		# remaining rows have equal values
+		return rb_ior(result, rows[:k - len(result)])
+
+	def __repr__(self):
+		return '%s(%d rows, %d slices)' % (
+				self.__class__.__name__, len(self.ebm), len(self.slices))
@@ -0,0 +1,368 @@
+"""Build a MultiRoaringBitmap file from (row, element) pairs.
+
+Pairs are encoded as 64-bit integers ``(row << 32) | element`` so that
+sorting them groups the elements of each row in order. Pairs are buffered
+in memory; when the buffer is full, it is sorted and written to a temporary
+file as a sorted run. Finally, the runs are merged and the bitmaps are
+written to the result file one row at a time."""
+
+# Number of pairs read at a time from a sorted run while merging
+DEF MERGECHUNK = 1 << 16
+
+
+cdef struct SortedRun:
+	uint64_t *data  # current chunk of the run
+	size_t pos, length  # position in and length of current chunk
+
+
+cdef int cmpuint64(const void *a, const void *b) noexcept nogil:
+	cdef uint64_t x = (<uint64_t *>a)[0], y = (<uint64_t *>b)[0]
+	return (x > y) - (x < y)
+
+
+cdef size_t sortunique(uint64_t *data, size_t length) noexcept nogil:
+	"""Sort array in-place and remove duplicates; return new length."""
+	cdef size_t n, m = 0
+	if length == 0:
+		return 0
+	qsort(data, length, sizeof(uint64_t), cmpuint64)
+	for n in range(1, length):
+		if data[n] != data[m]:
+			m += 1
+			data[m] = data[n]
+	return m + 1
+
+
+cdef int cmpuint32(const void *a, const void *b) noexcept nogil:
+	cdef uint32_t x = (<uint32_t *>a)[0], y = (<uint32_t *>b)[0]
+	return (x > y) - (x < y)
+
+
+cdef size_t sortunique32(uint32_t *data, size_t length) noexcept nogil:
+	"""Sort array in-place, unless already sorted, and remove duplicates;
+	return new length."""
+	cdef size_t n, m = 0
+	if length == 0:
+		return 0
+	for n in range(1, length):
+		if data[n - 1] > data[n]:
+			qsort(data, length, sizeof(uint32_t), cmpuint32)
+			break
+	for n in range(1, length):
+		if data[n] != data[m]:
+			m += 1
+			data[m] = data[n]
+	return m + 1
+
+
+cdef class PairMerger(object):
+	"""Merge sorted runs of pairs, from files or an in-memory array.
+
+	Uses a binary heap of run indices ordered by their current pair."""
+	cdef SortedRun *runs
+	cdef int *heap
+	cdef int heapsize
+	cdef list files  # file object for each run, or None
+	cdef list chunks  # array with current chunk for each run
+	cdef uint64_t last  # the last pair that was returned
+	cdef bint started
+
+	def __cinit__(self, list files, array.array inmemory, size_t length):
+		cdef int n, numruns = len(files) + (length > 0)
+		self.runs = <SortedRun *>calloc(numruns or 1, sizeof(SortedRun))
+		self.heap = <int *>calloc(numruns or 1, sizeof(int))
+		if self.runs is NULL or self.heap is NULL:
+			raise MemoryError(numruns)
+		self.files = list(files)
+		self.chunks = [array.clone(ulonglongarray, MERGECHUNK, False)
+				for _ in files]
+		if length:
+			self.files.append(None)
+			self.chunks.append(inmemory)
+			self.runs[numruns - 1].data = (
+					<uint64_t *>inmemory.data.as_ulonglongs)
+			self.runs[numruns - 1].length = length
+		self.heapsize = 0
+		self.started = False
+		for n in range(numruns):
+			if self.runs[n].length or self._refill(n):
+				self.heap[self.heapsize] = n
+				self.heapsize += 1
+		for n in range(self.heapsize // 2 - 1, -1, -1):
+			self._siftdown(n)
+
+	def __dealloc__(self):
+		free(self.runs)
+		free(self.heap)
+
+	cdef bint _refill(self, int n) except -1:
+		"""Read next chunk of run n; return False if run is exhausted."""
+		cdef array.array chunk = self.chunks[n]
+		if self.files[n] is None:
+			return False
+		self.runs[n].data = <uint64_t *>chunk.data.as_ulonglongs
+		self.runs[n].length = self.files[n].readinto(
+				chunk) // sizeof(uint64_t)
+		self.runs[n].pos = 0
+		return self.runs[n].length > 0
+
+	cdef inline uint64_t _head(self, int n) noexcept nogil:
+		return self.runs[self.heap[n]].data[self.runs[self.heap[n]].pos]
+
+	cdef void _siftdown(self, int n) noexcept nogil:
+		cdef int child, tmp
+		while 2 * n + 1 < self.heapsize:
+			child = 2 * n + 1
+			if (child + 1 < self.heapsize
+					and self._head(child + 1) < self._head(child)):
+				child += 1
+			if self._head(n) <= self._head(child):
+				break
+			tmp = self.heap[n]
+			self.heap[n] = self.heap[child]
+			self.heap[child] = tmp
+			n = child
+
+	cdef size_t fill(self, uint64_t *out, size_t length) except? 0:
+		"""Write up to ``length`` pairs to ``out``, without duplicates.
+
+		:returns: the number of pairs written; 0 when all runs are
+			exhausted."""
+		cdef SortedRun *run
+		cdef uint64_t pair
+		cdef size_t result = 0
+		while result < length and self.heapsize:
+			run = &(self.runs[self.heap[0]])
+			pair = run.data[run.pos]
+			if not self.started or pair != self.last:
+				out[result] = pair
+				result += 1
+				self.last = pair
+				self.started = True
+			run.pos += 1
+			if run.pos == run.length and not self._refill(self.heap[0]):
+				self.heapsize -= 1
+				self.heap[0] = self.heap[self.heapsize]
+			self._siftdown(0)
+		return result
+
+
+cdef class MultiRoaringBitmapBuilder(object):
+	"""Build a MultiRoaringBitmap file from batches of (row, element) pairs.
+
+	Memory usage is bounded by ``maxmemory`` plus the size of the largest
+	single bitmap; pairs that do not fit are spilled to temporary files.
+
+	>>> builder = MultiRoaringBitmapBuilder('index.bin')
+	>>> builder.add(array.array('I', [0, 2, 0]), array.array('I', [7, 5, 5]))
+	>>> mrb = builder.finish()
+	>>> mrb[0], mrb[1], mrb[2]
+	(ImmutableRoaringBitmap({5, 7}), ImmutableRoaringBitmap(), \
+ImmutableRoaringBitmap({5}))
+	"""
+	cdef array.array buf  # buffered pairs
+	cdef size_t length  # number of pairs in buf
+	cdef list runs  # temporary files with sorted runs of pairs
+	cdef object filename
+	cdef object tmpdir
+	cdef uint32_t size  # number of rows encountered so far
+
+	def __init__(self, filename, maxmemory=256 << 20, tmpdir=None):
+		"""
+		:param filename: the file to which the result will be written.
+			File is overwritten if it already exists.
+		:param maxmemory: number of bytes to use for buffering pairs.
+		:param tmpdir: directory for temporary files; if not given, the
+			default of the ``tempfile`` module is used."""
+		self.filename = filename
+		self.tmpdir = tmpdir
+		self.buf = array.clone(ulonglongarray,
+				maxmemory // sizeof(uint64_t) or 1, False)
+		self.length = 0
+		self.runs = []
+		self.size = 0
+
+	def add(self, rows, elements):
+		"""Add ``elements[n]`` to the bitmap with index ``rows[n]``.
+
+		:param rows: a sequence of unsigned 32-bit integers; preferably an
+			``array.array('I')``, or another contiguous buffer with 4-byte
+			items, such as a numpy array of type uint32.
+		:param elements: a sequence of unsigned 32-bit integers of the same
+			length as ``rows``."""
+		cdef Py_buffer buffer1, buffer2
+		cdef char *ptr1 = NULL
+		cdef char *ptr2 = NULL
+		cdef Py_ssize_t size1 = 0, size2 = 0
+		cdef uint32_t *rowptr
+		cdef uint32_t *elemptr
+		cdef uint64_t *data = <uint64_t *>self.buf.data.as_ulonglongs
+		cdef size_t n = 0, m, k, numpairs, capacity = len(self.buf)
+		cdef uint32_t maxrow = 0
+		rows, elements = asuint32(rows), asuint32(elements)
+		if len(rows) != len(elements):
+			raise ValueError('rows and elements should have same length.')
+		numpairs = len(rows)
+		if numpairs == 0:
+			return
+		if getbufptr(rows, &ptr1, &size1, &buffer1) != 0:
+			raise ValueError('could not get buffer from rows.')
+		if getbufptr(elements, &ptr2, &size2, &buffer2) != 0:
+			releasebuf(&buffer1)
+			raise ValueError('could not get buffer from elements.')
+		rowptr, elemptr = <uint32_t *>ptr1, <uint32_t *>ptr2
+		try:
+			while n < numpairs:
+				m = numpairs - n
+				if m > capacity - self.length:
+					m = capacity - self.length
+				with nogil:
+					for k in range(n, n + m):
+						if rowptr[k] > maxrow:
+							maxrow = rowptr[k]
+						data[self.length] = (
+								(<uint64_t>rowptr[k]) << 32) | elemptr[k]
+						self.length += 1
+				n += m
+				if self.length == capacity:
+					self._spill()
+		finally:
+			releasebuf(&buffer1)
+			releasebuf(&buffer2)
+		if maxrow >= self.size:
+			self.size = maxrow + 1
+
+	cdef _spill(self):
+		"""Sort buffered pairs, and unless removing duplicates freed up
+		enough space, write them to a temporary file."""
+		cdef uint64_t *data = <uint64_t *>self.buf.data.as_ulonglongs
+		with nogil:
+			self.length = sortunique(data, self.length)
+		if self.length <= len(self.buf) // 2:
+			return
+		tmp = tempfile.TemporaryFile(dir=self.tmpdir)
+		tmp.write(memoryview(self.buf)[:self.length])
+		tmp.seek(0)
+		self.runs.append(tmp)
+		self.length = 0
+
+	def finish(self, size=None, bint metadata=False):
+		"""Merge all pairs and write the bitmaps to the file.
+
+		:param size: the number of bitmaps in the result; by default,
+			the largest row index that was added + 1.
+		:param metadata: if True, store a summary of each bitmap;
+			cf. ``MultiRoaringBitmap()``.
+		:returns: the result as a MultiRoaringBitmap, loaded from the file
+			with mmap."""
+		cdef PairMerger merger
+		cdef array.array chunk = array.clone(
+				ulonglongarray, MERGECHUNK, False)
+		cdef array.array offsets, sizes, metas = None
+		cdef RowMeta *meta = NULL
+		cdef uint64_t *data = <uint64_t *>self.buf.data.as_ulonglongs
+		cdef uint64_t *chunkdata = <uint64_t *>chunk.data.as_ulonglongs
+		cdef uint32_t *elems = NULL
+		cdef void *tmp
+		cdef size_t n, numpairs, numelems = 0, capacity = 0, offset
+		cdef long row, prev = -1
+		if size is None:
+			size = self.size
+		elif size < self.size:
+			raise ValueError('size should be at least %d' % self.size)
+		with nogil:
+			self.length = sortunique(data, self.length)
+		merger = PairMerger(self.runs, self.buf, self.length)
+		offset = mrbheadersize(size)
+		offsets = array.clone(uintarray, size, False)
+		sizes = array.clone(uintarray, size, True)
+		if metadata:
+			metas = array.clone(chararray, size * sizeof(RowMeta), True)
+			meta = <RowMeta *>metas.data.as_chars
+		with open(self.filename, 'wb') as out:
+			out.seek(offset)
+			try:
+				numpairs = merger.fill(chunkdata, MERGECHUNK)
+				while numpairs:
+					for n in range(numpairs):
+						row = chunkdata[n] >> 32
+						if row != prev:
+							if numelems:
+								offset = writesorted(
+										out, offset, elems, numelems,
+										&(offsets.data.as_uints[prev]),
+										&(sizes.data.as_uints[prev]),
+										NULL if meta is NULL else &(meta[prev]))
+								numelems = 0
+							while prev < row:
+								prev += 1
+								offsets.data.as_uints[prev] = offset
+						if numelems == capacity:
+							capacity = 2 * capacity or MERGECHUNK
+							tmp = realloc(elems, capacity * sizeof(uint32_t))
+							if tmp is NULL:
+								raise MemoryError(capacity)
+							elems = <uint32_t *>tmp
+						elems[numelems] = <uint32_t>chunkdata[n]
+						numelems += 1
+					numpairs = merger.fill(chunkdata, MERGECHUNK)
+				if numelems:
+					offset = writesorted(
+							out, offset, elems, numelems,
+							&(offsets.data.as_uints[prev]),
+							&(sizes.data.as_uints[prev]),
+							NULL if meta is NULL else &(meta[prev]))
+			finally:
+				free(elems)
+			while prev + 1 < size:
+				prev += 1
+				offsets.data.as_uints[prev] = offset
+			if metadata:
+				offset = writemrbmeta(out, offset, metas)
+			out.seek(0)
+			writemrbheader(out, size, offsets, sizes,
+					offset if metadata else 0)
+		self.close()
+		return MultiRoaringBitmap.fromfile(self.filename)
+
+	def close(self):
+		"""Discard buffered pairs and temporary files."""
+		for tmp in self.runs:
+			tmp.close()
+		self.runs = []
+		self.length = 0
+
+
+cdef size_t writesorted(out, size_t offset, uint32_t *elems, size_t length,
+		uint32_t *rowoffset, uint32_t *rowsize, RowMeta *meta) except 0:
+	"""Write a serialized roaring bitmap with the given sorted elements to
+	the file ``out``, where ``offset`` is the current position; return the
+	offset after the bitmap.
+
+	:param rowoffset, rowsize: store the offset and size of the bitmap here.
+	:param meta: if not NULL, store the summary of the bitmap here."""
+	cdef RoaringBitmap rb = RoaringBitmap()
+	rb._initsorted(elems, length)
+	if meta is not NULL:
+		rowmeta(rb, meta)
+	state = rb.__getstate__()
+	rowoffset[0] = writerow(out, offset, state)
+	rowsize[0] = len(state)
+	return rowoffset[0] + rowsize[0]
+
+
+cdef asuint32(ob):
+	"""Return ``ob`` if it is a contiguous buffer of unsigned 32-bit
+	integers, otherwise convert it to an array of unsigned 32-bit integers;
+	raises on elements that are negative or not integers."""
+	if PyObject_CheckBuffer(ob) == 1:
+		view = memoryview(ob)
+		if (view.itemsize == 4 and view.c_contiguous
+				and view.format in UINT32FORMATS):
+			return ob
+	return array.array(uintarray.typecode, ob)
+
+
+# buffer formats of native unsigned 32-bit integers (cf. struct module)
+UINT32FORMATS = ('I', '@I', '=I', 'L', '@L', '=L') + (
+		('<I', '<L') if sys.byteorder == 'little' else ('>I', '>L'))
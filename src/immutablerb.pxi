@@ -45,11 +45,13 @@ cdef class ImmutableRoaringBitmap(RoaringBitmap):
 		:param state: a char array with the pickle format of RoaringBitmap.
 			Instead of copying this data, it will be used directly.
 		"""
+		self._checkexports()
 		self._ob = state
 		# FIXME: 32 byte alignment depends on state.data being aligned.
 		self._setptr(state.data.as_chars, len(state))
 
 	cdef void _setptr(self, char *ptr, size_t size) noexcept nogil:
+		self._cleardirectory()
 		self.ptr = ptr
 		self.offset = <size_t>ptr
 		self.bufsize = size
@@ -62,12 +64,21 @@ cdef class ImmutableRoaringBitmap(RoaringBitmap):
 				sizeof(uint32_t) + self.size * (sizeof(uint16_t))])
 
 	def __hash__(self):
-		cdef size_t n
+		"""Hash of the keys and blocks; consistent with ``==``, and
+		therefore independent of the layout of the serialized data."""
+		cdef uint64_t h = 5381
+		cdef uint32_t n
 		if self._hash == -1:
-			self._hash = 5381
-			for n in range(self.bufsize):
-				self._hash = ((self._hash << 5) + self._hash) + self.ptr[n]
-				# i.e., self._hash *= 33 ^ self.ptr[n]
+			h = hashbytes(h, <char *>self.keys, self.size * sizeof(uint16_t))
+			for n in range(self.size):
+				h = hashbytes(h, <char *>&(self.data[n].cardinality),
+						sizeof(uint32_t))
+				h = hashbytes(h,
+						<char *>(self.offset + self.data[n].buf.offset),
+						getsize(&(self.data[n])) * sizeof(uint16_t))
+			self._hash = <long>h
+			if self._hash == -1:  # reserved for 'not computed' and errors
+				self._hash = -2
 		return self._hash
 
 	def __richcmp__(x, y, int op):
@@ -76,16 +87,21 @@ cdef class ImmutableRoaringBitmap(RoaringBitmap):
 				and isinstance(y, ImmutableRoaringBitmap)):
 			if op == 2:  # ==
 				iob1, iob2 = x, y
-				if (iob1.bufsize != iob2.bufsize
-						or iob1.__hash__() != iob2.__hash__()):
+				if iob1.__hash__() != iob2.__hash__():
 					return False
-				return memcmp(iob1.ptr, iob2.ptr, iob1.bufsize) == 0
+				if (iob1.bufsize == iob2.bufsize and memcmp(
+						iob1.ptr, iob2.ptr, iob1.bufsize) == 0):
+					return True
+				# the same elements may be serialized with a different layout
+				return richcmp(x, y, op)
 			elif op == 3:  # !=
 				return not (x == y)
 		return richcmp(x, y, op)
 
 	def __sizeof__(self):
 		"""Return memory usage in bytes."""
+		if self._ob is None:  # points into a MultiRoaringBitmap
+			return self.bufsize
 		return len(self._ob)
 
 	def freeze(self):
@@ -126,6 +142,26 @@ cdef class ImmutableRoaringBitmap(RoaringBitmap):
 		"""Unsupported method."""
 		raise ValueError('ImmutableRoaringBitmap cannot be modified.')
 
+	def add_many(self, buf):
+		"""Unsupported method."""
+		raise ValueError('ImmutableRoaringBitmap cannot be modified.')
+
+	def discard_many(self, buf):
+		"""Unsupported method."""
+		raise ValueError('ImmutableRoaringBitmap cannot be modified.')
+
+	def ior_and(self, a, b):
+		"""Unsupported method."""
+		raise ValueError('ImmutableRoaringBitmap cannot be modified.')
+
+	def ior_andnot(self, a, b):
+		"""Unsupported method."""
+		raise ValueError('ImmutableRoaringBitmap cannot be modified.')
+
+	def iand_or(self, a, b):
+		"""Unsupported method."""
+		raise ValueError('ImmutableRoaringBitmap cannot be modified.')
+
 	def remove(self, uint32_t elem):
 		"""Unsupported method."""
 		raise ValueError('ImmutableRoaringBitmap cannot be modified.')
@@ -157,3 +193,12 @@ cdef class ImmutableRoaringBitmap(RoaringBitmap):
 	def clear(self):
 		"""Unsupported method."""
 		raise ValueError('ImmutableRoaringBitmap cannot be modified.')
+
+
+cdef inline uint64_t hashbytes(uint64_t h, char *ptr,
+		size_t length) noexcept nogil:
+	"""Update the hash value ``h`` with the given bytes (djb2)."""
+	cdef size_t n
+	for n in range(length):
+		h = ((h << 5) + h) + ptr[n]  # i.e., h * 33 + ptr[n]
+	return h
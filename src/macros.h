@@ -17,6 +17,8 @@ Fix word size at 64 bits:
 #define BITNSLOTS(nb)		(((nb) + BITSIZE1) / BITSIZE)
 #define TESTBIT(a, b)		(((a)[BITSLOT(b)] >> (b & BITSIZE1)) & 1)
 /* NB: TESTBIT returns 0 or 1*/
+/* Read a byte that is not used, e.g., to fault in a page of an mmap. */
+#define TOUCHBYTE(p)		(*(volatile const char *)(p))
 
 #ifdef _MSC_VER
 #define ALIGNED_INLINE __inline
@@ -0,0 +1,164 @@
+"""Lazy iteration over the union of many roaring bitmaps."""
+
+
+cdef struct MergeSource:
+	uint16_t *keys
+	Block *data
+	size_t offset  # non-zero for immutable bitmaps
+	uint32_t size
+	uint32_t pos  # index of the next block
+
+
+@cython.no_gc_clear
+cdef class MergeIterator(object):
+	"""Iterate over the union of roaring bitmaps in sorted order.
+
+	The union is computed one block at a time, using a heap of the bitmaps
+	ordered by the key of their next block. Created by ``merge_iter()`` and
+	``MultiRoaringBitmap.iter_union()``.
+
+	Until the iterator is exhausted or deleted, the bitmaps cannot be
+	modified; attempts raise a BufferError."""
+	cdef MergeSource *sources
+	cdef int *heap  # indices of sources with remaining blocks
+	cdef int heapsize
+	cdef list refs  # the bitmaps; None after they are released
+	cdef bint withcounts
+	cdef Block scratch  # union of blocks for the current key
+	cdef uint16_t *elems  # elements of the current block
+	cdef uint32_t *counts  # occurrence count of each element in current block
+	cdef uint32_t high  # the key of the current block << 16
+	cdef uint32_t pos, length  # position in and length of elems
+
+	def __cinit__(self, list bitmaps, bint counts=False):
+		cdef RoaringBitmap ob
+		cdef int n, numsources = len(bitmaps)
+		self.sources = <MergeSource *>calloc(
+				numsources or 1, sizeof(MergeSource))
+		self.heap = <int *>calloc(numsources or 1, sizeof(int))
+		self.elems = <uint16_t *>malloc(BLOCKSIZE * sizeof(uint16_t))
+		self.counts = <uint32_t *>calloc(BLOCKSIZE, sizeof(uint32_t)) if (
+				counts) else NULL
+		if (self.sources is NULL or self.heap is NULL or self.elems is NULL
+				or (counts and self.counts is NULL)):
+			raise MemoryError(numsources)
+		self.refs = bitmaps
+		self.withcounts = counts
+		self.heapsize = self.pos = self.length = 0
+		for n, ob in enumerate(bitmaps):
+			ob._exports += 1  # keys and blocks are read lazily
+			self.sources[n].keys = ob.keys
+			self.sources[n].data = ob.data
+			self.sources[n].offset = ob.offset
+			self.sources[n].size = ob.size
+			if ob.size:
+				self.heap[self.heapsize] = n
+				self.heapsize += 1
+		for n in range(self.heapsize // 2 - 1, -1, -1):
+			self._siftdown(n)
+
+	def __dealloc__(self):
+		self._release()
+		free(self.sources)
+		free(self.heap)
+		free(self.elems)
+		free(self.counts)
+		aligned_free(self.scratch.buf.ptr)
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		cdef uint32_t elem
+		if self.pos == self.length:
+			with nogil:
+				self._nextblock()
+			if self.length == 0:
+				self._release()
+				raise StopIteration
+		elem = self.elems[self.pos]
+		self.pos += 1
+		if self.withcounts:
+			return self.high | elem, self.counts[elem]
+		return self.high | elem
+
+	cdef void _release(self):
+		"""Allow the bitmaps to be modified again."""
+		cdef RoaringBitmap ob
+		if self.refs is not None:
+			for ob in self.refs:
+				ob._exports -= 1
+			self.refs = None
+
+	cdef inline uint16_t _key(self, int n) noexcept nogil:
+		cdef MergeSource *source = &(self.sources[self.heap[n]])
+		return source.keys[source.pos]
+
+	cdef void _siftdown(self, int n) noexcept nogil:
+		cdef int child, tmp
+		while 2 * n + 1 < self.heapsize:
+			child = 2 * n + 1
+			if (child + 1 < self.heapsize
+					and self._key(child + 1) < self._key(child)):
+				child += 1
+			if self._key(n) <= self._key(child):
+				break
+			tmp = self.heap[n]
+			self.heap[n] = self.heap[child]
+			self.heap[child] = tmp
+			n = child
+
+	cdef void _nextblock(self) noexcept nogil:
+		"""Compute union of the blocks with the next smallest key, and store
+		its elements in ``self.elems``; set length to 0 if there are no
+		more blocks."""
+		cdef MergeSource *source
+		cdef Block *block
+		cdef Block *result = NULL
+		cdef Block tmp
+		cdef uint32_t n
+		cdef uint16_t key
+		if self.withcounts:  # reset counts of previous block
+			for n in range(self.length):
+				self.counts[self.elems[n]] = 0
+		self.pos = self.length = 0
+		if self.heapsize == 0:
+			return
+		key = self._key(0)
+		self.high = (<uint32_t>key) << 16
+		while self.heapsize and self._key(0) == key:
+			source = &(self.sources[self.heap[0]])
+			block = &(source.data[source.pos])
+			if source.offset:
+				tmp = block[0]
+				tmp.buf.ptr = <void *>(tmp.buf.offset + source.offset)
+				block = &tmp
+			if self.withcounts:
+				block_addcounts(block, self.counts)
+			if result is NULL:
+				block_copy(&(self.scratch), block)
+			else:
+				block_ior(&(self.scratch), block)
+			result = &(self.scratch)
+			source.pos += 1
+			if source.pos == source.size:
+				self.heapsize -= 1
+				self.heap[0] = self.heap[self.heapsize]
+			self._siftdown(0)
+		self.length = block_toarray(result, self.elems)
+
+
+def merge_iter(*bitmaps, counts=False):
+	"""Iterate over the union of the given roaring bitmaps in sorted order,
+	without creating the union.
+
+	:param counts: if True, yield tuples ``(elem, count)`` where ``count``
+		is the number of bitmaps that contain ``elem``.
+
+	>>> list(merge_iter(RoaringBitmap({1, 5}), RoaringBitmap({5, 7})))
+	[1, 5, 7]
+	>>> list(merge_iter(RoaringBitmap({1, 5}), RoaringBitmap({5, 7}),
+	...		counts=True))
+	[(1, 1), (5, 2), (7, 1)]
+	"""
+	return MergeIterator([ensurerb(a) for a in bitmaps], counts)
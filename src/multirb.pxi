@@ -1,3 +1,290 @@
+# Similarity metrics for MultiRoaringBitmap.similarity_matrix()
+DEF SIMINTERSECTION = 0
+DEF SIMUNION = 1
+DEF SIMJACCARD = 2
+DEF SIMJACCARDDIST = 3
+DEF SIMCOSINE = 4
+DEF SIMOVERLAP = 5
+
+# Number of rows/columns in a tile of a similarity matrix
+DEF SIMTILE = 32
+
+SIMILARITYMETRICS = {
+		'intersection': SIMINTERSECTION,
+		'union': SIMUNION,
+		'jaccard': SIMJACCARD,
+		'jaccard_dist': SIMJACCARDDIST,
+		'cosine': SIMCOSINE,
+		'overlap': SIMOVERLAP}
+
+
+cdef inline double similarity(int metric, size_t andlen,
+		size_t len1, size_t len2) noexcept nogil:
+	"""Compute similarity metric given the intersection cardinality and the
+	cardinalities of two sets."""
+	cdef size_t orlen = len1 + len2 - andlen
+	if metric == SIMINTERSECTION:
+		return andlen
+	elif metric == SIMUNION:
+		return orlen
+	elif metric == SIMJACCARD:
+		return andlen / <double>orlen if orlen else 0
+	elif metric == SIMJACCARDDIST:
+		return 1 - andlen / <double>orlen if orlen else 1
+	elif metric == SIMCOSINE:
+		return andlen / sqrt(<double>len1 * len2) if len1 and len2 else 0
+	else:  # metric == SIMOVERLAP
+		if len1 > len2:
+			len1 = len2
+		return andlen / <double>len1 if len1 else 0
+
+
+# Operations for MultiRoaringBitmap._lensingle()
+DEF LENAND = 0
+DEF LENOR = 1
+DEF LENSUB = 2
+
+# Relations for MultiRoaringBitmap._find()
+DEF FINDSUBSET = 0
+DEF FINDSUPERSET = 1
+DEF FINDINTERSECTING = 2
+
+
+cdef struct FacetCount:
+	unsigned long count
+	unsigned long index
+
+
+cdef int cmpfacetcount(const void *a, const void *b) noexcept nogil:
+	"""Order by descending count, then by ascending index."""
+	cdef FacetCount *x = <FacetCount *>a
+	cdef FacetCount *y = <FacetCount *>b
+	if x.count != y.count:
+		return (x.count < y.count) - (x.count > y.count)
+	return (x.index > y.index) - (x.index < y.index)
+
+
+# Number of 64-bit words in the key summary of RowMeta; each bit stands for
+# a range of 64 keys (i.e., 64 blocks of 2**16 elements).
+DEF METAKEYWORDS = 16
+
+
+cdef struct RowMeta:
+	# Summary of a bitmap, stored in the metadata section of a
+	# MultiRoaringBitmap, so that queries can skip or order bitmaps without
+	# accessing their data.
+	uint64_t cardinality  # the number of elements
+	uint32_t minelem  # smallest element; 0 if empty
+	uint32_t maxelem  # largest element; 0 if empty
+	uint32_t nblocks  # the number of blocks
+	uint32_t _padding
+	uint64_t keys[METAKEYWORDS]  # a 1-bit for each range of keys present
+
+
+cdef void rowmeta(RoaringBitmap rb, RowMeta *meta) noexcept nogil:
+	"""Compute the summary of ``rb`` for the metadata section."""
+	cdef Block tmp
+	cdef uint32_t n
+	memset(meta, 0, sizeof(RowMeta))
+	meta.nblocks = rb.size
+	for n in range(rb.size):
+		meta.cardinality += rb.data[n].cardinality
+		meta.keys[rb.keys[n] >> 12] |= 1ULL << ((rb.keys[n] >> 6) & 63)
+	if rb.size:
+		meta.minelem = (<uint32_t>rb.keys[0] << 16) | block_nextge(
+				rb._getblk(0, &tmp), 0)
+		meta.maxelem = (<uint32_t>rb.keys[rb.size - 1] << 16) | block_prevle(
+				rb._getblk(rb.size - 1, &tmp), 0xffff)
+
+
+cdef bint rowdisjoint(RowMeta *a, RowMeta *b) noexcept nogil:
+	"""Return True if the summaries show that two bitmaps have no elements
+	in common. A False result is inconclusive."""
+	cdef int n
+	if (a.cardinality == 0 or b.cardinality == 0
+			or a.maxelem < b.minelem or b.maxelem < a.minelem):
+		return True
+	for n in range(METAKEYWORDS):
+		if a.keys[n] & b.keys[n]:
+			return False
+	return True
+
+
+# Access pattern hints for MultiRoaringBitmap.fromfile(); cf. madvise(2)
+MADVICE = {
+		'normal': 'MADV_NORMAL',
+		'random': 'MADV_RANDOM',
+		'sequential': 'MADV_SEQUENTIAL',
+		'willneed': 'MADV_WILLNEED',
+		'dontneed': 'MADV_DONTNEED'}
+
+
+cdef void touchpages(char *ptr, size_t start, size_t end,
+		size_t pagesize) noexcept nogil:
+	"""Read a byte of each page in ``ptr[start:end]``, so that the pages
+	are faulted in."""
+	if start >= end:
+		return
+	while start < end:
+		TOUCHBYTE(&(ptr[start]))
+		start += pagesize
+	TOUCHBYTE(&(ptr[end - 1]))
+
+
+cdef RoaringBitmap andlimit(list bitmaps, uint32_t start, uint32_t stop,
+		limit, offset):
+	"""Return the intersection of bitmaps restricted to elements
+	``start <= n < stop`` and to ranks ``offset`` up to ``offset + limit``."""
+	bitmaps.sort(key=len)
+	if start or stop < 0xffffffffUL:
+		bitmaps[0] = rb_clamp(bitmaps[0], start, stop)
+	return rb_andlimit(bitmaps, offset, SIZE_MAX if limit is None else limit)
+
+
+cdef size_t mrbheadersize(uint32_t size):
+	"""Return the number of bytes for the header of a serialized
+	MultiRoaringBitmap with ``size`` bitmaps, including padding."""
+	cdef size_t alloc = sizeof(uint32_t) + 2 * size * sizeof(uint32_t)
+	return alloc + 32 - alloc % 32
+
+
+cdef size_t rowalign(char *ptr, size_t offset) noexcept nogil:
+	"""Return the offset at which to store the serialized bitmap ``ptr``,
+	at or after ``offset``: 32-byte aligned if it contains dense blocks,
+	since their buffers are aligned relative to its start; otherwise
+	8-byte aligned, so that tiny bitmaps are packed without padding."""
+	cdef uint32_t n, size = (<uint32_t *>ptr)[0]
+	cdef Block *data = <Block *>&(ptr[
+			sizeof(uint32_t) + size * sizeof(uint16_t)])
+	for n in range(size):
+		if data[n].state == DENSE:
+			return bufalign(offset, 32)
+	return bufalign(offset, 8)
+
+
+cdef size_t writerow(out, size_t offset, array.array state) except 0:
+	"""Write the serialized bitmap ``state`` to file ``out``, where
+	``offset`` is the current position; return the offset where it starts,
+	after any padding for alignment."""
+	cdef size_t start = rowalign(state.data.as_chars, offset)
+	out.write(b'\0' * (start - offset))
+	out.write(state)
+	return start
+
+
+cdef writemrbheader(out, uint32_t size, array.array offsets,
+		array.array sizes, uint32_t metaoffset=0):
+	"""Write header of a serialized MultiRoaringBitmap to file ``out``.
+
+	:param offsets, sizes: arrays of type 'I' with ``size`` elements.
+	:param metaoffset: the byte offset of the metadata section, if any;
+		stored in the first word of the padding, which is zero otherwise."""
+	cdef size_t alloc = sizeof(uint32_t) + 2 * size * sizeof(uint32_t)
+	out.write(array.array(uintarray.typecode, [size]))
+	out.write(offsets)
+	out.write(sizes)
+	out.write(array.array(uintarray.typecode, [metaoffset]))
+	out.write(b'\0' * (mrbheadersize(size) - alloc - sizeof(uint32_t)))
+
+
+cdef size_t writemrbmeta(out, size_t offset, array.array metas) except 0:
+	"""Write the metadata section to file ``out``, where ``offset`` is the
+	current position after the data; return the offset of the section.
+
+	:param metas: a char array with a RowMeta struct for each bitmap."""
+	cdef size_t extra = 32 - offset % 32
+	out.write(b'\0' * extra)
+	out.write(metas)
+	return offset + extra
+
+
+# Statistics of a QueryCache; cf. MultiRoaringBitmap.cache_info()
+CacheInfo = collections.namedtuple('CacheInfo',
+		['hits', 'misses', 'partialhits', 'entries', 'nbytes', 'maxbytes'])
+
+
+cdef class QueryCache(object):
+	"""A cache of query results, evicting the least recently used results
+	when the total size exceeds a budget in bytes;
+	cf. ``MultiRoaringBitmap.enable_cache()``.
+
+	Keys are normalized queries: ``('and', indices, start, stop)`` with
+	sorted, unique indices for intersections, and ``('eval', tree, start,
+	stop)`` with a normalized query tree for ``evaluate()``."""
+	cdef object entries  # key => (result, nbytes); least recently used first
+	cdef dict subsets  # (first index, start, stop) => set of 'and' keys
+	cdef size_t maxbytes, nbytes
+	cdef size_t hits, misses, partialhits
+
+	def __init__(self, size_t maxbytes):
+		self.entries = collections.OrderedDict()
+		self.subsets = {}
+		self.maxbytes = maxbytes
+		self.nbytes = self.hits = self.misses = self.partialhits = 0
+
+	cdef tuple get(self, key):
+		"""Return a tuple ``(found, result)``, where ``result`` is an
+		ImmutableRoaringBitmap, or None for an empty intersection."""
+		entry = self.entries.pop(key, None)
+		if entry is None:
+			self.misses += 1
+			return False, None
+		self.entries[key] = entry  # now most recently used
+		self.hits += 1
+		return True, entry[0]
+
+	cdef tuple getsubset(self, key):
+		"""For an intersection ``key``, find the cached intersection with
+		the most operands that is over a subset of its operands, with the
+		same start and stop.
+
+		:returns: a tuple ``(indices, result)``, or None if not found.
+
+		Only the intersections whose first index is one of the operands are
+		considered; cf. ``self.subsets``."""
+		cdef tuple best = None
+		indices = frozenset(key[1])
+		for i in key[1]:
+			for other in self.subsets.get((i, ) + key[2:], ()):
+				if (len(other[1]) < len(indices)
+						and (best is None or len(other[1]) > len(best[0]))
+						and indices.issuperset(other[1])):
+					best = other[1], self.entries[other][0]
+		if best is not None:
+			self.partialhits += 1
+		return best
+
+	cdef put(self, key, RoaringBitmap result):
+		"""Store an immutable copy of ``result`` (None if empty) for
+		``key``, and evict results until the size is within budget."""
+		cdef size_t nbytes
+		if result is not None:
+			result = result.freeze()
+		nbytes = sys.getsizeof(key) + sys.getsizeof(key[1]) + (
+				0 if result is None else result.__sizeof__())
+		if nbytes > self.maxbytes:
+			return
+		if key in self.entries:
+			self.nbytes -= self.entries.pop(key)[1]
+		elif key[0] == 'and':
+			self.subsets.setdefault(
+					(key[1][0], ) + key[2:], set()).add(key)
+		self.entries[key] = (result, nbytes)
+		self.nbytes += nbytes
+		while self.nbytes > self.maxbytes:
+			other, entry = self.entries.popitem(last=False)
+			self.nbytes -= entry[1]
+			if other[0] == 'and':
+				sub = (other[1][0], ) + other[2:]
+				self.subsets[sub].discard(other)
+				if not self.subsets[sub]:
+					del self.subsets[sub]
+
+	def info(self):
+		return CacheInfo(self.hits, self.misses, self.partialhits,
+				len(self.entries), self.nbytes, self.maxbytes)
+
+
 @cython.no_gc_clear
 cdef class MultiRoaringBitmap(object):
 	"""A sequence of immutable roaring bitmaps.
@@ -20,21 +307,33 @@ cdef class MultiRoaringBitmap(object):
 	cdef uint32_t *ptr  # the data
 	cdef object _ob  # array or mmap which should be kept alive for ptr
 	cdef object _file  # optionally, file with mmap to be kept open
+	cdef RowMeta *meta  # per-bitmap metadata, or NULL if not stored
+	cdef QueryCache _cache  # optional cache of query results
 
-	def __init__(self, list init, filename=None):
+	def __init__(self, list init, filename=None, bint dedup=True,
+			bint metadata=False):
 		"""
 		:param init: a list of set-like objects (e.g., RoaringBitmaps).
 			May contain ``None`` elements, which are treated as empty
 			sets.
 		:param filename: if given, result is stored in an mmap'd file.
-			File is overwritten if it already exists."""
+			File is overwritten if it already exists.
+		:param dedup: if True, identical bitmaps are stored only once;
+			the offsets of their rows point to the same data.
+		:param metadata: if True, store a summary of each bitmap
+			(cardinality, smallest and largest element, blocks present),
+			which is used by queries to skip bitmaps and to order operands,
+			without accessing their data; cf. ``cardinality()`` and
+			``bounds()``."""
 		cdef ImmutableRoaringBitmap irb
-		cdef uint32_t alloc, offset
+		cdef uint32_t alloc, offset, metaoffset = 0
 		cdef int alignment = 32
 		cdef Py_buffer buffer
 		cdef Py_ssize_t size = 0
 		cdef char *ptr = NULL
 		cdef int result
+		cdef dict seen = {}  # digest => index of first row with that data
+		cdef list first = []  # for each row, index of row with its data
 
 		if filename is not None:
 			flags = os.O_CREAT | os.O_RDWR
@@ -48,9 +347,21 @@ cdef class MultiRoaringBitmap(object):
 		extra = alignment - alloc % alignment
 		alloc += extra
 		offset = alloc
-		for irb in tmp:
-			if irb is not None:
-				alloc += irb.bufsize
+		for n, irb in enumerate(tmp):
+			first.append(n)
+			if irb is None or irb.size == 0:
+				continue
+			if dedup:
+				key = hashlib.sha1((<char *>irb.ptr)[:irb.bufsize]).digest()
+				if key in seen:
+					first[n] = seen[key]
+					continue
+				seen[key] = n
+			alloc = rowalign(irb.ptr, alloc) + irb.bufsize
+		if metadata:
+			alloc += alignment - alloc % alignment
+			metaoffset = alloc
+			alloc += self.size * sizeof(RowMeta)
 
 		if filename is not None:
 			os.ftruncate(self._file, alloc)
@@ -58,16 +369,15 @@ cdef class MultiRoaringBitmap(object):
 				-1 if filename is None else self._file,
 				alloc, access=mmap.ACCESS_WRITE)
 		result = getbufptr(self._ob, &ptr, &size, &buffer)
-		self.ptr = <uint32_t *>ptr
 		if result != 0:
 			raise ValueError('could not get buffer from mmap.')
 
-		self.ptr[0] = self.size
-		self.offsets = &(self.ptr[1])
-		self.sizes = &(self.ptr[1 + self.size])
+		(<uint32_t *>ptr)[0] = self.size
 		for n in range(1 + 2 * self.size,
 				1 + 2 * self.size + extra // sizeof(uint32_t)):
-			self.ptr[n] = 0
+			(<uint32_t *>ptr)[n] = 0
+		(<uint32_t *>ptr)[1 + 2 * self.size] = metaoffset
+		self._setheader(ptr)
 		for n, irb in enumerate(tmp):
 			# offset
 			self.ptr[1 + n] = offset
@@ -76,9 +386,20 @@ cdef class MultiRoaringBitmap(object):
 				self.ptr[1 + n + self.size] = 0
 				continue
 			self.ptr[1 + n + self.size] = irb.bufsize
+			if first[n] != n:  # duplicate; share data of first occurrence
+				self.ptr[1 + n] = self.ptr[1 + <uint32_t>first[n]]
+				continue
 			# copy data
+			offset = rowalign(irb.ptr, offset)
+			self.ptr[1 + n] = offset
 			memcpy(&((<char *>self.ptr)[offset]), irb.ptr, irb.bufsize)
 			offset += irb.bufsize
+		if metadata:
+			for n, irb in enumerate(tmp):
+				if irb is None:
+					memset(&(self.meta[n]), 0, sizeof(RowMeta))
+				else:
+					rowmeta(irb, &(self.meta[n]))
 		if filename is not None:
 			self._ob.flush()
 		releasebuf(&buffer)
@@ -123,35 +444,124 @@ cdef class MultiRoaringBitmap(object):
 	def __setstate__(self, state):
 		"""Initialize this object with a serialized representation."""
 		self._ob = state
-		self.ptr = <uint32_t *><char *>state
+		self._setheader(<char *>state)
+
+	cdef _setheader(self, char *ptr):
+		"""Set pointers to the header, data, and metadata (if any) of a
+		serialized MultiRoaringBitmap starting at ``ptr``."""
+		cdef uint32_t metaoffset
+		self.ptr = <uint32_t *>ptr
 		self.size = self.ptr[0]
 		self.offsets = &(self.ptr[1])
 		self.sizes = &(self.ptr[1 + self.size])
+		# the first word of the padding after the header
+		metaoffset = self.ptr[1 + 2 * self.size]
+		self.meta = <RowMeta *>&(ptr[metaoffset]) if metaoffset else NULL
 
 	@classmethod
-	def fromfile(cls, filename):
-		"""Load a MultiRoaringBitmap from a file using mmap."""
+	def fromfile(cls, filename, advice=None, bint populate=False,
+			bint hugepages=False):
+		"""Load a MultiRoaringBitmap from a file using mmap.
+
+		:param advice: a hint on how the file will be accessed; one of
+			'normal', 'random', 'sequential', 'willneed', 'dontneed';
+			cf. ``madvise(2)``. With 'random', the kernel does not read
+			ahead, which is preferable when queries touch a few bitmaps of a
+			large file.
+		:param populate: if True, read the whole file into memory before
+			returning (``MAP_POPULATE``), to avoid page faults in queries.
+		:param hugepages: if True, request transparent huge pages for the
+			mapping (``MADV_HUGEPAGE``).
+
+		Hints that are not supported by the platform are ignored."""
 		cdef MultiRoaringBitmap ob
 		cdef Py_buffer buffer
 		cdef char *ptr = NULL
 		cdef Py_ssize_t size = 0
+		if advice is not None and advice not in MADVICE:
+			raise ValueError('advice should be one of %s; got %r.' % (
+					', '.join(sorted(MADVICE)), advice))
 		ob = MultiRoaringBitmap.__new__(MultiRoaringBitmap)
 		flags = os.O_RDONLY
 		if sys.platform == 'win32':
 			flags |= os.O_BINARY
 		ob._file = os.open(filename, flags)
-		ob._ob = mmap.mmap(ob._file, 0, access=mmap.ACCESS_READ)
+		if populate and hasattr(mmap, 'MAP_POPULATE'):
+			ob._ob = mmap.mmap(ob._file, 0,
+					flags=mmap.MAP_SHARED | mmap.MAP_POPULATE,
+					prot=mmap.PROT_READ)
+		else:
+			ob._ob = mmap.mmap(ob._file, 0, access=mmap.ACCESS_READ)
 		result = getbufptr(ob._ob, &ptr, &size, &buffer)
-		ob.ptr = <uint32_t *>ptr
 		if result != 0:
 			raise ValueError('could not get buffer from mmap.')
-		ob.size = ob.ptr[0]
-		ob.offsets = &(ob.ptr[1])
-		ob.sizes = &(ob.ptr[1 + ob.size])
-		# rest is data
+		ob._setheader(ptr)
 		releasebuf(&buffer)
+		if advice is not None:
+			ob._madvise(MADVICE[advice], 0, len(ob._ob))
+		if hugepages:
+			ob._madvise('MADV_HUGEPAGE', 0, len(ob._ob))
+		if populate and not hasattr(mmap, 'MAP_POPULATE'):
+			ob.warmup(touch=True)
 		return ob
 
+	cdef bint _madvise(self, name, size_t start, size_t length):
+		"""Apply madvise hint ``mmap.<name>`` to a range of the mmap.
+
+		:returns: True if successful, False if not supported."""
+		advice = getattr(mmap, name, None)
+		if advice is None or not hasattr(self._ob, 'madvise'):
+			return False
+		try:
+			self._ob.madvise(advice, start, length)
+		except OSError:
+			return False
+		return True
+
+	def warmup(self, indices=None, bint touch=False):
+		"""Load the pages of the given bitmaps into memory, to avoid page
+		faults when they are first used; e.g., after ``fromfile()``.
+
+		:param indices: an iterable of indices; if None, all bitmaps.
+		:param touch: if False, ask the kernel to read the pages in the
+			background (``MADV_WILLNEED``); if True, or if that is not
+			supported, read a byte of each page, so that the pages are in
+			memory when this method returns.
+		:raises IndexError: if an invalid index is encountered."""
+		cdef size_t pagesize = mmap.PAGESIZE
+		cdef size_t start, end, curstart, curend
+		cdef list ranges = [(0, mrbheadersize(self.size))]
+		if indices is None:
+			if self.size:
+				ranges.append((0, self.bufsize()))
+		else:
+			for i in indices:
+				if i < 0 or i >= self.size:
+					raise IndexError('index %d out of range 0..%d' % (
+							i, self.size))
+				if self.sizes[i]:
+					ranges.append((self.offsets[i],
+							self.offsets[i] + self.sizes[i]))
+		ranges.sort()
+		# merge ranges that share a page; the first range starts at 0
+		curstart = curend = 0
+		for start, end in ranges:
+			start -= start % pagesize
+			if start > curend:
+				self._warmup(curstart, curend, touch)
+				curstart = start
+			if end > curend:
+				curend = end
+		self._warmup(curstart, curend, touch)
+
+	cdef _warmup(self, size_t start, size_t end, bint touch):
+		"""Load the pages of ``ptr[start:end]``; start is page-aligned."""
+		cdef char *ptr = <char *>self.ptr
+		cdef size_t pagesize = mmap.PAGESIZE
+		if touch or not self._madvise('MADV_WILLNEED', start, end - start):
+			with nogil:
+				touchpages(ptr, start, end, pagesize)
+
 	@classmethod
 	def frombuffer(cls, data, int offset):
 		"""Load a MultiRoaringBitmap from a Python object using the buffer
@@ -162,19 +572,37 @@ cdef class MultiRoaringBitmap(object):
 		cdef Py_buffer buffer
 		cdef Py_ssize_t size = 0
 		result = getbufptr(data, &ptr, &size, &buffer)
-		ob.ptr = <uint32_t *>&ptr[offset]
 		if result != 0:
 			raise ValueError('could not get buffer from mmap.')
-		ob.size = ob.ptr[0]
-		ob.offsets = &(ob.ptr[1])
-		ob.sizes = &(ob.ptr[1 + ob.size])
-		# rest is data
+		ob._setheader(&ptr[offset])
 		releasebuf(&buffer)
 		return ob
 
 	def bufsize(self):
 		"""Return size in number of bytes."""
-		return self.offsets[self.size - 1] + self.sizes[self.size - 1]
+		cdef size_t result = mrbheadersize(self.size)
+		cdef uint32_t i
+		for i in range(self.size):
+			if self.offsets[i] + self.sizes[i] > result:
+				result = self.offsets[i] + self.sizes[i]
+		if self.meta is not NULL:
+			result = (<char *>self.meta - <char *>self.ptr
+					+ self.size * sizeof(RowMeta))
+		return result
+
+	def dedupratio(self):
+		"""Return the ratio of the total size in bytes of the bitmaps, to
+		the number of bytes used to store them. A ratio above 1 means
+		that identical bitmaps are shared."""
+		cdef size_t total = 0, stored = 0
+		cdef set seen = set()
+		cdef uint32_t i
+		for i in range(self.size):
+			total += self.sizes[i]
+			if self.sizes[i] and self.offsets[i] not in seen:
+				seen.add(self.offsets[i])
+				stored += self.sizes[i]
+		return total / <double>stored if stored else 1.0
 
 	def __len__(self):
 		return self.size
@@ -208,21 +636,98 @@ cdef class MultiRoaringBitmap(object):
 	def getsize(self, long i):
 		return self.sizes[i]
 
+	def enable_cache(self, size_t maxbytes=64 << 20):
+		"""Cache the results of ``intersection()`` and ``evaluate()``.
+
+		:param maxbytes: the budget for the total size of the cached
+			results in bytes; when it is exceeded, the least recently
+			used results are discarded. If 0, disable the cache.
+
+		Results are cached by normalized query, so that the order of
+		indices or operands does not matter. An intersection that is not
+		in the cache starts from the cached intersection of the largest
+		subset of its indices, if any. Queries with a ``limit`` or
+		``offset``, and queries with RoaringBitmap operands, are not
+		cached."""
+		self._cache = QueryCache(maxbytes) if maxbytes else None
+
+	def cache_info(self):
+		"""Return statistics of the cache as a named tuple ``(hits, misses,
+		partialhits, entries, nbytes, maxbytes)``, or None if the cache is
+		not enabled; cf. ``enable_cache()``."""
+		return None if self._cache is None else self._cache.info()
+
+	def clear_cache(self):
+		"""Discard all cached results, keeping the budget."""
+		if self._cache is not None:
+			self._cache = QueryCache(self._cache.maxbytes)
+
+	def hasmetadata(self):
+		"""Return True if a summary of each bitmap is stored;
+		cf. ``cardinality()`` and ``bounds()``."""
+		return self.meta is not NULL
+
+	def cardinality(self, long i):
+		"""Return the number of elements in bitmap `i`; equivalent to
+		``len(self[i])``, but without accessing the data of the bitmap
+		if there is a metadata section.
+
+		:raises IndexError: if `i` is an invalid index."""
+		cdef ImmutableRoaringBitmap ob
+		if i < 0 or i >= self.size:
+			raise IndexError('index %d out of range 0..%d' % (i, self.size))
+		ob = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
+		return self._len(ob, i)
+
+	def bounds(self, long i):
+		"""Return a tuple ``(min, max)`` with the smallest and largest
+		element of bitmap `i`, or ``None`` if it is empty; uses the metadata
+		section if available.
+
+		:raises IndexError: if `i` is an invalid index."""
+		if i < 0 or i >= self.size:
+			raise IndexError('index %d out of range 0..%d' % (i, self.size))
+		elif self.sizes[i] == 0:
+			return None
+		elif self.meta is not NULL:
+			return self.meta[i].minelem, self.meta[i].maxelem
+		rb = self.get(i)
+		return rb.min(), rb.max()
+
+	def iter_union(self, indices, counts=False):
+		"""Iterate over the union of the given bitmaps in sorted order,
+		one block at a time; cf. ``merge_iter()``.
+
+		:param counts: if True, yield tuples ``(elem, count)`` where ``count``
+			is the number of the given bitmaps that contain ``elem``.
+		:raises IndexError: if an invalid index is encountered."""
+		cdef list bitmaps = []
+		for i in indices:
+			if i < 0 or i >= self.size:
+				raise IndexError('index %d out of range 0..%d' % (i, self.size))
+			bitmaps.append(self.get(i))
+		return MergeIterator(bitmaps, counts)
+
 	def intersection(self, list indices,
-			uint32_t start=0, uint32_t stop=0xffffffffUL):
+			uint32_t start=0, uint32_t stop=0xffffffffUL,
+			limit=None, offset=0):
 		"""Compute intersection of given a list of indices of roaring bitmaps
 		in this collection.
 
 		:param start: optional start index.
 		:param stop: optional end index;
 			if given, only return elements ``n`` s.t. ``start <= n < stop``.
+		:param limit, offset: if given, only return the elements of the
+			intersection with ranks ``offset`` up to ``offset + limit``;
+			cf. ``RoaringBitmap.intersection()``.
 		:returns: the intersection as a mutable RoaringBitmap.
 			Returns ``None`` when an invalid index is encountered or an empty
 			result is obtained.
+
+		The result is cached if ``enable_cache()`` was called. The GIL is
+		released while the result is intersected with the bitmaps after
+		the first two, and for the first two if they have many blocks.
 		"""
-		cdef ImmutableRoaringBitmap ob1, ob2
-		cdef RoaringBitmap result
-		cdef char *ptr = <char *>self.ptr
 		cdef long i, j, numindices = len(indices)
 		if numindices == 0:
 			return None
@@ -230,16 +735,63 @@ cdef class MultiRoaringBitmap(object):
 			j = indices[i]
 			if j < 0 or j >= self.size or self.sizes[j] == 0:
 				return None
+		if self.meta is not NULL and self._disjoint(indices, start, stop):
+			return None
+		if limit is not None or offset:
+			return andlimit([self.get(i) for i in indices],
+					start, stop, limit, offset) or None
+		if self._cache is not None and numindices > 1:
+			return self._cachedintersection(indices, start, stop)
+		return self._intersection(indices, start, stop)
+
+	cdef _cachedintersection(self, list indices, uint32_t start,
+			uint32_t stop):
+		"""Look up an intersection in the cache, or compute and store it;
+		start from a cached intersection over a subset of indices if
+		possible."""
+		cdef RoaringBitmap result
+		key = ('and', tuple(sorted(set(indices))), start, stop)
+		found, cached = self._cache.get(key)
+		if found:
+			return None if cached is None else RoaringBitmap(cached)
+		sub = self._cache.getsubset(key)
+		if sub is None:
+			result = self._intersection(list(key[1]), start, stop)
+		elif sub[1] is None:
+			result = None
+		else:
+			result = RoaringBitmap(sub[1])
+			rest = sorted(set(key[1]).difference(sub[0]),
+					key=self.getsize if self.meta is NULL else self.cardinality)
+			for i in rest:
+				rb_iand(result, self.get(i))
+				if result.size == 0:
+					break
+			result = result or None
+		self._cache.put(key, result)
+		return result
+
+	cdef _intersection(self, list indices, uint32_t start, uint32_t stop):
+		"""Compute intersection of at least one valid, non-empty index."""
+		cdef ImmutableRoaringBitmap ob1, ob2
+		cdef RoaringBitmap result
+		cdef array.array rest
+		cdef char *ptr = <char *>self.ptr
+		cdef uint16_t *keys = NULL
+		cdef uint16_t *tmpkeys
+		cdef Block *data = NULL
+		cdef Block *tmpdata
+		cdef long i, j, numindices = len(indices)
 		ob1 = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
 		if numindices == 1:
 			i = indices[0]
 			ob1._setptr(&(ptr[self.offsets[i]]), self.sizes[i])
 			if start or stop < 0xffffffffUL:
-				return rb_clamp(ob1, start, stop)
+				return rb_clamp(ob1, start, stop) or None
 			return ob1
-		indices.sort(key=self.getsize)
+		indices.sort(key=self.getsize if self.meta is NULL
+				else self.cardinality)
 		ob2 = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
-		# TODO with nogil?:
 		i, j = indices[0], indices[1]
 		ob1._setptr(&(ptr[self.offsets[i]]), self.sizes[i])
 		ob2._setptr(&(ptr[self.offsets[j]]), self.sizes[j])
@@ -248,15 +800,209 @@ cdef class MultiRoaringBitmap(object):
 			rb_iand(result, ob2)
 		else:
 			result = rb_and(ob1, ob2)
+		if result.size == 0 or numindices == 2:
+			return result or None
+		# result is not shared yet, so the remaining bitmaps can be
+		# intersected with it in place without the GIL. The number of blocks
+		# can only decrease, so alternate between two arrays of this size.
+		rest = array.clone(longarray, numindices - 2, False)
 		for i in range(2, numindices):
-			j = indices[i]
-			# swap out contents of ImmutableRoaringBitmap object
-			ob1._setptr(&(ptr[self.offsets[j]]), self.sizes[j])
-			rb_iand(result, ob1)
-			if result.size == 0:
-				return None
+			rest.data.as_ulongs[i - 2] = indices[i]
+		result.capacity = result.size
+		result._tmpalloc(result.size, &keys, &data)
+		with nogil:
+			for i in range(numindices - 2):
+				j = rest.data.as_ulongs[i]
+				# swap out contents of ImmutableRoaringBitmap object
+				ob1._setptr(&(ptr[self.offsets[j]]), self.sizes[j])
+				if ob1.size == 0:
+					for j in range(result.size):
+						aligned_free(result.data[j].buf.ptr)
+					result.size = 0
+					break
+				j = rb_iandblocks(result, ob1, keys, data)
+				tmpkeys, tmpdata = result.keys, result.data
+				result.keys, result.data = keys, data
+				keys, data = tmpkeys, tmpdata
+				result.size = j
+				if result.size == 0:
+					break
+		free(keys)
+		free(data)
+		result._resize(result.size)
+		return result or None
+
+	cdef bint _disjoint(self, list indices, uint32_t start, uint32_t stop):
+		"""Use the metadata section to check whether the intersection of
+		the given non-empty bitmaps restricted to ``start <= n < stop``
+		is empty. A False result is inconclusive."""
+		cdef RowMeta *meta
+		cdef uint64_t keys[METAKEYWORDS]
+		cdef uint32_t lo = start, hi = stop
+		cdef int n
+		if stop == 0:
+			return True
+		elif stop < 0xffffffffUL:  # NB: by default, stop is inclusive
+			hi = stop - 1
+		memset(keys, 0xff, sizeof(keys))
+		for i in indices:
+			meta = &(self.meta[<uint32_t>i])
+			if meta.minelem > lo:
+				lo = meta.minelem
+			if meta.maxelem < hi:
+				hi = meta.maxelem
+			if lo > hi:
+				return True
+			for n in range(METAKEYWORDS):
+				keys[n] &= meta.keys[n]
+		for n in range(METAKEYWORDS):
+			if keys[n]:
+				return False
+		return True
+
+	def evaluate(self, expr, uint32_t start=0, uint32_t stop=0xffffffffUL):
+		"""Evaluate a boolean query over roaring bitmaps in this collection.
+
+		:param expr: an index of a roaring bitmap in this collection,
+			a RoaringBitmap, or a tuple ``(op, operand1, operand2, ...)``
+			where each operand is again an expression, and ``op`` is one of:
+
+			- ``'and'`` (or ``'&'``): intersection of the operands;
+			- ``'or'`` (or ``'|'``): union of the operands;
+			- ``'andnot'`` (or ``'-'``): the first operand minus the rest.
+		:param start: optional start index.
+		:param stop: optional end index;
+			if given, only return elements ``n`` s.t. ``start <= n < stop``.
+		:returns: the result as a mutable RoaringBitmap.
+
+		>>> mrb.evaluate(('andnot', ('and', 0, 2), ('or', 1, 3)))
+		RoaringBitmap({2})
+
+		Operands of intersections are ordered by size, and empty operands
+		are eliminated before evaluation. The result is computed block by
+		block, without creating intermediate roaring bitmaps for
+		subexpressions."""
+		cdef QueryPlan plan
+		cdef RoaringBitmap result
+		cdef dict bitmaps = {}
+		tree = self._normalize(expr, bitmaps)
+		if tree is None or stop == 0 or start >= stop:
+			return RoaringBitmap()
+		# queries with RoaringBitmap operands are not cached,
+		# since those may be modified.
+		key = None
+		if self._cache is not None and not bitmaps:
+			key = ('eval', tree, start, stop)
+			found, cached = self._cache.get(key)
+			if found:
+				return RoaringBitmap(cached)
+		nnodes, nchildren = querysize(tree)
+		plan = QueryPlan(nnodes, nchildren)
+		self._buildplan(plan, tree, bitmaps)
+		if start or stop < 0xffffffffUL:
+			result = plan.evaluate(start, stop - 1)
+		else:
+			result = plan.evaluate(0, 0xffffffffUL)
+		if key is not None:
+			self._cache.put(key, result)
 		return result
 
+	def _normalize(self, expr, dict bitmaps):
+		"""Return canonical query tree for ``expr``, or None if the result
+		is known to be empty.
+
+		Nodes are of the form ``('leaf', index)``, ``('bitmap', id, size)``,
+		``('or', children)``, and ``('and', positive, negative)``, where the
+		latter represents the intersection of the positive children minus
+		the negative children. RoaringBitmap operands are stored in
+		``bitmaps`` with their ``id()`` as key. Nested operators of the same
+		type are flattened, and operands are sorted by their estimated
+		size."""
+		if isinstance(expr, RoaringBitmap):
+			if not expr:
+				return None
+			bitmaps[id(expr)] = expr
+			return ('bitmap', id(expr), expr.__sizeof__())
+		elif isinstance(expr, (int, long)):
+			if expr < 0 or expr >= self.size:
+				raise IndexError('index %d out of range 0..%d' % (
+						expr, self.size))
+			if self.sizes[expr] == 0:
+				return None
+			return ('leaf', expr)
+		elif not isinstance(expr, tuple) or len(expr) < 2:
+			raise ValueError('invalid query expression: %r' % (expr, ))
+		op = QUERYOPS.get(expr[0])
+		if op is None:
+			raise ValueError('unknown query operator: %r' % (expr[0], ))
+		operands = [self._normalize(a, bitmaps) for a in expr[1:]]
+		if op == 'or':
+			children = set()
+			for a in operands:
+				if a is None:
+					continue
+				elif a[0] == 'or':
+					children.update(a[1])
+				else:
+					children.add(a)
+			if len(children) == 0:
+				return None
+			elif len(children) == 1:
+				return children.pop()
+			return ('or', tuple(sorted(children, key=self._querykey)))
+		pos, neg = set(), set()
+		for a in (operands if op == 'and' else operands[:1]):
+			if a is None:
+				return None
+			elif a[0] == 'and':
+				pos.update(a[1])
+				neg.update(a[2])
+			else:
+				pos.add(a)
+		for a in (() if op == 'and' else operands[1:]):
+			if a is None:
+				continue
+			elif a[0] == 'or':  # x - (a | b) == x - a - b
+				neg.update(a[1])
+			else:
+				neg.add(a)
+		if pos & neg:
+			return None
+		elif len(pos) == 1 and not neg:
+			return pos.pop()
+		return ('and', tuple(sorted(pos, key=self._querykey)),
+				tuple(sorted(neg, key=self._querykey)))
+
+	def _queryest(self, tree):
+		"""Estimate the size of the result of a normalized query tree."""
+		if tree[0] == 'leaf':
+			return self.sizes[tree[1]]
+		elif tree[0] == 'bitmap':
+			return tree[2]
+		elif tree[0] == 'and':  # NB: first operand is the smallest
+			return self._queryest(tree[1][0])
+		return sum([self._queryest(a) for a in tree[1]])
+
+	def _querykey(self, tree):
+		return (self._queryest(tree), tree)
+
+	cdef int _buildplan(self, QueryPlan plan, tree, dict bitmaps) except -1:
+		"""Add nodes for normalized query tree to plan; return root index."""
+		cdef int n, i
+		if tree[0] == 'leaf':
+			return plan.addleaf(self.get(tree[1]))
+		elif tree[0] == 'bitmap':
+			return plan.addleaf(bitmaps[tree[1]])
+		elif tree[0] == 'or':
+			n = plan.addnode(QOR, len(tree[1]), 0)
+			children = tree[1]
+		else:  # tree[0] == 'and'
+			n = plan.addnode(QAND, len(tree[1]) + len(tree[2]), len(tree[1]))
+			children = tree[1] + tree[2]
+		for i, a in enumerate(children):
+			plan.setchild(n, i, self._buildplan(plan, a, bitmaps))
+		return n
+
 	def andor_len_pairwise(self, array.array indices1, array.array indices2,
 			array.array resultand, array.array resultor):
 		"""Pairwise intersection/union cardinality for pairs of roaring bitmaps
@@ -337,15 +1083,366 @@ cdef class MultiRoaringBitmap(object):
 		:param rb: a roaring bitmap.
 		:returns: a Python array of floats with the jaccard distances with
 			length equal to `len(self)`.
-		"""
+
+		If there is a metadata section, bitmaps that are disjoint with
+		`rb` according to their summary are skipped."""
 		cdef ImmutableRoaringBitmap ob1, ob2
 		cdef array.array result = array.clone(dblarray, len(self), False)
 		cdef char *ptr = <char *>self.ptr
+		cdef RowMeta rbmeta
 		cdef uint32_t n
 		ob1 = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
 		ob2 = ImmutableRoaringBitmap(rb)
 		with nogil:
+			rowmeta(ob2, &rbmeta)
 			for n in range(self.size):
+				if (self.meta is not NULL and self.sizes[n]
+						and rowdisjoint(&(self.meta[n]), &rbmeta)):
+					result.data.as_doubles[n] = 1
+					continue
 				ob1._setptr(&(ptr[self.offsets[n]]), self.sizes[n])
 				result.data.as_doubles[n] = rb_jaccard_dist(ob1, ob2)
 		return result
+
+	def intersection_len_single(self, rb, indices=None, topk=None):
+		"""Compute ``len(rb & self[i])`` for all bitmaps ``i`` in this
+		collection, or those in ``indices``; e.g., to count the matches of a
+		query for each facet.
+
+		>>> mrb.intersection_len_single(RoaringBitmap([1, 6, 19, 22]))
+		array.array('L', [3, 0, 2])
+
+		:param rb: a roaring bitmap.
+		:param indices: optionally, a sequence of indices; preferably an
+			array of unsigned long integers, created with
+			``array.array('L')``.
+		:param topk: if given, return only the ``topk`` largest results.
+		:returns: a Python array of unsigned long integers, with one result
+			for each index; if ``topk`` is given, a list of tuples
+			``(index, result)`` in descending order of result, ties broken
+			by index.
+
+		Blocks of bitmaps with keys not present in ``rb`` are skipped,
+		and the GIL is released. If there is a metadata section, bitmaps
+		that are disjoint with ``rb`` according to their summary are
+		skipped entirely."""
+		return self._lensingle(rb, indices, topk, LENAND)
+
+	def union_len_single(self, rb, indices=None, topk=None):
+		"""Compute ``len(rb | self[i])``;
+		cf. ``intersection_len_single()``."""
+		return self._lensingle(rb, indices, topk, LENOR)
+
+	def difference_len_single(self, rb, indices=None, topk=None):
+		"""Compute ``len(rb - self[i])``;
+		cf. ``intersection_len_single()``."""
+		return self._lensingle(rb, indices, topk, LENSUB)
+
+	cdef _lensingle(self, rb, indices, topk, int op):
+		cdef ImmutableRoaringBitmap ob1
+		cdef RoaringBitmap ob2 = ensurerb(rb)
+		cdef array.array idx, result
+		cdef FacetCount *facets = NULL
+		cdef unsigned long *res
+		cdef RowMeta rbmeta
+		cdef size_t n, i, length, andlen, rblen
+		if indices is None:
+			idx = array.array(longarray.typecode, range(self.size))
+		else:
+			idx = array.array(longarray.typecode, indices)
+			for i in idx:
+				if i >= self.size:
+					raise IndexError('index %d out of range 0..%d' % (
+							i, self.size))
+		length = len(idx)
+		result = array.clone(longarray, length, False)
+		res = result.data.as_ulongs
+		ob1 = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
+		ob2._exports += 1  # cannot be modified while the GIL is released
+		with nogil:
+			rblen = rb_len(ob2)
+			rowmeta(ob2, &rbmeta)
+			for n in range(length):
+				i = idx.data.as_ulongs[n]
+				andlen = 0
+				if self.sizes[i] and (self.meta is NULL
+						or not rowdisjoint(&(self.meta[i]), &rbmeta)):
+					ob1._setptr(&((<char *>self.ptr)[self.offsets[i]]),
+							self.sizes[i])
+					andlen = rb_andlen_gallop(ob1, ob2)
+				if op == LENAND:
+					res[n] = andlen
+				elif op == LENOR:
+					res[n] = rblen + self._len(ob1, i) - andlen
+				else:  # op == LENSUB
+					res[n] = rblen - andlen
+		ob2._exports -= 1
+		if topk is None:
+			return result
+		facets = <FacetCount *>malloc((length or 1) * sizeof(FacetCount))
+		if facets is NULL:
+			raise MemoryError(length)
+		with nogil:
+			for n in range(length):
+				facets[n].count = res[n]
+				facets[n].index = idx.data.as_ulongs[n]
+			qsort(facets, length, sizeof(FacetCount), cmpfacetcount)
+		try:
+			return [(facets[n].index, facets[n].count)
+					for n in range(length if topk > length else topk)]
+		finally:
+			free(facets)
+
+	def find_subsets(self, rb):
+		"""Return the indices of the bitmaps in this collection that are a
+		subset of ``rb``; i.e., ``self[i] <= rb``.
+
+		>>> mrb.find_subsets(RoaringBitmap([0, 1, 2, 3]))
+		RoaringBitmap({0})
+
+		:param rb: a roaring bitmap.
+		:returns: a RoaringBitmap with the indices of matching bitmaps.
+
+		Bitmaps with more elements or blocks than ``rb``, or with a range
+		of keys outside that of ``rb``, are skipped without comparing
+		their blocks; with a metadata section, also bitmaps whose summary
+		excludes a match. The GIL is released."""
+		return self._find(rb, FINDSUBSET)
+
+	def find_supersets(self, rb):
+		"""Return the indices of the bitmaps in this collection that are a
+		superset of ``rb``; i.e., ``self[i] >= rb``;
+		cf. ``find_subsets()``."""
+		return self._find(rb, FINDSUPERSET)
+
+	def find_intersecting(self, rb):
+		"""Return the indices of the bitmaps in this collection that have
+		at least one element in common with ``rb``;
+		cf. ``find_subsets()``."""
+		return self._find(rb, FINDINTERSECTING)
+
+	cdef _find(self, rb, int op):
+		cdef ImmutableRoaringBitmap ob1
+		cdef RoaringBitmap ob2 = ensurerb(rb)
+		cdef RoaringBitmap result = RoaringBitmap()
+		cdef array.array matches = array.clone(uintarray, self.size, False)
+		cdef uint32_t *res = matches.data.as_uints
+		cdef RowMeta rbmeta
+		cdef uint32_t n
+		cdef size_t numres = 0
+		ob1 = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
+		ob2._exports += 1  # cannot be modified while the GIL is released
+		with nogil:
+			rowmeta(ob2, &rbmeta)
+			for n in range(self.size):
+				if self._findrow(n, op, ob1, ob2, &rbmeta):
+					res[numres] = n
+					numres += 1
+		ob2._exports -= 1
+		result._initsorted(res, numres)
+		return result
+
+	cdef bint _findrow(self, uint32_t n, int op, ImmutableRoaringBitmap ob1,
+			RoaringBitmap ob2, RowMeta *rbmeta) noexcept nogil:
+		"""Test whether bitmap n stands in relation ``op`` to ``ob2``, using
+		``ob1`` as scratch object."""
+		cdef RowMeta *meta
+		cdef size_t card
+		cdef uint16_t first, last
+		cdef int i
+		if self.sizes[n] == 0 or rbmeta.cardinality == 0:
+			if op == FINDSUBSET:
+				return self.sizes[n] == 0
+			elif op == FINDSUPERSET:
+				return rbmeta.cardinality == 0
+			return False
+		if self.meta is not NULL:
+			meta = &(self.meta[n])
+			if op == FINDINTERSECTING:
+				if rowdisjoint(meta, rbmeta):
+					return False
+			elif op == FINDSUPERSET:
+				meta, rbmeta = rbmeta, meta
+			if op != FINDINTERSECTING:
+				# now test whether meta may be a subset of rbmeta
+				if (meta.cardinality > rbmeta.cardinality
+						or meta.nblocks > rbmeta.nblocks
+						or meta.minelem < rbmeta.minelem
+						or meta.maxelem > rbmeta.maxelem):
+					return False
+				for i in range(METAKEYWORDS):
+					if meta.keys[i] & ~rbmeta.keys[i]:
+						return False
+		ob1._setptr(&((<char *>self.ptr)[self.offsets[n]]), self.sizes[n])
+		if self.meta is NULL:
+			# prune with keys and cardinalities, without reading the blocks
+			first, last = ob1.keys[0], ob1.keys[ob1.size - 1]
+			if op == FINDSUBSET:
+				if (ob1.size > ob2.size or first < ob2.keys[0]
+						or last > ob2.keys[ob2.size - 1]):
+					return False
+				card = rb_len(ob1)
+				if card > rbmeta.cardinality:
+					return False
+			elif op == FINDSUPERSET:
+				if (ob1.size < ob2.size or first > ob2.keys[0]
+						or last < ob2.keys[ob2.size - 1]):
+					return False
+				card = rb_len(ob1)
+				if card < rbmeta.cardinality:
+					return False
+			elif last < ob2.keys[0] or first > ob2.keys[ob2.size - 1]:
+				return False
+		if op == FINDSUBSET:
+			return rb_issubset(ob1, ob2)
+		elif op == FINDSUPERSET:
+			return rb_issubset(ob2, ob1)
+		return not rb_isdisjoint(ob1, ob2)
+
+	def similarity_matrix(self, rows, cols=None, metric='jaccard', out=None,
+			int nthreads=1):
+		"""Compute a similarity metric for all pairs of roaring bitmaps
+		with indices ``rows`` x ``cols``.
+
+		:param rows: a sequence of indices; preferably an array of unsigned
+			long integers, created with ``array.array('L')``.
+		:param cols: a sequence of indices; if not given or equal to
+			``rows``, compare ``rows`` with itself, and only compute half of
+			the (symmetric) matrix.
+		:param metric: one of ``'intersection'``, ``'union'`` (cardinality
+			of intersection or union), ``'jaccard'``, ``'jaccard_dist'``,
+			``'cosine'``, or ``'overlap'`` (intersection cardinality divided
+			by that of the smallest set).
+		:param out: optionally, a preallocated, writable, C-contiguous
+			buffer of ``len(rows) * len(cols)`` doubles (e.g., a 2-D numpy
+			array of type float64).
+		:param nthreads: divide the work among this number of threads.
+		:returns: ``out``, or a Python array of doubles with the matrix in
+			row-major order; i.e., the value for ``rows[i]`` and ``cols[j]``
+			is at index ``i * len(cols) + j``.
+
+		>>> mrb.similarity_matrix(array.array('L', [0, 1]), metric='union')
+		array.array('d', [3.0, 5.0, 5.0, 3.0])
+
+		The matrix is computed in tiles of bitmaps so that operands are
+		re-used while they are in the cache; the GIL is released."""
+		cdef array.array rowarr, colarr, rowlens, collens
+		cdef array.array result = None
+		cdef ImmutableRoaringBitmap ob1
+		cdef Py_buffer buffer
+		cdef Py_ssize_t size = 0
+		cdef char *ptr = NULL
+		cdef int i, n, m, metricid
+		cdef bint symmetric
+		if metric not in SIMILARITYMETRICS:
+			raise ValueError('unknown metric: %r' % (metric, ))
+		metricid = SIMILARITYMETRICS[metric]
+		rowarr = array.array(longarray.typecode, rows)
+		colarr = rowarr if cols is None else array.array(
+				longarray.typecode, cols)
+		symmetric = cols is None or colarr == rowarr
+		if symmetric:
+			colarr = rowarr
+		n, m = len(rowarr), len(colarr)
+		for a in (rowarr if symmetric else rowarr + colarr):
+			if a >= self.size:
+				raise IndexError('index %d out of range 0..%d' % (
+						a, self.size))
+		if out is None:
+			result = array.clone(dblarray, n * m, False)
+			ptr = <char *>result.data.as_doubles
+		else:
+			view = memoryview(out)
+			if (view.readonly or view.format != 'd'
+					or not view.c_contiguous or view.nbytes != n * m * 8):
+				raise ValueError('out should be a writable, contiguous '
+						'buffer of %d doubles.' % (n * m))
+			if getbufptr(out, &ptr, &size, &buffer) != 0:
+				raise ValueError('could not get buffer from out.')
+		ob1 = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
+		rowlens = array.clone(longarray, n, False)
+		with nogil:
+			for i in range(n):
+				rowlens.data.as_ulongs[i] = self._len(
+						ob1, rowarr.data.as_ulongs[i])
+		if symmetric:
+			collens = rowlens
+		else:
+			collens = array.clone(longarray, m, False)
+			with nogil:
+				for i in range(m):
+					collens.data.as_ulongs[i] = self._len(
+							ob1, colarr.data.as_ulongs[i])
+
+		def work(int first, int step):
+			cdef ImmutableRoaringBitmap ob1, ob2
+			ob1 = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
+			ob2 = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
+			with nogil:
+				self._similaritytiles(
+						ob1, ob2, rowarr.data.as_ulongs, n,
+						colarr.data.as_ulongs, m,
+						rowlens.data.as_ulongs, collens.data.as_ulongs,
+						metricid, symmetric, <double *>ptr, first, step)
+
+		try:
+			if nthreads <= 1:
+				work(0, 1)
+			else:
+				threads = [threading.Thread(target=work, args=(a, nthreads))
+						for a in range(nthreads)]
+				for thread in threads:
+					thread.start()
+				for thread in threads:
+					thread.join()
+		finally:
+			if out is not None:
+				releasebuf(&buffer)
+		return result if out is None else out
+
+	cdef size_t _len(self, ImmutableRoaringBitmap ob,
+			uint32_t i) noexcept nogil:
+		"""Return cardinality of bitmap i, using ob as scratch object."""
+		if self.sizes[i] == 0:
+			return 0
+		elif self.meta is not NULL:
+			return self.meta[i].cardinality
+		ob._setptr(&((<char *>self.ptr)[self.offsets[i]]), self.sizes[i])
+		return rb_len(ob)
+
+	cdef void _similaritytiles(self,
+			ImmutableRoaringBitmap ob1, ImmutableRoaringBitmap ob2,
+			unsigned long *rows, int n, unsigned long *cols, int m,
+			unsigned long *rowlens, unsigned long *collens,
+			int metric, bint symmetric, double *result,
+			int first, int step) noexcept nogil:
+		"""Compute tiles of rows with indices first, first + step, ...
+
+		When symmetric, only tiles on or above the diagonal are computed,
+		and the results are mirrored."""
+		cdef char *ptr = <char *>self.ptr
+		cdef int rowtile = first * SIMTILE, coltile, i, j, jstart, iend, jend
+		cdef size_t andlen
+		cdef double val
+		while rowtile < n:
+			iend = rowtile + SIMTILE if rowtile + SIMTILE < n else n
+			coltile = rowtile if symmetric else 0
+			while coltile < m:
+				jend = coltile + SIMTILE if coltile + SIMTILE < m else m
+				for i in range(rowtile, iend):
+					if self.sizes[rows[i]]:
+						ob1._setptr(&(ptr[self.offsets[rows[i]]]),
+								self.sizes[rows[i]])
+					jstart = i if symmetric and coltile == rowtile else coltile
+					for j in range(jstart, jend):
+						andlen = 0
+						if self.sizes[rows[i]] and self.sizes[cols[j]]:
+							ob2._setptr(&(ptr[self.offsets[cols[j]]]),
+									self.sizes[cols[j]])
+							andlen = rb_andlen(ob1, ob2)
+						val = similarity(metric, andlen, rowlens[i], collens[j])
+						result[i * m + j] = val
+						if symmetric:
+							result[j * m + i] = val
+				coltile += SIMTILE
+			rowtile += step * SIMTILE
@@ -0,0 +1,256 @@
+"""Key-by-key evaluation of boolean queries over roaring bitmaps.
+
+A query is compiled into a flat array of nodes. Instead of materializing a
+roaring bitmap for each subexpression, the result is computed one block
+(i.e., key) at a time: candidate keys are found with a leapfrog walk over the
+keys of the operands, and each node evaluates its block for the current key
+into a scratch block that is reused for subsequent keys.
+"""
+
+# Operators of query nodes
+DEF QLEAF = 0
+DEF QAND = 1  # intersection of positive operands minus negative operands
+DEF QOR = 2
+
+# Names of operators accepted in query expressions
+QUERYOPS = {'and': 'and', '&': 'and',
+		'or': 'or', '|': 'or',
+		'andnot': 'andnot', '-': 'andnot'}
+
+
+cdef struct QueryNode:
+	int op  # QLEAF, QAND, or QOR
+	int start, stop  # children of this node: children[start:stop]
+	int npos  # QAND: children[start:start + npos] are positive operands
+	Block scratch  # result of this node for the current key
+	# the following are only used by leaves:
+	uint16_t *keys
+	Block *data
+	size_t offset  # non-zero for immutable bitmaps
+	uint32_t size
+	uint32_t pos  # cursor: index of first key >= last requested key
+	Block tmp  # block with adjusted pointer for immutable bitmaps
+
+
+cdef class QueryPlan(object):
+	"""A compiled query, evaluated with ``QueryPlan.evaluate()``.
+
+	Leaves of the query are roaring bitmaps; these are kept alive by the
+	plan. Cursors are advanced during evaluation, so a plan can only be
+	evaluated once."""
+	cdef QueryNode *nodes
+	cdef int *children
+	cdef int nnodes, nchildren
+	cdef list refs  # the leaves
+
+	def __cinit__(self, int nnodes, int nchildren):
+		self.nodes = <QueryNode *>calloc(nnodes or 1, sizeof(QueryNode))
+		self.children = <int *>calloc(nchildren or 1, sizeof(int))
+		if self.nodes is NULL or self.children is NULL:
+			raise MemoryError((nnodes, nchildren))
+		self.nnodes = self.nchildren = 0
+		self.refs = []
+
+	def __dealloc__(self):
+		cdef int n
+		if self.nodes is not NULL:
+			for n in range(self.nnodes):
+				aligned_free(self.nodes[n].scratch.buf.ptr)
+			free(self.nodes)
+			self.nodes = NULL
+		free(self.children)
+		self.children = NULL
+
+	cdef int addleaf(self, RoaringBitmap ob):
+		"""Add node for a roaring bitmap; return its index."""
+		cdef QueryNode *node = &(self.nodes[self.nnodes])
+		self.refs.append(ob)
+		node.op = QLEAF
+		node.keys = ob.keys
+		node.data = ob.data
+		node.offset = ob.offset
+		node.size = ob.size
+		node.pos = 0
+		self.nnodes += 1
+		return self.nnodes - 1
+
+	cdef int addnode(self, int op, int numchildren, int npos):
+		"""Add node for an operator; return its index.
+
+		The indices of its children should be stored with ``setchild()``."""
+		cdef QueryNode *node = &(self.nodes[self.nnodes])
+		node.op = op
+		node.start = self.nchildren
+		node.stop = self.nchildren + numchildren
+		node.npos = npos
+		self.nchildren += numchildren
+		self.nnodes += 1
+		return self.nnodes - 1
+
+	cdef void setchild(self, int n, int i, int child):
+		"""Set the i'th child of node n."""
+		self.children[self.nodes[n].start + i] = child
+
+	cdef RoaringBitmap evaluate(self, uint32_t start, uint32_t stop):
+		"""Return the result of the query as a new RoaringBitmap.
+
+		Only elements ``start <= n <= stop`` are included."""
+		cdef RoaringBitmap result = RoaringBitmap()
+		cdef Block *block
+		cdef Block *ptr
+		cdef Block tmp
+		cdef uint32_t key = highbits(start), keystop = highbits(stop)
+		if self.nnodes == 0:
+			return result
+		key = query_nextkey(self.nodes, self.children, 0, key)
+		while key <= keystop:
+			result._extendarray(1)
+			block = &(result.data[result.size])
+			memset(block, 0, sizeof(Block))
+			ptr = query_evalblock(self.nodes, self.children, 0, key, block)
+			if ptr is not NULL and ptr is not block:
+				block_copy(block, ptr)
+			if ptr is not NULL and (
+					(key == highbits(start) and lowbits(start) != 0)
+					or (key == keystop and lowbits(stop) != 0xffff)):
+				memset(&tmp, 0, sizeof(Block))
+				block_clamp(&tmp, block,
+						lowbits(start) if key == highbits(start) else 0,
+						lowbits(stop) + 1 if key == keystop else BLOCKSIZE)
+				aligned_free(block.buf.ptr)
+				block[0] = tmp
+			if ptr is not NULL and block.cardinality:
+				result.keys[result.size] = key
+				result.size += 1
+			else:
+				aligned_free(block.buf.ptr)
+			key = query_nextkey(self.nodes, self.children, 0, key + 1)
+		result._resize(result.size)
+		return result
+
+
+cdef uint32_t query_nextkey(QueryNode *nodes, int *children, int n,
+		uint32_t key) noexcept nogil:
+	"""Return smallest key ``>= key`` for which node n may have elements.
+
+	:returns: a key, or ``BLOCKSIZE`` if there are no more keys."""
+	cdef QueryNode *node = &(nodes[n])
+	cdef uint32_t result, tmp
+	cdef int i
+	if key >= BLOCKSIZE:
+		return BLOCKSIZE
+	if node.op == QLEAF:
+		if node.pos < node.size and node.keys[node.pos] < key:
+			node.pos = advance(node.keys, node.pos, node.size, key)
+		if node.pos < node.size:
+			return node.keys[node.pos]
+		return BLOCKSIZE
+	elif node.op == QAND:  # leapfrog over positive operands
+		result = key
+		i = node.start
+		while i < node.start + node.npos:
+			tmp = query_nextkey(nodes, children, children[i], result)
+			if tmp >= BLOCKSIZE:
+				return BLOCKSIZE
+			elif tmp > result:
+				result = tmp
+				if i != node.start:
+					i = node.start
+					continue
+			i += 1
+		return result
+	else:  # node.op == QOR
+		result = BLOCKSIZE
+		for i in range(node.start, node.stop):
+			tmp = query_nextkey(nodes, children, children[i], key)
+			if tmp < result:
+				result = tmp
+				if result == key:
+					break
+		return result
+
+
+cdef Block *query_child(QueryNode *nodes, int *children, int n,
+		uint32_t key) noexcept nogil:
+	"""Return block of node n for key, or NULL if it has no elements."""
+	cdef QueryNode *node = &(nodes[n])
+	if query_nextkey(nodes, children, n, key) != key:
+		return NULL
+	elif node.op != QLEAF:
+		return query_evalblock(nodes, children, n, key, &(node.scratch))
+	elif node.offset:
+		node.tmp = node.data[node.pos]
+		node.tmp.buf.ptr = <void *>(node.tmp.buf.offset + node.offset)
+		return &(node.tmp)
+	return &(node.data[node.pos])
+
+
+cdef Block *query_evalblock(QueryNode *nodes, int *children, int n,
+		uint32_t key, Block *out) noexcept nogil:
+	"""Evaluate node n for the block with the given key.
+
+	:param out: a zero-initialized or previously allocated block that may be
+		used to store the result.
+	:returns: a pointer to the result, which is either ``out`` or a block of
+		an operand that should not be modified; NULL if the result is empty.
+	"""
+	cdef QueryNode *node = &(nodes[n])
+	cdef Block *result = NULL
+	cdef Block *ptr
+	cdef int i
+	if node.op == QLEAF:
+		return query_child(nodes, children, n, key)
+	elif node.op == QAND:
+		result = query_child(nodes, children, children[node.start], key)
+		if result is NULL:
+			return NULL
+		for i in range(node.start + 1, node.start + node.npos):
+			ptr = query_child(nodes, children, children[i], key)
+			if ptr is NULL:
+				return NULL
+			elif result is not out:
+				block_and(out, result, ptr)
+				result = out
+			else:
+				block_iand(out, ptr)
+			if result.cardinality == 0:
+				return NULL
+		for i in range(node.start + node.npos, node.stop):
+			ptr = query_child(nodes, children, children[i], key)
+			if ptr is NULL:
+				continue
+			elif result is not out:
+				block_sub(out, result, ptr)
+				result = out
+			else:
+				block_isub(out, ptr)
+			if result.cardinality == 0:
+				return NULL
+		return result
+	else:  # node.op == QOR
+		for i in range(node.start, node.stop):
+			ptr = query_child(nodes, children, children[i], key)
+			if ptr is NULL:
+				continue
+			elif result is NULL:
+				result = ptr
+			elif result is not out:
+				block_or(out, result, ptr)
+				result = out
+			else:
+				block_ior(out, ptr)
+		return result
+
+
+cdef tuple querysize(tree):
+	"""Return the number of nodes and child references in a query tree."""
+	cdef int nnodes = 1, nchildren
+	if tree[0] == 'leaf' or tree[0] == 'bitmap':
+		return 1, 0
+	children = tree[1] if tree[0] == 'or' else tree[1] + tree[2]
+	nchildren = len(children)
+	for a in children:
+		x, y = querysize(a)
+		nnodes += x
+		nchildren += y
+	return nnodes, nchildren
@@ -40,10 +40,10 @@ cdef inline richcmp(x, y, int op):
 
 
 cdef inline RoaringBitmap rb_iand(RoaringBitmap ob1, RoaringBitmap ob2):
-	cdef uint32_t pos1 = 0, pos2 = 0, res = 0
+	cdef uint32_t pos1, res = 0
 	cdef uint16_t *keys = NULL
 	cdef Block *data = NULL
-	cdef Block b2
+	ob1._checkexports()
 	if ob2.size == 0:
 		for pos1 in range(ob1.size):
 			aligned_free(ob1.data[pos1].buf.ptr)
@@ -51,128 +51,127 @@ cdef inline RoaringBitmap rb_iand(RoaringBitmap ob1, RoaringBitmap ob2):
 	elif ob1.size > 0:
 		ob1.capacity = min(ob1.size, ob2.size)
 		ob1._tmpalloc(ob1.capacity, &keys, &data)
-		while True:
-			if ob1.keys[pos1] < ob2.keys[pos2]:
-				aligned_free(ob1.data[pos1].buf.ptr)
-				pos1 += 1
-				if pos1 == ob1.size:
-					break
-			elif ob1.keys[pos1] > ob2.keys[pos2]:
-				pos2 += 1
-				if pos2 == ob2.size:
-					break
-			else:  # ob1.keys[pos1] == ob2.keys[pos2]:
-				block_iand(&(ob1.data[pos1]), ob2._getblk(pos2, &b2))
-				if ob1.data[pos1].cardinality > 0:
-					keys[res] = ob1.keys[pos1]
-					data[res] = ob1.data[pos1]
-					res += 1
-				else:
-					aligned_free(ob1.data[pos1].buf.ptr)
-				pos1 += 1
-				pos2 += 1
-				if pos1 == ob1.size or pos2 == ob2.size:
-					break
+		res = rb_iandblocks(ob1, ob2, keys, data)
 		ob1._replacearrays(keys, data, res)
 	return ob1
 
 
-cdef inline RoaringBitmap rb_isub(RoaringBitmap ob1, RoaringBitmap ob2):
+cdef uint32_t rb_iandblocks(RoaringBitmap ob1, RoaringBitmap ob2,
+		uint16_t *keys, Block *data) noexcept nogil:
+	"""Block loop of rb_iand(); store result in preallocated arrays,
+	return number of blocks in result."""
 	cdef uint32_t pos1 = 0, pos2 = 0, res = 0
-	cdef uint16_t *keys = NULL
-	cdef Block *data = NULL
 	cdef Block b2
-	if pos1 < ob1.size and pos2 < ob2.size:
-		ob1.capacity = ob1.size
-		ob1._tmpalloc(ob1.capacity, &keys, &data)
-		while True:
-			if ob1.keys[pos1] < ob2.keys[pos2]:
-				keys[res] = ob1.keys[pos1]
-				data[res] = ob1.data[pos1]
-				res += 1
-				pos1 += 1
-				if pos1 == ob1.size:
-					break
-			elif ob1.keys[pos1] > ob2.keys[pos2]:
-				pos2 += 1
-				if pos2 == ob2.size:
-					break
-			else:  # ob1.keys[pos1] == ob2.keys[pos2]:
-				block_isub(&(ob1.data[pos1]), ob2._getblk(pos2, &b2))
-				if ob1.data[pos1].cardinality > 0:
-					keys[res] = ob1.keys[pos1]
-					data[res] = ob1.data[pos1]
-					res += 1
-				else:
-					aligned_free(ob1.data[pos1].buf.ptr)
-				pos1 += 1
-				pos2 += 1
-				if pos1 == ob1.size or pos2 == ob2.size:
-					break
-		if pos2 == ob2.size:
-			for pos1 in range(pos1, ob1.size):
+	while True:
+		if ob1.keys[pos1] < ob2.keys[pos2]:
+			aligned_free(ob1.data[pos1].buf.ptr)
+			pos1 += 1
+			if pos1 == ob1.size:
+				break
+		elif ob1.keys[pos1] > ob2.keys[pos2]:
+			pos2 += 1
+			if pos2 == ob2.size:
+				break
+		else:  # ob1.keys[pos1] == ob2.keys[pos2]:
+			block_iand(&(ob1.data[pos1]), ob2._getblk(pos2, &b2))
+			if ob1.data[pos1].cardinality > 0:
 				keys[res] = ob1.keys[pos1]
 				data[res] = ob1.data[pos1]
 				res += 1
+			else:
+				aligned_free(ob1.data[pos1].buf.ptr)
+			pos1 += 1
+			pos2 += 1
+			if pos1 == ob1.size or pos2 == ob2.size:
+				break
+	# free remaining blocks that are not in ob2
+	for pos1 in range(pos1, ob1.size):
+		aligned_free(ob1.data[pos1].buf.ptr)
+	return res
+
+
+cdef inline RoaringBitmap rb_isub(RoaringBitmap ob1, RoaringBitmap ob2):
+	cdef uint32_t res = 0
+	cdef uint16_t *keys = NULL
+	cdef Block *data = NULL
+	ob1._checkexports()
+	if ob1.size > 0 and ob2.size > 0:
+		ob1.capacity = ob1.size
+		ob1._tmpalloc(ob1.capacity, &keys, &data)
+		res = rb_isubblocks(ob1, ob2, keys, data)
 		ob1._replacearrays(keys, data, res)
 	return ob1
 
 
-cdef inline RoaringBitmap rb_ior(RoaringBitmap ob1, RoaringBitmap ob2):
+cdef uint32_t rb_isubblocks(RoaringBitmap ob1, RoaringBitmap ob2,
+		uint16_t *keys, Block *data) noexcept nogil:
+	"""Block loop of rb_isub(); cf. rb_iandblocks()."""
 	cdef uint32_t pos1 = 0, pos2 = 0, res = 0
-	cdef uint16_t *keys = NULL
-	cdef Block *data = NULL
 	cdef Block b2
-	if ob2.size == 0:
-		return ob1
-	ob1.capacity = ob1.size + ob2.size
-	ob1._tmpalloc(ob1.capacity, &keys, &data)
-	if pos1 < ob1.size and pos2 < ob2.size:
-		while True:
-			if ob1.keys[pos1] < ob2.keys[pos2]:
-				keys[res] = ob1.keys[pos1]
-				data[res] = ob1.data[pos1]
-				res += 1
-				pos1 += 1
-				if pos1 == ob1.size:
-					break
-			elif ob1.keys[pos1] > ob2.keys[pos2]:
-				keys[res] = ob2.keys[pos2]
-				block_copy(&(data[res]), ob2._getblk(pos2, &b2))
-				res += 1
-				pos2 += 1
-				if pos2 == ob2.size:
-					break
-			else:  # ob1.keys[pos1] == ob2.keys[pos2]:
-				block_ior(&(ob1.data[pos1]), ob2._getblk(pos2, &b2))
+	while True:
+		if ob1.keys[pos1] < ob2.keys[pos2]:
+			keys[res] = ob1.keys[pos1]
+			data[res] = ob1.data[pos1]
+			res += 1
+			pos1 += 1
+			if pos1 == ob1.size:
+				break
+		elif ob1.keys[pos1] > ob2.keys[pos2]:
+			pos2 += 1
+			if pos2 == ob2.size:
+				break
+		else:  # ob1.keys[pos1] == ob2.keys[pos2]:
+			block_isub(&(ob1.data[pos1]), ob2._getblk(pos2, &b2))
+			if ob1.data[pos1].cardinality > 0:
 				keys[res] = ob1.keys[pos1]
 				data[res] = ob1.data[pos1]
 				res += 1
-				pos1 += 1
-				pos2 += 1
-				if pos1 == ob1.size or pos2 == ob2.size:
-					break
-	if pos1 == ob1.size:
-		for pos2 in range(pos2, ob2.size):
-			keys[res] = ob2.keys[pos2]
-			block_copy(&(data[res]), ob2._getblk(pos2, &b2))
-			res += 1
-	elif pos2 == ob2.size:
+			else:
+				aligned_free(ob1.data[pos1].buf.ptr)
+			pos1 += 1
+			pos2 += 1
+			if pos1 == ob1.size or pos2 == ob2.size:
+				break
+	if pos2 == ob2.size:
 		for pos1 in range(pos1, ob1.size):
 			keys[res] = ob1.keys[pos1]
 			data[res] = ob1.data[pos1]
 			res += 1
+	return res
+
+
+cdef inline RoaringBitmap rb_ior(RoaringBitmap ob1, RoaringBitmap ob2):
+	cdef uint32_t res = 0
+	cdef uint16_t *keys = NULL
+	cdef Block *data = NULL
+	ob1._checkexports()
+	if ob2.size == 0:
+		return ob1
+	ob1.capacity = ob1.size + ob2.size
+	ob1._tmpalloc(ob1.capacity, &keys, &data)
+	res = rb_iorblocks(ob1, ob2, keys, data, False)
 	ob1._replacearrays(keys, data, res)
 	return ob1
 
 
 cdef inline RoaringBitmap rb_ixor(RoaringBitmap ob1, RoaringBitmap ob2):
-	cdef uint32_t pos1 = 0, pos2 = 0, res = 0
+	cdef uint32_t res = 0
 	cdef uint16_t *keys = NULL
 	cdef Block *data = NULL
-	cdef Block b2
+	ob1._checkexports()
 	ob1.capacity = ob1.size + ob2.size
 	ob1._tmpalloc(ob1.capacity, &keys, &data)
+	res = rb_iorblocks(ob1, ob2, keys, data, True)
+	ob1._replacearrays(keys, data, res)
+	return ob1
+
+
+cdef uint32_t rb_iorblocks(RoaringBitmap ob1, RoaringBitmap ob2,
+		uint16_t *keys, Block *data, bint xor) noexcept nogil:
+	"""Block loop of rb_ior() and (if xor is True) rb_ixor();
+	cf. rb_iandblocks()."""
+	cdef uint32_t pos1 = 0, pos2 = 0, res = 0
+	cdef Block b2
 	if pos1 < ob1.size and pos2 < ob2.size:
 		while True:
 			if ob1.keys[pos1] < ob2.keys[pos2]:
@@ -190,7 +189,10 @@ cdef inline RoaringBitmap rb_ixor(RoaringBitmap ob1, RoaringBitmap ob2):
 				if pos2 == ob2.size:
 					break
 			else:  # ob1.keys[pos1] == ob2.keys[pos2]:
-				block_ixor(&(ob1.data[pos1]), ob2._getblk(pos2, &b2))
+				if xor:
+					block_ixor(&(ob1.data[pos1]), ob2._getblk(pos2, &b2))
+				else:
+					block_ior(&(ob1.data[pos1]), ob2._getblk(pos2, &b2))
 				if ob1.data[pos1].cardinality > 0:
 					keys[res] = ob1.keys[pos1]
 					data[res] = ob1.data[pos1]
@@ -211,169 +213,199 @@ cdef inline RoaringBitmap rb_ixor(RoaringBitmap ob1, RoaringBitmap ob2):
 			keys[res] = ob1.keys[pos1]
 			data[res] = ob1.data[pos1]
 			res += 1
-	ob1._replacearrays(keys, data, res)
-	return ob1
+	return res
 
 
 cdef inline RoaringBitmap rb_and(RoaringBitmap ob1, RoaringBitmap ob2):
 	cdef RoaringBitmap result = RoaringBitmap()
-	cdef uint32_t pos1 = 0, pos2 = 0
-	cdef Block b1, b2
-	if pos1 < ob1.size and pos2 < ob2.size:
+	if ob1.size > 0 and ob2.size > 0:
 		# initialize to zero so that unallocated blocks can be detected
 		result._initarray(min(ob1.size, ob2.size))
-		while True:
-			if ob1.keys[pos1] < ob2.keys[pos2]:
-				pos1 += 1
-				if pos1 == ob1.size:
-					break
-			elif ob1.keys[pos1] > ob2.keys[pos2]:
-				pos2 += 1
-				if pos2 == ob2.size:
-					break
-			else:  # ob1.keys[pos1] == ob2.keys[pos2]:
-				block_and(&(result.data[result.size]),
-						ob1._getblk(pos1, &b1), ob2._getblk(pos2, &b2))
-				if result.data[result.size].cardinality:
-					result.keys[result.size] = ob1.keys[pos1]
-					result.size += 1
-				pos1 += 1
-				pos2 += 1
-				if pos1 == ob1.size or pos2 == ob2.size:
-					break
-		aligned_free(result.data[result.size].buf.ptr)
+		if ob1.size + ob2.size > NOGILBLOCKS:
+			ob1._exports += 1  # operands cannot be modified meanwhile
+			ob2._exports += 1
+			with nogil:
+				result.size = rb_andblocks(
+						ob1, ob2, result.keys, result.data)
+			ob1._exports -= 1
+			ob2._exports -= 1
+		else:
+			result.size = rb_andblocks(ob1, ob2, result.keys, result.data)
 		result._resize(result.size)
 	return result
 
 
+cdef uint32_t rb_andblocks(RoaringBitmap ob1, RoaringBitmap ob2,
+		uint16_t *keys, Block *data) noexcept nogil:
+	"""Block loop of rb_and(); store result in preallocated, zero-initialized
+	arrays with room for at least one block more than the result; return
+	number of blocks in result."""
+	cdef uint32_t pos1 = 0, pos2 = 0, res = 0
+	cdef Block b1, b2
+	while True:
+		if ob1.keys[pos1] < ob2.keys[pos2]:
+			pos1 += 1
+			if pos1 == ob1.size:
+				break
+		elif ob1.keys[pos1] > ob2.keys[pos2]:
+			pos2 += 1
+			if pos2 == ob2.size:
+				break
+		else:  # ob1.keys[pos1] == ob2.keys[pos2]:
+			block_and(&(data[res]),
+					ob1._getblk(pos1, &b1), ob2._getblk(pos2, &b2))
+			if data[res].cardinality:
+				keys[res] = ob1.keys[pos1]
+				res += 1
+			pos1 += 1
+			pos2 += 1
+			if pos1 == ob1.size or pos2 == ob2.size:
+				break
+	aligned_free(data[res].buf.ptr)
+	return res
+
+
 cdef inline RoaringBitmap rb_sub(RoaringBitmap ob1, RoaringBitmap ob2):
 	cdef RoaringBitmap result = RoaringBitmap()
-	cdef uint32_t pos1 = 0, pos2 = 0
-	cdef Block b1, b2
 	result._initarray(ob1.size)
-	if pos1 < ob1.size and pos2 < ob2.size:
-		while True:
-			if ob1.keys[pos1] < ob2.keys[pos2]:
-				result._insertcopy(
-						result.size, ob1.keys[pos1], ob1._getblk(pos1, &b1))
-				pos1 += 1
-				if pos1 == ob1.size:
-					break
-			elif ob1.keys[pos1] > ob2.keys[pos2]:
-				pos2 += 1
-				if pos2 == ob2.size:
-					break
-			else:  # ob1.keys[pos1] == ob2.keys[pos2]:
-				block_sub(&(result.data[result.size]),
-						ob1._getblk(pos1, &b1), ob2._getblk(pos2, &b2))
-				if result.data[result.size].cardinality > 0:
-					result.keys[result.size] = ob1.keys[pos1]
-					result.size += 1
-				pos1 += 1
-				pos2 += 1
-				if pos1 == ob1.size or pos2 == ob2.size:
-					break
-		if pos2 == ob2.size:
-			for pos1 in range(pos1, ob1.size):
-				result._insertcopy(
-						result.size, ob1.keys[pos1], ob1._getblk(pos1, &b1))
-		aligned_free(result.data[result.size].buf.ptr)
-		result._resize(result.size)
-	if pos2 == ob2.size:
-		while pos1 < ob1.size:
-			result._insertcopy(
-					result.size, ob1.keys[pos1], ob1._getblk(pos1, &b1))
-			pos1 += 1
+	if ob1.size + ob2.size > NOGILBLOCKS:
+		ob1._exports += 1  # operands cannot be modified meanwhile
+		ob2._exports += 1
+		with nogil:
+			result.size = rb_subblocks(ob1, ob2, result.keys, result.data)
+		ob1._exports -= 1
+		ob2._exports -= 1
+	else:
+		result.size = rb_subblocks(ob1, ob2, result.keys, result.data)
+	result._resize(result.size)
 	return result
 
 
-cdef inline RoaringBitmap rb_or(RoaringBitmap ob1, RoaringBitmap ob2):
-	cdef RoaringBitmap result = RoaringBitmap()
-	cdef uint32_t pos1 = 0, pos2 = 0
+cdef uint32_t rb_subblocks(RoaringBitmap ob1, RoaringBitmap ob2,
+		uint16_t *keys, Block *data) noexcept nogil:
+	"""Block loop of rb_sub(); cf. rb_andblocks()."""
+	cdef uint32_t pos1 = 0, pos2 = 0, res = 0
 	cdef Block b1, b2
 	if pos1 < ob1.size and pos2 < ob2.size:
-		result._initarray(ob1.size + ob2.size)
 		while True:
 			if ob1.keys[pos1] < ob2.keys[pos2]:
-				result._insertcopy(
-						result.size, ob1.keys[pos1], ob1._getblk(pos1, &b1))
+				keys[res] = ob1.keys[pos1]
+				block_copy(&(data[res]), ob1._getblk(pos1, &b1))
+				res += 1
 				pos1 += 1
 				if pos1 == ob1.size:
 					break
 			elif ob1.keys[pos1] > ob2.keys[pos2]:
-				result._insertcopy(
-						result.size, ob2.keys[pos2], ob2._getblk(pos2, &b2))
 				pos2 += 1
 				if pos2 == ob2.size:
 					break
 			else:  # ob1.keys[pos1] == ob2.keys[pos2]:
-				block_or(&(result.data[result.size]),
+				block_sub(&(data[res]),
 						ob1._getblk(pos1, &b1), ob2._getblk(pos2, &b2))
-				result.keys[result.size] = ob1.keys[pos1]
-				result.size += 1
+				if data[res].cardinality > 0:
+					keys[res] = ob1.keys[pos1]
+					res += 1
 				pos1 += 1
 				pos2 += 1
 				if pos1 == ob1.size or pos2 == ob2.size:
 					break
-	if pos1 == ob1.size:
-		result._extendarray(ob2.size - pos2)
-		for pos2 in range(pos2, ob2.size):
-			result._insertcopy(result.size,
-					ob2.keys[pos2], ob2._getblk(pos2, &b2))
-	elif pos2 == ob2.size:
-		result._extendarray(ob1.size - pos1)
+		aligned_free(data[res].buf.ptr)
+		data[res].buf.ptr = NULL
+	if pos2 == ob2.size:
 		for pos1 in range(pos1, ob1.size):
-			result._insertcopy(
-					result.size, ob1.keys[pos1], ob1._getblk(pos1, &b1))
+			keys[res] = ob1.keys[pos1]
+			block_copy(&(data[res]), ob1._getblk(pos1, &b1))
+			res += 1
+	return res
+
+
+cdef inline RoaringBitmap rb_or(RoaringBitmap ob1, RoaringBitmap ob2):
+	cdef RoaringBitmap result = RoaringBitmap()
+	result._initarray(ob1.size + ob2.size)
+	if ob1.size + ob2.size > NOGILBLOCKS:
+		ob1._exports += 1  # operands cannot be modified meanwhile
+		ob2._exports += 1
+		with nogil:
+			result.size = rb_orblocks(
+					ob1, ob2, result.keys, result.data, False)
+		ob1._exports -= 1
+		ob2._exports -= 1
+	else:
+		result.size = rb_orblocks(ob1, ob2, result.keys, result.data, False)
 	result._resize(result.size)
 	return result
 
 
 cdef inline RoaringBitmap rb_xor(RoaringBitmap ob1, RoaringBitmap ob2):
 	cdef RoaringBitmap result = RoaringBitmap()
-	cdef uint32_t pos1 = 0, pos2 = 0
+	result._initarray(ob1.size + ob2.size)
+	if ob1.size + ob2.size > NOGILBLOCKS:
+		ob1._exports += 1  # operands cannot be modified meanwhile
+		ob2._exports += 1
+		with nogil:
+			result.size = rb_orblocks(
+					ob1, ob2, result.keys, result.data, True)
+		ob1._exports -= 1
+		ob2._exports -= 1
+	else:
+		result.size = rb_orblocks(ob1, ob2, result.keys, result.data, True)
+	result._resize(result.size)
+	return result
+
+
+cdef uint32_t rb_orblocks(RoaringBitmap ob1, RoaringBitmap ob2,
+		uint16_t *keys, Block *data, bint xor) noexcept nogil:
+	"""Block loop of rb_or() and (if xor is True) rb_xor();
+	cf. rb_andblocks()."""
+	cdef uint32_t pos1 = 0, pos2 = 0, res = 0
 	cdef Block b1, b2
 	if pos1 < ob1.size and pos2 < ob2.size:
-		result._initarray(ob1.size + ob2.size)
 		while True:
 			if ob1.keys[pos1] < ob2.keys[pos2]:
-				result._insertcopy(
-						result.size, ob1.keys[pos1], ob1._getblk(pos1, &b1))
+				keys[res] = ob1.keys[pos1]
+				block_copy(&(data[res]), ob1._getblk(pos1, &b1))
+				res += 1
 				pos1 += 1
 				if pos1 == ob1.size:
 					break
 			elif ob1.keys[pos1] > ob2.keys[pos2]:
-				result._insertcopy(
-						result.size, ob2.keys[pos2], ob2._getblk(pos2, &b2))
+				keys[res] = ob2.keys[pos2]
+				block_copy(&(data[res]), ob2._getblk(pos2, &b2))
+				res += 1
 				pos2 += 1
 				if pos2 == ob2.size:
 					break
 			else:  # ob1.keys[pos1] == ob2.keys[pos2]:
-				block_xor(&(result.data[result.size]),
-						ob1._getblk(pos1, &b1), ob2._getblk(pos2, &b2))
-				if result.data[result.size].cardinality > 0:
-					result.keys[result.size] = ob1.keys[pos1]
-					result.size += 1
+				if xor:
+					block_xor(&(data[res]),
+							ob1._getblk(pos1, &b1), ob2._getblk(pos2, &b2))
+				else:
+					block_or(&(data[res]),
+							ob1._getblk(pos1, &b1), ob2._getblk(pos2, &b2))
+				if data[res].cardinality > 0:
+					keys[res] = ob1.keys[pos1]
+					res += 1
 				pos1 += 1
 				pos2 += 1
 				if pos1 == ob1.size or pos2 == ob2.size:
 					break
-		aligned_free(result.data[result.size].buf.ptr)
+		aligned_free(data[res].buf.ptr)
+		data[res].buf.ptr = NULL
 	if pos1 == ob1.size:
-		result._extendarray(ob2.size - pos2)
 		for pos2 in range(pos2, ob2.size):
-			result._insertcopy(
-					result.size, ob2.keys[pos2], ob2._getblk(pos2, &b2))
+			keys[res] = ob2.keys[pos2]
+			block_copy(&(data[res]), ob2._getblk(pos2, &b2))
+			res += 1
 	elif pos2 == ob2.size:
-		result._extendarray(ob1.size - pos1)
 		for pos1 in range(pos1, ob1.size):
-			result._insertcopy(
-					result.size, ob1.keys[pos1], ob1._getblk(pos1, &b1))
-	result._resize(result.size)
-	return result
+			keys[res] = ob1.keys[pos1]
+			block_copy(&(data[res]), ob1._getblk(pos1, &b1))
+			res += 1
+	return res
 
 
-cdef bint rb_isdisjoint(RoaringBitmap self, RoaringBitmap ob):
+cdef bint rb_isdisjoint(RoaringBitmap self,
+		RoaringBitmap ob) noexcept nogil:
 	cdef Block b1, b2
 	cdef size_t n
 	cdef int i = 0
@@ -390,7 +422,8 @@ cdef bint rb_isdisjoint(RoaringBitmap self, RoaringBitmap ob):
 	return True
 
 
-cdef inline bint rb_issubset(RoaringBitmap self, RoaringBitmap ob):
+cdef inline bint rb_issubset(RoaringBitmap self,
+		RoaringBitmap ob) noexcept nogil:
 	cdef Block b1, b2
 	cdef size_t n
 	cdef int i = 0
@@ -422,13 +455,15 @@ cdef inline RoaringBitmap rb_clamp(RoaringBitmap self,
 		jj = self._getindex(highbits(stop))
 		# when block was not found, round down to preceding block
 		j = -jj - 2 if jj < 0 else jj
-	if i >= <int32_t>self.size or j < 0:
+	elif ii < 0:  # start and stop fall in the same, non-existent block
+		return result
+	if i >= <int32_t>self.size or j < 0 or i > j:
 		return result
 	result._initarray(j - i + 1)
 	block_clamp(
 			&(result.data[0]), self._getblk(i, &b1),
 			lowbits(start) if i == ii else 0,
-			lowbits(stop) if ii == jj and ii >= 0 else BLOCKSIZE)
+			lowbits(stop) if i == j and jj >= 0 else BLOCKSIZE)
 	if result.data[result.size].cardinality:
 		result.keys[result.size] = self.keys[i]
 		result.size += 1
@@ -451,6 +486,266 @@ cdef inline RoaringBitmap rb_clamp(RoaringBitmap self,
 	return result
 
 
+cdef RoaringBitmap rb_andlimit(list bitmaps, size_t offset, size_t limit):
+	"""Return the elements of the intersection of the given bitmaps with
+	ranks ``offset`` up to ``offset + limit``.
+
+	Matching keys are found in ascending order with galloping search, and
+	blocks are intersected until enough elements have been produced; the
+	rest of the intersection is not computed."""
+	cdef RoaringBitmap ob, result = RoaringBitmap()
+	cdef Block scratch, tmp
+	cdef Block *block
+	cdef int *pos
+	cdef int i = 0, j, matched = 1, numbitmaps = len(bitmaps)
+	cdef uint32_t card, first, last
+	cdef uint16_t key
+	if numbitmaps == 0 or limit == 0:
+		return result
+	for ob in bitmaps:
+		if ob.size == 0:
+			return result
+	pos = <int *>calloc(numbitmaps, sizeof(int))
+	if pos is NULL:
+		raise MemoryError(numbitmaps)
+	memset(&scratch, 0, sizeof(Block))
+	key = (<RoaringBitmap>bitmaps[0]).keys[0]
+	try:
+		while limit:
+			if matched == numbitmaps:  # all bitmaps have a block with key
+				ob = bitmaps[0]
+				block_copy(&scratch, ob._getblk(pos[0], &tmp))
+				for j in range(1, numbitmaps):
+					ob = bitmaps[j]
+					if scratch.cardinality:
+						block_iand(&scratch, ob._getblk(pos[j], &tmp))
+				card = scratch.cardinality
+				if card <= offset:
+					offset -= card
+				else:
+					result._extendarray(1)
+					block = &(result.data[result.size])
+					memset(block, 0, sizeof(Block))
+					result.keys[result.size] = key
+					result.size += 1
+					if offset == 0 and card <= limit:
+						block_copy(block, &scratch)
+					else:
+						first = block_select(&scratch, offset)
+						last = block_select(&scratch, offset + limit - 1
+								if card - offset > limit else card - 1)
+						block_clamp(block, &scratch, first, last + 1)
+					limit -= block.cardinality
+					offset = 0
+				# the next key of bitmap i is the new candidate
+				ob = bitmaps[i]
+				pos[i] += 1
+				if pos[i] >= <int>ob.size:
+					break
+				key = ob.keys[pos[i]]
+				matched = 1
+				continue
+			# leapfrog: advance the next bitmap to the candidate key;
+			# if it does not have that key, its next key is the new candidate.
+			i = (i + 1) % numbitmaps
+			ob = bitmaps[i]
+			if ob.keys[pos[i]] < key:
+				pos[i] = advance(ob.keys, pos[i], ob.size, key)
+				if pos[i] >= <int>ob.size:
+					break
+			if ob.keys[pos[i]] == key:
+				matched += 1
+			else:
+				key = ob.keys[pos[i]]
+				matched = 1
+	finally:
+		free(pos)
+		aligned_free(scratch.buf.ptr)
+	return result
+
+
+cdef inline Block *rb_findblock(RoaringBitmap ob, uint16_t key, int *pos,
+		Block *tmp) noexcept nogil:
+	"""Return the block of ob with key, or NULL if there is none.
+
+	Skips ahead from ``pos[0]`` with galloping search and updates it; keys
+	should therefore be looked up in ascending order."""
+	if pos[0] < <int>ob.size and ob.keys[pos[0]] < key:
+		pos[0] = advance(ob.keys, pos[0], ob.size, key)
+	if pos[0] < <int>ob.size and ob.keys[pos[0]] == key:
+		return ob._getblk(pos[0], tmp)
+	return NULL
+
+
+cdef RoaringBitmap rb_iorand(RoaringBitmap ob1, RoaringBitmap ob2,
+		RoaringBitmap ob3, bint andnot):
+	"""In-place ``ob1 |= ob2 & ob3``, or if andnot is True,
+	``ob1 |= ob2 - ob3``, without creating the intermediate result."""
+	cdef uint32_t res = 0
+	cdef uint16_t *keys = NULL
+	cdef Block *data = NULL
+	cdef uint64_t *scratch
+	ob1._checkexports()
+	if ob2.size == 0 or (ob3.size == 0 and not andnot) or ob1 is ob2:
+		return ob1
+	elif ob1 is ob3:  # ob1 | (ob2 & ob1) == ob1; ob1 | (ob2 - ob1) == ob1 | ob2
+		return rb_ior(ob1, ob2) if andnot else ob1
+	ob1.capacity = ob1.size + ob2.size
+	ob1._tmpalloc(ob1.capacity, &keys, &data)
+	scratch = <uint64_t *>aligned_malloc(2 * BITMAPSIZE, 32)
+	if scratch is NULL:
+		free(keys)
+		free(data)
+		raise MemoryError
+	res = rb_iorandblocks(ob1, ob2, ob3, andnot, keys, data, scratch)
+	aligned_free(scratch)
+	ob1._replacearrays(keys, data, res)
+	return ob1
+
+
+cdef uint32_t rb_iorandblocks(RoaringBitmap ob1, RoaringBitmap ob2,
+		RoaringBitmap ob3, bint andnot, uint16_t *keys, Block *data,
+		uint64_t *scratch) noexcept nogil:
+	"""Block loop of rb_iorand(); cf. rb_iandblocks()."""
+	cdef uint32_t pos1 = 0, pos2, res = 0
+	cdef int pos3 = 0
+	cdef Block b2, b3, tmp
+	cdef Block *block
+	cdef Block *block2
+	cdef Block *block3
+	cdef uint16_t key
+	memset(&tmp, 0, sizeof(Block))
+	for pos2 in range(ob2.size):
+		key = ob2.keys[pos2]
+		block3 = rb_findblock(ob3, key, &pos3, &b3)
+		if block3 is NULL and not andnot:
+			continue
+		block2 = ob2._getblk(pos2, &b2)
+		while pos1 < ob1.size and ob1.keys[pos1] < key:
+			keys[res] = ob1.keys[pos1]
+			data[res] = ob1.data[pos1]
+			res += 1
+			pos1 += 1
+		if pos1 < ob1.size and ob1.keys[pos1] == key:
+			block = &(ob1.data[pos1])
+			if block3 is NULL:
+				block_ior(block, block2)
+			else:
+				block_iorand(block, block2, block3, andnot, &tmp, scratch)
+			keys[res] = key
+			data[res] = block[0]
+			res += 1
+			pos1 += 1
+		else:
+			block = &(data[res])
+			if block3 is NULL:
+				block_copy(block, block2)
+			elif andnot:
+				block_sub(block, block2, block3)
+			else:
+				block_and(block, block2, block3)
+			if block.cardinality:
+				keys[res] = key
+				res += 1
+			else:
+				aligned_free(block.buf.ptr)
+				block.buf.ptr = NULL
+	for pos1 in range(pos1, ob1.size):
+		keys[res] = ob1.keys[pos1]
+		data[res] = ob1.data[pos1]
+		res += 1
+	aligned_free(tmp.buf.ptr)
+	return res
+
+
+cdef RoaringBitmap rb_iandor(RoaringBitmap ob1, RoaringBitmap ob2,
+		RoaringBitmap ob3):
+	"""In-place ``ob1 &= ob2 | ob3``, without creating the intermediate
+	result."""
+	cdef uint32_t res = 0
+	cdef uint64_t *scratch
+	ob1._checkexports()
+	if ob1 is ob2 or ob1 is ob3:
+		return ob1
+	scratch = <uint64_t *>aligned_malloc(2 * BITMAPSIZE, 32)
+	if scratch is NULL:
+		raise MemoryError
+	res = rb_iandorblocks(ob1, ob2, ob3, scratch)
+	aligned_free(scratch)
+	ob1._resize(res)
+	return ob1
+
+
+cdef uint32_t rb_iandorblocks(RoaringBitmap ob1, RoaringBitmap ob2,
+		RoaringBitmap ob3, uint64_t *scratch) noexcept nogil:
+	"""Block loop of rb_iandor(); blocks of ob1 are updated and moved to
+	the front in place; return number of blocks in result."""
+	cdef uint32_t pos1, res = 0
+	cdef int pos2 = 0, pos3 = 0
+	cdef Block b2, b3
+	cdef Block *block
+	cdef Block *block2
+	cdef Block *block3
+	for pos1 in range(ob1.size):
+		block = &(ob1.data[pos1])
+		block2 = rb_findblock(ob2, ob1.keys[pos1], &pos2, &b2)
+		block3 = rb_findblock(ob3, ob1.keys[pos1], &pos3, &b3)
+		if block2 is NULL and block3 is NULL:
+			block.cardinality = 0
+		elif block3 is NULL:
+			block_iand(block, block2)
+		elif block2 is NULL:
+			block_iand(block, block3)
+		else:
+			block_iandor(block, block2, block3, scratch)
+		if block.cardinality:
+			ob1.keys[res] = ob1.keys[pos1]
+			ob1.data[res] = block[0]
+			res += 1
+		else:
+			aligned_free(block.buf.ptr)
+	return res
+
+
+cdef size_t rb_andandnotlen(RoaringBitmap ob1, RoaringBitmap ob2,
+		RoaringBitmap ob3):
+	"""Return ``len(ob1 & ob2 - ob3)``, without creating the
+	intermediate results."""
+	cdef Block b1, b2, b3
+	cdef Block *block3
+	cdef uint64_t *scratch
+	cdef int pos1 = 0, pos2 = 0, pos3 = 0
+	cdef size_t result = 0
+	scratch = <uint64_t *>aligned_malloc(3 * BITMAPSIZE, 32)
+	if scratch is NULL:
+		raise MemoryError
+	ob1._exports += 1  # operands cannot be modified meanwhile
+	ob2._exports += 1
+	ob3._exports += 1
+	with nogil:
+		while pos1 < <int>ob1.size and pos2 < <int>ob2.size:
+			if ob1.keys[pos1] < ob2.keys[pos2]:
+				pos1 = advance(ob1.keys, pos1, ob1.size, ob2.keys[pos2])
+			elif ob1.keys[pos1] > ob2.keys[pos2]:
+				pos2 = advance(ob2.keys, pos2, ob2.size, ob1.keys[pos1])
+			else:
+				block3 = rb_findblock(ob3, ob1.keys[pos1], &pos3, &b3)
+				if block3 is NULL:
+					result += block_andlen(
+							ob1._getblk(pos1, &b1), ob2._getblk(pos2, &b2))
+				else:
+					result += block_andandnotlen(
+							ob1._getblk(pos1, &b1), ob2._getblk(pos2, &b2),
+							block3, scratch)
+				pos1 += 1
+				pos2 += 1
+	ob1._exports -= 1
+	ob2._exports -= 1
+	ob3._exports -= 1
+	aligned_free(scratch)
+	return result
+
+
 cdef inline void rb_andor_len(RoaringBitmap ob1, RoaringBitmap ob2,
 		unsigned long *intersection_result,
 		unsigned long *union_result) noexcept nogil:
@@ -489,6 +784,60 @@ cdef inline void rb_andor_len(RoaringBitmap ob1, RoaringBitmap ob2,
 			union_result[0] += ob1.data[pos1].cardinality
 
 
+cdef inline size_t rb_andlen(RoaringBitmap ob1,
+		RoaringBitmap ob2) noexcept nogil:
+	cdef Block b1, b2
+	cdef uint32_t pos1 = 0, pos2 = 0
+	cdef size_t result = 0
+	if pos1 < ob1.size and pos2 < ob2.size:
+		while True:
+			if ob1.keys[pos1] < ob2.keys[pos2]:
+				pos1 += 1
+				if pos1 == ob1.size:
+					break
+			elif ob1.keys[pos1] > ob2.keys[pos2]:
+				pos2 += 1
+				if pos2 == ob2.size:
+					break
+			else:
+				result += block_andlen(
+						ob1._getblk(pos1, &b1),
+						ob2._getblk(pos2, &b2))
+				pos1 += 1
+				pos2 += 1
+				if pos1 == ob1.size or pos2 == ob2.size:
+					break
+	return result
+
+
+cdef size_t rb_andlen_gallop(RoaringBitmap ob1,
+		RoaringBitmap ob2) noexcept nogil:
+	"""Like ``rb_andlen``, but skip over non-matching keys with galloping
+	search; faster when the number of blocks differs a lot."""
+	cdef Block b1, b2
+	cdef int pos1 = 0, pos2 = 0
+	cdef size_t result = 0
+	while pos1 < <int>ob1.size and pos2 < <int>ob2.size:
+		if ob1.keys[pos1] < ob2.keys[pos2]:
+			pos1 = advance(ob1.keys, pos1, ob1.size, ob2.keys[pos2])
+		elif ob1.keys[pos1] > ob2.keys[pos2]:
+			pos2 = advance(ob2.keys, pos2, ob2.size, ob1.keys[pos1])
+		else:
+			result += block_andlen(
+					ob1._getblk(pos1, &b1),
+					ob2._getblk(pos2, &b2))
+			pos1 += 1
+			pos2 += 1
+	return result
+
+
+cdef inline size_t rb_len(RoaringBitmap ob) noexcept nogil:
+	cdef size_t result = 0, n
+	for n in range(ob.size):
+		result += ob.data[n].cardinality
+	return result
+
+
 cdef inline double rb_jaccard_dist(RoaringBitmap ob1,
 		RoaringBitmap ob2) noexcept nogil:
 	cdef unsigned long union_result = 0, intersection_result = 0
@@ -46,14 +46,23 @@ import os
 import sys
 import mmap
 import heapq
+import bisect
 import array
-
-from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t, int32_t
+import tempfile
+import threading
+import random
+import hashlib
+import collections
+
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t, int32_t, \
+		SIZE_MAX
 from libc.stdio cimport printf
-from libc.stdlib cimport free, malloc, calloc, realloc, abort
+from libc.stdlib cimport free, malloc, calloc, realloc, abort, qsort
+from libc.math cimport sqrt
 from libc.string cimport memset, memcpy, memcmp, memmove
 from cpython.buffer cimport PyBUF_SIMPLE, Py_buffer, PyObject_CheckBuffer, \
-		PyObject_GetBuffer, PyBuffer_Release
+		PyObject_GetBuffer, PyBuffer_Release, PyBUF_WRITABLE, PyBUF_FORMAT, \
+		PyBUF_ND, PyBUF_STRIDES
 from cpython cimport array
 cimport cython
 
@@ -74,6 +83,7 @@ cdef extern from "macros.h":
 	void CLEARBIT(uint64_t a[], int b) nogil
 	uint64_t TESTBIT(uint64_t a[], int b) nogil
 	uint64_t BITMASK(int b) nogil
+	char TOUCHBYTE(char *p) nogil
 	void *aligned_malloc(size_t size, size_t align) nogil
 	void aligned_free(void *ptr) nogil
 
@@ -127,36 +137,72 @@ DEF INITCAPACITY = 4
 # Extra elements in result to accomodate SSE/AVX vector operations
 DEF OVERALLOC = 8
 
+# Release the GIL in binary operations that create a new bitmap, when the
+# operands have more blocks; with fewer blocks, an operation may take less
+# than a few microseconds, which is comparable to reacquiring a contended GIL.
+# In-place operations keep the GIL, since they free and reallocate blocks of
+# a bitmap that other threads may be reading; while the GIL is released, the
+# operands cannot be modified (cf. RoaringBitmap._checkexports).
+DEF NOGILBLOCKS = 64
+
+# Build a key directory for bitmaps with at least this many blocks, once
+# this many lookups have been done with binary search:
+DEF DIRMINBLOCKS = 1024
+DEF DIRLOOKUPS = 256
+
 # The different ways a block may store its elements:
 DEF DENSE = 0
 DEF POSITIVE = 1
 DEF INVERTED = 2
 
+# Names of the block states, as reported by RoaringBitmap.iter_blocks()
+BLOCKSTATES = ('dense', 'positive', 'inverted')
+
 include "bitops.pxi"
 include "arrayops.pxi"
 include "block.pxi"
 include "rbbinaryops.pxi"
+include "queryops.pxi"
 include "immutablerb.pxi"
 include "multirb.pxi"
+include "builder.pxi"
+include "updatable.pxi"
+include "mergeiter.pxi"
+include "bsi.pxi"
+include "sharded.pxi"
 
 chararray = array.array(b'B' if PY2 else 'B')
 dblarray = array.array(b'd' if PY2 else 'd')
 longarray = array.array(b'L' if PY2 else 'L')
+uintarray = array.array(b'I' if PY2 else 'I')
+ulonglongarray = array.array(b'Q' if PY2 else 'Q')
 RANGE = xrange if PY2 else range
 EMPTYIRB = ImmutableRoaringBitmap()
 
 
 cdef class RoaringBitmap(object):
-	"""A compact, mutable set of 32-bit integers."""
+	"""A compact, mutable set of 32-bit integers.
+
+	Binary operations that return a new bitmap, such as ``a & b``, release
+	the GIL for large operands, so that threads can query shared bitmaps in
+	parallel. Meanwhile, attempts by other threads to modify the operands
+	raise a BufferError. In-place operations (``a &= b``, ``a.ior_and(b,
+	c)``, etc.) hold the GIL, and are atomic with respect to other threads.
+	"""
 	cdef Block *data  # pointer and size of array/bitmap with elements
 	cdef uint16_t *keys  # the high bits of elements in each block
 	cdef uint32_t size  # the number of blocks
 	cdef uint32_t capacity  # the allocated capacity for blocks
 	cdef size_t offset  # used for immutable bitmaps with relative pointers
+	cdef uint16_t *directory  # optional; key k => index of first key >= k
+	cdef uint32_t lookups  # binary searches since directory was cleared
+	cdef uint32_t _exports  # number of users of the data; cf. _checkexports
 
 	def __cinit__(self, *args, **kwargs):
 		self.keys = self.data = NULL
-		self.capacity = self.size = self.offset = 0
+		self.directory = NULL
+		self.capacity = self.size = self.offset = self.lookups = 0
+		self._exports = 0
 
 	def __init__(self, iterable=None):
 		"""Return a new RoaringBitmap with elements from ``iterable``.
@@ -189,6 +235,7 @@ cdef class RoaringBitmap(object):
 			self._inititerator(iterable)
 
 	def __dealloc__(self):
+		self._cleardirectory()
 		if self.data is not NULL and self.offset == 0:
 			for n in range(self.size):
 				aligned_free(self.data[n].buf.ptr)
@@ -282,7 +329,9 @@ cdef class RoaringBitmap(object):
 		This has no effect if the element is already present."""
 		cdef Block *block
 		cdef uint16_t key = highbits(elem)
-		cdef int i = self._getindex(key)
+		cdef int i
+		self._checkexports()
+		i = self._getindex(key)
 		if i >= 0:
 			block = &(self.data[i])
 		else:
@@ -303,18 +352,39 @@ cdef class RoaringBitmap(object):
 		"""Remove an element from the set if it is a member.
 
 		If the element is not a member, do nothing."""
-		cdef int i = self._getindex(highbits(elem))
+		cdef int i
+		self._checkexports()
+		i = self._getindex(highbits(elem))
 		if i >= 0:
 			block_discard(&(self.data[i]), lowbits(elem))
 			if self.data[i].cardinality == 0:
 				self._removeatidx(i)
 
+	def add_many(self, buf):
+		"""Add elements from a sequence of unsigned 32-bit integers.
+
+		:param buf: preferably an ``array.array('I')``, or another
+			contiguous buffer with 4-byte items, such as a numpy array of
+			type uint32.
+
+		Elements are sorted and grouped by block, so that each block is
+		updated once; much faster than calling ``add()`` for each element.
+		"""
+		rb_ior(self, rbfromuint32(buf))
+
+	def discard_many(self, buf):
+		"""Remove elements from a sequence of unsigned 32-bit integers,
+		if they are members; cf. ``add_many()``."""
+		rb_isub(self, rbfromuint32(buf))
+
 	def remove(self, uint32_t elem):
 		"""Remove an element from the set; it must be a member.
 
 		If the element is not a member, raise a KeyError."""
-		cdef int i = self._getindex(highbits(elem))
+		cdef int i
 		cdef uint32_t x
+		self._checkexports()
+		i = self._getindex(highbits(elem))
 		if i >= 0:
 			x = self.data[i].cardinality
 			block_discard(&(self.data[i]), lowbits(elem))
@@ -328,6 +398,7 @@ cdef class RoaringBitmap(object):
 	def pop(self):
 		"""Remove and return the largest element."""
 		cdef uint32_t high, low
+		self._checkexports()
 		if self.size == 0:
 			raise ValueError('pop from empty roaringbitmap')
 		high = self.keys[self.size - 1]
@@ -339,10 +410,12 @@ cdef class RoaringBitmap(object):
 	def clear(self):
 		"""Remove all elements from this RoaringBitmap."""
 		cdef size_t n
+		self._checkexports()
 		for n in range(self.size):
 			aligned_free(self.data[n].buf.ptr)
 		free(self.keys)
 		free(self.data)
+		self._cleardirectory()
 		self.size = 0
 		self.keys = <uint16_t *>malloc(INITCAPACITY * sizeof(uint16_t))
 		self.data = <Block *>malloc(INITCAPACITY * sizeof(Block))
@@ -401,9 +474,9 @@ cdef class RoaringBitmap(object):
 								block.buf.sparse[n] + 1,
 								block.buf.sparse[n + 1]):
 							yield high | low
-					for low in range(block.buf.sparse[
-							BLOCKSIZE - block.cardinality - 1] + 1, BLOCKSIZE):
-						yield high | low
+				for low in range(block.buf.sparse[
+						BLOCKSIZE - block.cardinality - 1] + 1, BLOCKSIZE):
+					yield high | low
 
 	def __reversed__(self):
 		cdef Block *block
@@ -443,10 +516,7 @@ cdef class RoaringBitmap(object):
 					yield high | low
 
 	def __len__(self):
-		cdef size_t result = 0, n
-		for n in range(self.size):
-			result += self.data[n].cardinality
-		return result
+		return rb_len(self)
 
 	def __sizeof__(self):
 		"""Return memory usage in bytes (incl. overallocation)."""
@@ -454,6 +524,8 @@ cdef class RoaringBitmap(object):
 		for n in range(self.size):
 			result += (sizeof(uint16_t) + sizeof(Block)
 					+ self.data[n].capacity * sizeof(uint16_t))
+		if self.directory is not NULL:
+			result += BLOCKSIZE * sizeof(uint16_t)
 		return result
 
 	def numelem(self):
@@ -472,6 +544,303 @@ cdef class RoaringBitmap(object):
 	def __repr__(self):
 		return 'RoaringBitmap(%s)' % str(self)
 
+	def iter_blocks(self):
+		"""Iterate over the blocks of this set, without copying their data.
+
+		:yields: tuples ``(key, state, view)`` where ``key`` is the value of
+			the upper 16 bits of the elements in the block, and ``view`` is a
+			memoryview of its data, depending on ``state``:
+
+			- ``'dense'``: a bitmap of 1024 unsigned 64-bit integers, where
+			  bit ``n`` (``view[n >> 6] >> (n & 63) & 1``) is set if
+			  ``key << 16 | n`` is an element;
+			- ``'positive'``: a sorted array of unsigned 16-bit integers with
+			  the lower 16 bits of the elements;
+			- ``'inverted'``: a sorted array of unsigned 16-bit integers with
+			  the lower 16 bits that are *not* elements.
+
+		The views are read-only. Until the iterator is exhausted or deleted,
+		and as long as any of the views exist, this set cannot be modified;
+		attempts raise a BufferError.
+
+		>>> for key, state, view in RoaringBitmap({1, 2, 65537}).iter_blocks():
+		...     print(key, state, view.tolist())
+		0 positive [1, 2]
+		1 positive [1]
+		"""
+		cdef Block *block
+		cdef Block b1
+		cdef uint32_t i
+		self._exports += 1
+		try:
+			for i in range(self.size):
+				block = self._getblk(i, &b1)
+				buf = blockbuffer(self, block, True)
+				yield self.keys[i], BLOCKSTATES[block.state], memoryview(buf)
+		finally:
+			self._exports -= 1
+
+	@classmethod
+	def from_bitset(cls, buf, size_t offset=0):
+		"""Create a bitmap from a packed bitset, where bit ``i`` (i.e., bit
+		``i & 7`` of byte ``i >> 3``, little-endian) is set if ``i`` is an
+		element.
+
+		:param buf: an object supporting the buffer protocol, e.g., bytes,
+			bytearray, or a numpy array of type uint8 or uint64.
+		:param offset: the byte offset of the bitset in ``buf``.
+
+		>>> RoaringBitmap.from_bitset(b'\\x05\\x80')
+		RoaringBitmap({0, 2, 15})
+
+		Each range of ``2 ** 16`` bits is copied as a whole into a bitmap
+		block, which is converted to an array if it has few (or few unset)
+		bits; the GIL is released."""
+		cdef RoaringBitmap result = RoaringBitmap()
+		cdef Block *block
+		cdef uint64_t *scratch = NULL
+		cdef Py_buffer buffer
+		cdef Py_ssize_t size = 0
+		cdef char *ptr = NULL
+		cdef size_t nbytes, numblocks, chunk, key
+		cdef uint32_t card
+		if getbufptr(buf, &ptr, &size, &buffer) != 0:
+			raise ValueError('could not get buffer from buf.')
+		try:
+			if offset > <size_t>size:
+				raise ValueError('offset %d beyond end of buffer.' % offset)
+			nbytes = size - offset
+			numblocks = (nbytes + BITMAPSIZE - 1) // BITMAPSIZE
+			if numblocks > BLOCKSIZE:
+				raise ValueError('bitset has more than 2 ** 32 bits.')
+			result._extendarray(numblocks)
+			with nogil:
+				for key in range(numblocks):
+					chunk = nbytes - key * BITMAPSIZE
+					if chunk > BITMAPSIZE:
+						chunk = BITMAPSIZE
+					if scratch is NULL:
+						scratch = allocdense()
+					memcpy(scratch, &(ptr[offset + key * BITMAPSIZE]), chunk)
+					memset(&((<char *>scratch)[chunk]), 0, BITMAPSIZE - chunk)
+					card = bitsetcount(scratch)
+					if card == 0:
+						continue
+					# use scratch as the bitmap of a new dense block
+					result.keys[result.size] = key
+					block = &(result.data[result.size])
+					result.size += 1
+					block.buf.dense = scratch
+					block.state = DENSE
+					block.cardinality = card
+					block.capacity = BITMAPSIZE // sizeof(uint16_t)
+					scratch = NULL
+					block_convert(block)
+		finally:
+			aligned_free(scratch)
+			releasebuf(&buffer)
+		if cls is RoaringBitmap:
+			return result
+		return cls(result)
+
+	def to_bitset(self, uint32_t start=0, stop=None, out=None):
+		"""Store elements ``start <= n < stop`` as a packed bitset, where
+		bit ``n - start`` is set if ``n`` is an element;
+		cf. ``from_bitset()``.
+
+		:param start: the element for the first bit; should be a
+			multiple of 8.
+		:param stop: by default, ``max(self) + 1``.
+		:param out: optionally, a preallocated, writable buffer of at
+			least ``ceil((stop - start) / 8)`` bytes; bytes beyond that
+			are not modified.
+		:returns: ``out``, or a new bytearray with the bitset.
+
+		>>> RoaringBitmap({0, 2, 15}).to_bitset()
+		bytearray(b'\\x05\\x80')
+
+		Bitmap blocks are copied with ``memcpy``."""
+		cdef Block *block
+		cdef Block b1
+		cdef uint64_t *scratch
+		cdef Py_buffer buffer
+		cdef unsigned char *ptr
+		cdef uint64_t lo, hi, blockstart, stop1, elem
+		cdef size_t nbytes
+		cdef uint32_t n
+		cdef int i
+		if start % 8:
+			raise ValueError('start should be a multiple of 8.')
+		if stop is None:
+			stop1 = (<uint64_t>self.max() + 1) if self.size else start
+		else:
+			stop1 = stop
+		if stop1 < start:
+			stop1 = start
+		nbytes = (stop1 - start + 7) // 8
+		if out is None:
+			out = bytearray(nbytes)
+		if PyObject_GetBuffer(out, &buffer, PyBUF_SIMPLE | PyBUF_WRITABLE):
+			raise ValueError('out should be a writable buffer.')
+		try:
+			if <size_t>buffer.len < nbytes:
+				raise ValueError('out should have at least %d bytes.'
+						% nbytes)
+			ptr = <unsigned char *>buffer.buf
+			scratch = allocdense()
+			i = self._getindex(highbits(start))
+			if i < 0:
+				i = -i - 1
+			self._exports += 1  # cannot be modified while the GIL is released
+			with nogil:
+				memset(ptr, 0, nbytes)
+				while i < <int>self.size:
+					blockstart = (<uint64_t>self.keys[i]) << 16
+					if blockstart >= stop1:
+						break
+					lo = blockstart if blockstart > start else start
+					hi = blockstart + BLOCKSIZE
+					if hi > stop1:
+						hi = stop1
+					block = self._getblk(i, &b1)
+					if block.state == POSITIVE:
+						for n in range(block.cardinality):
+							elem = blockstart + block.buf.sparse[n]
+							if lo <= elem < hi:
+								elem -= start
+								ptr[elem >> 3] |= 1 << (elem & 7)
+					else:
+						memcpy(&(ptr[(lo - start) >> 3]),
+								&((<unsigned char *>block_denseview(
+									block, scratch))[(lo - blockstart) >> 3]),
+								(hi - lo + 7) >> 3)
+					i += 1
+				if (stop1 - start) & 7:  # clear bits beyond stop
+					ptr[nbytes - 1] &= (1 << ((stop1 - start) & 7)) - 1
+			self._exports -= 1
+			aligned_free(scratch)
+		finally:
+			PyBuffer_Release(&buffer)
+		return out
+
+	def iter_ranges(self):
+		"""Iterate over the runs of consecutive elements, as half-open
+		ranges ``(start, stop)`` in ascending order; cf. ``from_ranges()``.
+
+		>>> list(RoaringBitmap({1, 2, 3, 7, 8}).iter_ranges())
+		[(1, 4), (7, 9)]
+
+		The runs of each block are derived from its array, or from its
+		bitmap with one ``ctz`` per run boundary, without visiting each
+		element; runs that continue in the next block are merged."""
+		cdef array.array runs = array.clone(uintarray, BLOCKSIZE, False)
+		cdef uint32_t *starts = runs.data.as_uints
+		cdef uint32_t *stops = &(runs.data.as_uints[BLOCKSIZE // 2])
+		cdef Block *block
+		cdef Block b1
+		cdef uint64_t high, start = 0, stop = 0
+		cdef uint32_t i, n, numruns
+		for i in range(self.size):
+			block = self._getblk(i, &b1)
+			high = (<uint64_t>self.keys[i]) << 16
+			numruns = block_runs(block, starts, stops)
+			for n in range(numruns):
+				# NB: also covers a first run starting at 0
+				if high + starts[n] == stop:
+					stop = high + stops[n]
+					continue
+				if stop:
+					yield start, stop
+				start, stop = high + starts[n], high + stops[n]
+		if stop:
+			yield start, stop
+
+	@classmethod
+	def from_ranges(cls, starts, stops):
+		"""Create a bitmap with the elements of the half-open ranges
+		``[starts[n], stops[n])``; cf. ``iter_ranges()``.
+
+		:param starts: a sequence of unsigned 32-bit integers in ascending
+			order; preferably an ``array.array('I')``, or another
+			contiguous buffer with 4-byte items, such as a numpy array of
+			type uint32.
+		:param stops: a sequence of unsigned 32-bit integers of the same
+			length as ``starts``. Ranges may be empty, overlap or be
+			adjacent. NB: the element ``2 ** 32 - 1`` cannot be included.
+
+		>>> RoaringBitmap.from_ranges([1, 7], [4, 9])
+		RoaringBitmap({1, 2, 3, 7, 8})
+
+		The runs falling in each block are collected, after which the block
+		is initialized at once; bitmap blocks are filled a word at a time.
+		"""
+		cdef RoaringBitmap result = RoaringBitmap()
+		cdef array.array runs = array.clone(uintarray, BLOCKSIZE, False)
+		cdef uint32_t *blockstarts = runs.data.as_uints
+		cdef uint32_t *blockstops = &(runs.data.as_uints[BLOCKSIZE // 2])
+		cdef Block *block
+		cdef Py_buffer buffer1, buffer2
+		cdef char *ptr1 = NULL
+		cdef char *ptr2 = NULL
+		cdef Py_ssize_t size1 = 0, size2 = 0
+		cdef uint32_t *startptr
+		cdef uint32_t *stopptr
+		cdef uint64_t start, stop, blockstop
+		cdef size_t n, length
+		cdef uint32_t numruns = 0, card = 0, key = 0
+		starts, stops = asuint32(starts), asuint32(stops)
+		if len(starts) != len(stops):
+			raise ValueError('starts and stops should have same length.')
+		length = len(starts)
+		if length == 0:
+			return cls()
+		if getbufptr(starts, &ptr1, &size1, &buffer1) != 0:
+			raise ValueError('could not get buffer from starts.')
+		if getbufptr(stops, &ptr2, &size2, &buffer2) != 0:
+			releasebuf(&buffer1)
+			raise ValueError('could not get buffer from stops.')
+		startptr, stopptr = <uint32_t *>ptr1, <uint32_t *>ptr2
+		try:
+			for n in range(1, length):
+				if startptr[n] < startptr[n - 1]:
+					raise ValueError('starts should be in ascending order.')
+			n = 0
+			while n < length:
+				start, stop = startptr[n], stopptr[n]
+				n += 1
+				if start >= stop:
+					continue
+				# merge with overlapping and adjacent ranges
+				while n < length and startptr[n] <= stop:
+					if stopptr[n] > stop:
+						stop = stopptr[n]
+					n += 1
+				# split run at block boundaries
+				while start < stop:
+					if numruns and highbits(start) != key:
+						block = result._insertempty(result.size, key)
+						block_initranges(
+								block, blockstarts, blockstops, numruns, card)
+						numruns = card = 0
+					key = highbits(start)
+					blockstop = (<uint64_t>key + 1) << 16
+					if blockstop > stop:
+						blockstop = stop
+					blockstarts[numruns] = lowbits(start)
+					blockstops[numruns] = blockstop - (<uint64_t>key << 16)
+					card += blockstops[numruns] - blockstarts[numruns]
+					numruns += 1
+					start = blockstop
+			if numruns:
+				block = result._insertempty(result.size, key)
+				block_initranges(block, blockstarts, blockstops, numruns, card)
+		finally:
+			releasebuf(&buffer1)
+			releasebuf(&buffer2)
+		if cls is RoaringBitmap:
+			return result
+		return cls(result)
+
 	def debuginfo(self, verbose=False):
 		"""Return a string describing the internal representation of this set.
 		"""
@@ -485,33 +854,35 @@ cdef class RoaringBitmap(object):
 		return [self.keys[n] for n in range(self.size)]
 
 	def __getstate__(self):
-		"""Return a serialized representation (Python array) for pickling."""
+		"""Return a serialized representation (Python array) for pickling.
+
+		The buffers of dense blocks are 32-byte aligned; the arrays of other
+		blocks are packed without padding, so that a bitmap with few elements
+		takes little space. The total size is a multiple of 8 bytes."""
 		cdef array.array state
 		cdef Block *ob
-		cdef uint32_t extra, alignment = 32
 		cdef size_t n, size
 		cdef size_t alloc  # total allocated bytes for pickle
 		cdef size_t offset1 = sizeof(uint32_t)  # keys, data
 		cdef size_t offset2  # buffers
 		# compute total size to allocate
-		# add padding to ensure bitmaps are 32-byte aligned
 		alloc = offset1 + self.size * (sizeof(uint16_t) + sizeof(Block))
-		alloc += alignment - alloc % alignment
 		for n in range(self.size):
+			if self.data[n].state == DENSE:
+				alloc = bufalign(alloc, 32)
 			alloc += getsize(&(self.data[n])) * sizeof(uint16_t)
-			alloc += alignment - alloc % alignment
-		state = array.clone(chararray, alloc, False)
+		alloc = bufalign(alloc, 8)
+		# zero padding bytes
+		state = array.clone(chararray, alloc, True)
 		(<uint32_t *>state.data.as_chars)[0] = self.size
 		size = self.size * sizeof(uint16_t)
 		memcpy(&(state.data.as_chars[offset1]), self.keys, size)
 		offset1 += size
 		offset2 = offset1 + self.size * sizeof(Block)
-		# add zero padding bytes
-		extra = alignment - offset2 % alignment
-		memset(&(state.data.as_chars[offset2]), 0, extra)
-		offset2 += extra
 		for n in range(self.size):
 			# copy block
+			if self.data[n].state == DENSE:
+				offset2 = bufalign(offset2, 32)
 			ob = (<Block *>&(state.data.as_chars[offset1]))
 			ob[0] = self.data[n]
 			ob.capacity = getsize(&(self.data[n]))
@@ -521,10 +892,6 @@ cdef class RoaringBitmap(object):
 			size = ob.capacity * sizeof(uint16_t)
 			memcpy(&(state.data.as_chars[offset2]), self.data[n].buf.ptr, size)
 			offset2 += size
-			# add zero padding bytes
-			extra = alignment - offset2 % alignment
-			memset(&(state.data.as_chars[offset2]), 0, extra)
-			offset2 += extra
 		return state
 
 	def __setstate__(self, array.array state):
@@ -557,11 +924,149 @@ cdef class RoaringBitmap(object):
 				size = data[n].capacity * sizeof(uint16_t)
 			memcpy(self.data[n].buf.ptr, &(buf[offset]), size)
 
-	def intersection(self, *other):
+	def write_to(self, fileobj):
+		"""Write this set to a binary file object, in the format of
+		``__getstate__()``, without serializing it in memory first.
+
+		:param fileobj: an object with a ``write()`` method that accepts
+			buffers and writes all data, e.g., a file opened with ``'wb'``
+			or ``socket.makefile('wb')``.
+		:returns: the number of bytes written.
+
+		The header with the keys and block descriptors is written first,
+		followed by the array or bitmap of each block, directly from the
+		memory of the block. Meanwhile, and as long as ``fileobj`` keeps any
+		of these buffers, this set cannot be modified."""
+		cdef array.array header
+		cdef Block *block
+		cdef Block *ob
+		cdef Block b1
+		cdef size_t n, size
+		cdef size_t offset1 = sizeof(uint32_t)  # keys, data
+		cdef size_t offset2  # buffers
+		self._exports += 1  # cannot be modified by fileobj.write()
+		try:
+			offset2 = offset1 + self.size * (sizeof(uint16_t) + sizeof(Block))
+			header = array.clone(chararray, offset2, False)
+			(<uint32_t *>header.data.as_chars)[0] = self.size
+			size = self.size * sizeof(uint16_t)
+			memcpy(&(header.data.as_chars[offset1]), self.keys, size)
+			offset1 += size
+			for n in range(self.size):
+				block = self._getblk(n, &b1)
+				if block.state == DENSE:
+					offset2 = bufalign(offset2, 32)
+				ob = (<Block *>&(header.data.as_chars[offset1]))
+				ob[0] = block[0]
+				ob.capacity = getsize(block)
+				ob.buf.ptr = <void *>offset2
+				offset1 += sizeof(Block)
+				offset2 += ob.capacity * sizeof(uint16_t)
+			fileobj.write(header)
+			offset1 = len(header)
+			for n in range(self.size):
+				block = self._getblk(n, &b1)
+				offset2 = offset1
+				if block.state == DENSE:
+					offset2 = bufalign(offset1, 32)
+					fileobj.write(b'\0' * (offset2 - offset1))
+				size = getsize(block) * sizeof(uint16_t)
+				if size:
+					fileobj.write(blockbuffer(self, block, True))
+				offset1 = offset2 + size
+			offset2 = bufalign(offset1, 8)
+			fileobj.write(b'\0' * (offset2 - offset1))
+			return offset2
+		finally:
+			self._exports -= 1
+
+	@classmethod
+	def read_from(cls, fileobj):
+		"""Read a set from a binary file object, as written by
+		``write_to()``; cf. ``__getstate__()``.
+
+		:param fileobj: an object with ``read()`` and ``readinto()``
+			methods, e.g., a file opened with ``'rb'`` or
+			``socket.makefile('rb')``. Exactly the bytes of one set are
+			consumed, so that several sets can be read from one stream.
+
+		The header is read first, after which the array or bitmap of each
+		block is read with ``readinto()`` into newly allocated memory of
+		the block, without intermediate copies."""
+		cdef RoaringBitmap result = RoaringBitmap()
+		cdef Block *block
+		cdef size_t n, m, size, offset1, offset2
+		cdef uint32_t numblocks
+		data = readbytes(fileobj, sizeof(uint32_t))
+		numblocks = (<uint32_t *><char *>data)[0]
+		if numblocks > BLOCKSIZE:
+			raise ValueError('invalid number of blocks: %d' % numblocks)
+		size = numblocks * (sizeof(uint16_t) + sizeof(Block))
+		data = readbytes(fileobj, size)
+		result._extendarray(numblocks)
+		memcpy(result.keys, <char *>data, numblocks * sizeof(uint16_t))
+		memcpy(result.data, &((<char *>data)[numblocks * sizeof(uint16_t)]),
+				numblocks * sizeof(Block))
+		for n in range(1, numblocks):
+			if result.keys[n - 1] >= result.keys[n]:
+				raise ValueError('keys not in ascending order')
+		offset1 = sizeof(uint32_t) + size
+		# NB: size is increased as blocks are allocated, for __dealloc__
+		for n in range(numblocks):
+			block = &(result.data[n])
+			offset2 = block.buf.offset
+			# reject states that other operations consider impossible
+			if (offset2 < offset1 or offset2 - offset1 >= 32  # padding
+					or block.cardinality == 0 or block.cardinality > BLOCKSIZE
+					or block.state not in (DENSE, POSITIVE, INVERTED)
+					or (block.state == POSITIVE and block.cardinality
+						> BLOCKSIZE - MAXARRAYLENGTH)
+					or (block.state == INVERTED
+						and block.cardinality < MAXARRAYLENGTH)
+					or block.capacity != getsize(block)):
+				raise ValueError('invalid block %d' % n)
+			readbytes(fileobj, offset2 - offset1)  # padding
+			size = getsize(block) * sizeof(uint16_t)
+			if block.state == DENSE:
+				block.buf.dense = allocdense()
+			else:
+				block.buf.sparse = allocsparse(block.capacity)
+			result.size += 1
+			if size:
+				readfully(fileobj, blockbuffer(result, block, False))
+			if block.state == DENSE:
+				if bitsetcount(block.buf.dense) != block.cardinality:
+					raise ValueError('invalid block %d' % n)
+			else:
+				for m in range(1, block.capacity):
+					if block.buf.sparse[m - 1] >= block.buf.sparse[m]:
+						raise ValueError('invalid block %d' % n)
+			offset1 = offset2 + size
+		readbytes(fileobj, bufalign(offset1, 8) - offset1)
+		if cls is RoaringBitmap:
+			return result
+		return cls(result)
+
+	def intersection(self, *other, limit=None, offset=0):
 		"""Return the intersection of two or more sets as a new RoaringBitmap.
 
-		(i.e. elements that are common to all of the sets.)"""
+		(i.e. elements that are common to all of the sets.)
+
+		:param limit, offset: if given, only return the elements of the
+			intersection with ranks ``offset`` up to ``offset + limit``,
+			e.g. for a page of results; blocks are intersected in order
+			and the rest of the intersection is not computed.
+
+		>>> RoaringBitmap(range(100)).intersection(
+		...		RoaringBitmap(range(0, 100, 3)), limit=3, offset=2)
+		RoaringBitmap({6, 9, 12})
+		"""
 		cdef RoaringBitmap result
+		if limit is not None or offset:
+			return rb_andlimit(
+					sorted([self] + [ensurerb(a) for a in other],
+						key=RoaringBitmap.numelem),
+					offset, SIZE_MAX if limit is None else limit)
 		if len(other) == 0:
 			return self
 		elif len(other) == 1:
@@ -684,34 +1189,37 @@ cdef class RoaringBitmap(object):
 		"""In-place negation for range(start, stop)."""
 		self.symmetric_difference_update(RANGE(start, stop))
 
+	def ior_and(self, a, b):
+		"""In-place union with the intersection of a and b.
+
+		Optimized version of ``self |= a & b``: the blocks of the
+		intersection are merged into this set as they are computed."""
+		rb_iorand(self, ensurerb(a), ensurerb(b), False)
+
+	def ior_andnot(self, a, b):
+		"""In-place union with the difference of a and b.
+
+		Optimized version of ``self |= a - b``."""
+		rb_iorand(self, ensurerb(a), ensurerb(b), True)
+
+	def iand_or(self, a, b):
+		"""In-place intersection with the union of a and b.
+
+		Optimized version of ``self &= a | b``."""
+		rb_iandor(self, ensurerb(a), ensurerb(b))
+
 	def intersection_len(self, other):
 		"""Return the cardinality of the intersection.
 
 		Optimized version of ``len(self & other)``."""
-		cdef RoaringBitmap ob1 = ensurerb(self)
-		cdef RoaringBitmap ob2 = ensurerb(other)
-		cdef Block b1, b2
-		cdef uint32_t pos1 = 0, pos2 = 0
-		cdef size_t result = 0
-		if pos1 < ob1.size and pos2 < ob2.size:
-			while True:
-				if ob1.keys[pos1] < ob2.keys[pos2]:
-					pos1 += 1
-					if pos1 == ob1.size:
-						break
-				elif ob1.keys[pos1] > ob2.keys[pos2]:
-					pos2 += 1
-					if pos2 == ob2.size:
-						break
-				else:
-					result += block_andlen(
-							ob1._getblk(pos1, &b1),
-							ob2._getblk(pos2, &b2))
-					pos1 += 1
-					pos2 += 1
-					if pos1 == ob1.size or pos2 == ob2.size:
-						break
-		return result
+		return rb_andlen(ensurerb(self), ensurerb(other))
+
+	def and_andnot_len(self, b, c):
+		"""Return the cardinality of the intersection with b, minus c.
+
+		Optimized version of ``len(self & b - c)``, which is equal to
+		``len(self & b) - len(self & b & c)``."""
+		return rb_andandnotlen(self, ensurerb(b), ensurerb(c))
 
 	def union_len(self, other):
 		"""Return the cardinality of the union.
@@ -796,6 +1304,164 @@ cdef class RoaringBitmap(object):
 		raise IndexError('select: index %d out of range 0..%d.' % (
 				i, len(self)))
 
+	def sample(self, size_t k, seed=None):
+		"""Return a uniform random sample of ``k`` elements of this set,
+		without replacement, as a new RoaringBitmap.
+
+		Random ranks are drawn and located with the cardinalities of the
+		blocks; the set is not iterated over.
+
+		:param seed: if given, seed for ``random.Random``.
+		:raises ValueError: if ``k`` is larger than the number of elements.
+		"""
+		cdef RoaringBitmap result = RoaringBitmap()
+		cdef array.array ranks, elems
+		cdef Block b1
+		cdef Block *block
+		cdef uint16_t *tmp = NULL
+		cdef uint32_t *r
+		cdef uint32_t *e
+		cdef uint32_t high
+		cdef size_t n, i = 0, j, m, card, blockstart = 0
+		cdef size_t total = rb_len(self)
+		if k > total:
+			raise ValueError('sample larger than population.')
+		ranks = array.array(uintarray.typecode,
+				sorted(random.Random(seed).sample(RANGE(total), k)))
+		elems = array.clone(uintarray, k, False)
+		r, e = ranks.data.as_uints, elems.data.as_uints
+		try:
+			for n in range(self.size):
+				if i == k:
+					break
+				card = self.data[n].cardinality
+				m = i
+				while m < k and r[m] < blockstart + card:
+					m += 1
+				if m > i:
+					block = self._getblk(n, &b1)
+					high = (<uint32_t>self.keys[n]) << 16
+					if block.state == DENSE and m - i > 1:
+						# one pass over the bitmap instead of a select
+						# for each element.
+						if tmp is NULL:
+							tmp = <uint16_t *>malloc(
+									BLOCKSIZE * sizeof(uint16_t))
+							if tmp is NULL:
+								raise MemoryError
+						block_toarray(block, tmp)
+						for j in range(i, m):
+							e[j] = high | tmp[r[j] - blockstart]
+					else:
+						for j in range(i, m):
+							e[j] = high | block_select(
+									block, r[j] - blockstart)
+					i = m
+				blockstart += card
+		finally:
+			free(tmp)
+		result._initsorted(e, k)
+		return result
+
+	def subsample(self, double fraction, uint32_t seed=0):
+		"""Return a new RoaringBitmap with a pseudo-random subset of about
+		``fraction`` of the elements of this set.
+
+		Whether an element is kept depends only on a hash of the element and
+		the seed; therefore, with the same seed, the same elements are kept
+		across bitmaps, and the subsample for a smaller fraction is a subset
+		of that for a larger fraction (e.g., for consistent bucketing).
+
+		:param fraction: a number between 0 and 1."""
+		cdef RoaringBitmap result = RoaringBitmap()
+		cdef Block b1
+		cdef uint16_t *tmp
+		cdef uint32_t *out
+		cdef uint32_t n, j, m, length, elem, high
+		cdef uint32_t seedhash = hash32(seed)
+		cdef uint64_t threshold
+		if not 0 <= fraction <= 1:
+			raise ValueError('fraction should be between 0 and 1.')
+		threshold = <uint64_t>(fraction * (1ULL << 32))
+		tmp = <uint16_t *>malloc(BLOCKSIZE * sizeof(uint16_t))
+		out = <uint32_t *>malloc(BLOCKSIZE * sizeof(uint32_t))
+		self._exports += 1  # cannot be modified while the GIL is released
+		try:
+			if tmp is NULL or out is NULL:
+				raise MemoryError
+			for n in range(self.size):
+				high = (<uint32_t>self.keys[n]) << 16
+				with nogil:
+					length = block_toarray(self._getblk(n, &b1), tmp)
+					m = 0
+					for j in range(length):
+						elem = high | tmp[j]
+						if hash32(elem ^ seedhash) < threshold:
+							out[m] = elem
+							m += 1
+				if m:
+					block_initsorted(
+							result._insertempty(result.size, self.keys[n]),
+							out, m)
+		finally:
+			self._exports -= 1
+			free(tmp)
+			free(out)
+		return result
+
+	def next_ge(self, uint32_t x):
+		"""Return the smallest element ``>= x`` in this set, or ``None``
+		if there is no such element."""
+		cdef Block b1
+		cdef int i = self._getindex(highbits(x)), low = -1
+		if i >= 0:
+			low = block_nextge(self._getblk(i, &b1), lowbits(x))
+			if low == -1:
+				i += 1
+		else:
+			i = -i - 1
+		if low == -1:
+			if i >= <int>self.size:
+				return None
+			low = block_nextge(self._getblk(i, &b1), 0)
+		return ((<uint32_t>self.keys[i]) << 16) | low
+
+	def prev_le(self, uint32_t x):
+		"""Return the largest element ``<= x`` in this set, or ``None``
+		if there is no such element."""
+		cdef Block b1
+		cdef int i = self._getindex(highbits(x)), low = -1
+		if i >= 0:
+			low = block_prevle(self._getblk(i, &b1), lowbits(x))
+			if low == -1:
+				i -= 1
+		else:
+			i = -i - 2
+		if low == -1:
+			if i < 0:
+				return None
+			low = block_prevle(self._getblk(i, &b1), BLOCKSIZE - 1)
+		return ((<uint32_t>self.keys[i]) << 16) | low
+
+	def iter(self, start=None, reverse=False):
+		"""Return a seekable iterator over the elements of this set.
+
+		:param start: if given, start at the first element ``>= start``
+			(if ``reverse`` is True: the last element ``<= start``).
+		:param reverse: if True, iterate in descending order.
+
+		>>> it = RoaringBitmap({1, 5, 8, 9}).iter(start=2)
+		>>> next(it)
+		5
+		>>> it.seek(9)
+		>>> list(it)
+		[9]
+		"""
+		result = RoaringBitmapIterator(self, reverse)
+		if start is not None:
+			result.seek(start)
+		return result
+
 	def index(self, uint32_t x):
 		"""Return the 0-based index of `x` in this set.
 
@@ -872,6 +1538,20 @@ cdef class RoaringBitmap(object):
 			if tmp >= stop:
 				break
 
+	cdef _initsorted(self, uint32_t *elems, size_t length):
+		"""Add elements from a sorted array without duplicates."""
+		cdef Block *block
+		cdef size_t n = 0, m
+		cdef uint16_t key
+		while n < length:
+			key = highbits(elems[n])
+			m = n + 1
+			while m < length and highbits(elems[m]) == key:
+				m += 1
+			block = self._insertempty(self.size, key)
+			block_initsorted(block, &(elems[n]), m - n)
+			n = m
+
 	def _init2pass(self, iterable):
 		cdef Block *block = NULL
 		cdef uint32_t elem
@@ -968,6 +1648,15 @@ cdef class RoaringBitmap(object):
 	# 		block_add(block, lowbits(elem))
 	# 		block_convert(block)
 
+	cdef _checkexports(self):
+		"""Raise BufferError if the keys and blocks of this set are in use
+		by another object, and may therefore not be modified or freed.
+
+		Should be called by each operation that modifies this set."""
+		if self._exports:
+			raise BufferError('RoaringBitmap cannot be modified while its '
+					'data is in use.')
+
 	cdef _initarray(self, int k):
 		"""Allocate k elements and initialize pointers to zero."""
 		self._extendarray(k)
@@ -1003,6 +1692,7 @@ cdef class RoaringBitmap(object):
 			self.data = <Block *>tmp2
 			self.capacity = k
 		self.size = k
+		self._cleardirectory()
 
 	cdef _tmpalloc(self, int size, uint16_t **keys, Block **data):
 		keys[0] = <uint16_t *>malloc(size * sizeof(uint16_t))
@@ -1021,6 +1711,7 @@ cdef class RoaringBitmap(object):
 	cdef _removeatidx(self, int i):
 		"""Remove the i'th element."""
 		aligned_free(self.data[i].buf.ptr)
+		self._dirremove(i)
 		memmove(&(self.keys[i]), &(self.keys[i + 1]),
 				(self.size - i - 1) * sizeof(uint16_t))
 		memmove(&(self.data[i]), &(self.data[i + 1]),
@@ -1038,6 +1729,7 @@ cdef class RoaringBitmap(object):
 		self.size += 1
 		self.keys[i] = key
 		self.data[i].buf.ptr = NULL
+		self._dirinsert(i)
 		return &(self.data[i])
 
 	cdef _insertcopy(self, int i, uint16_t key, Block *block):
@@ -1059,16 +1751,71 @@ cdef class RoaringBitmap(object):
 			self.data[i].capacity = size
 		memcpy(self.data[i].buf.ptr, block.buf.ptr, size * sizeof(uint16_t))
 		self.size += 1
+		self._dirinsert(i)
 
 	cdef int _getindex(self, uint16_t key):
+		cdef int i
 		if self.size == 0:
 			return -1
-		# Common case of appending in last block:
+		# Common case of appending in or after last block:
 		if self.keys[self.size - 1] == key:
 			return self.size - 1
+		elif self.keys[self.size - 1] < key:
+			return -(<int>self.size + 1)
+		if self.directory is NULL and self.size >= DIRMINBLOCKS:
+			self.lookups += 1
+			if self.lookups >= DIRLOOKUPS:
+				self._builddirectory()
+		if self.directory is not NULL:
+			i = self.directory[key]
+			return i if self.keys[i] == key else -(i + 1)
 		return self._binarysearch(0, self.size, key)
 
-	cdef int _binarysearch(self, int begin, int end, uint16_t key):
+	cdef void _builddirectory(self) noexcept nogil:
+		"""Build a table with the index of the first key ``>= k``, for each
+		``k`` up to the last key, such that lookups need no binary search.
+		"""
+		cdef uint32_t n, k = 0
+		self.directory = <uint16_t *>malloc(BLOCKSIZE * sizeof(uint16_t))
+		self.lookups = 0
+		if self.directory is NULL:  # fall back to binary search
+			return
+		for n in range(self.size):
+			while k <= self.keys[n]:
+				self.directory[k] = n
+				k += 1
+
+	cdef void _dirinsert(self, int i) noexcept nogil:
+		"""Update directory after inserting a block at index ``i``."""
+		cdef uint32_t k
+		if self.directory is NULL:
+			return
+		if i == <int>self.size - 1:  # appended; extend directory to new key
+			for k in range(self.keys[i - 1] + 1, self.keys[i] + 1):
+				self.directory[k] = i
+		else:
+			for k in range(self.keys[i] + 1, self.keys[self.size - 1] + 1):
+				self.directory[k] += 1
+
+	cdef void _dirremove(self, int i) noexcept nogil:
+		"""Update directory before removing the block at index ``i``."""
+		cdef uint32_t k
+		if self.directory is NULL:
+			return
+		if self.size <= DIRMINBLOCKS:
+			self._cleardirectory()
+		elif i < <int>self.size - 1:
+			for k in range(self.keys[i] + 1, self.keys[self.size - 1] + 1):
+				self.directory[k] -= 1
+
+	cdef void _cleardirectory(self) noexcept nogil:
+		"""Discard directory, e.g., when keys are replaced."""
+		free(self.directory)
+		self.directory = NULL
+		self.lookups = 0
+
+	cdef int _binarysearch(self, int begin, int end,
+			uint16_t key) noexcept nogil:
 		"""Binary search for key.
 
 		:returns: positive index ``i`` if ``key`` is found;
@@ -1129,6 +1876,141 @@ cdef class RoaringBitmap(object):
 		return &(self.data[i])
 
 
+@cython.no_gc_clear
+cdef class BlockBuffer(object):
+	"""Exposes the data of a block of a RoaringBitmap through the buffer
+	protocol, without copying; cf. RoaringBitmap.iter_blocks().
+
+	As long as this object exists, the bitmap cannot be modified."""
+	cdef RoaringBitmap ob  # the bitmap that owns the data
+	cdef void *ptr
+	cdef Py_ssize_t shape[1]
+	cdef Py_ssize_t strides[1]
+	cdef bint readonly
+	cdef bint dense
+
+	def __getbuffer__(self, Py_buffer *buffer, int flags):
+		if flags & PyBUF_WRITABLE and self.readonly:
+			raise BufferError('block of immutable bitmap is read-only.')
+		buffer.buf = self.ptr
+		buffer.obj = self
+		buffer.itemsize = self.strides[0]
+		buffer.len = self.shape[0] * self.strides[0]
+		buffer.readonly = self.readonly
+		buffer.ndim = 1
+		buffer.format = NULL
+		if flags & PyBUF_FORMAT:
+			buffer.format = b'Q' if self.dense else b'H'
+		buffer.shape = self.shape if flags & PyBUF_ND else NULL
+		buffer.strides = self.strides if flags & PyBUF_STRIDES else NULL
+		buffer.suboffsets = NULL
+		buffer.internal = NULL
+
+	def __releasebuffer__(self, Py_buffer *buffer):
+		pass
+
+	def __dealloc__(self):
+		if self.ob is not None:
+			self.ob._exports -= 1
+
+
+cdef BlockBuffer blockbuffer(RoaringBitmap ob, Block *block, bint readonly):
+	"""Return a buffer with the array or bitmap of a block of ``ob``."""
+	cdef BlockBuffer buf = BlockBuffer.__new__(BlockBuffer)
+	buf.ob = ob
+	ob._exports += 1
+	buf.ptr = block.buf.ptr
+	buf.readonly = readonly
+	buf.dense = block.state == DENSE
+	if buf.dense:
+		buf.shape[0] = BITNSLOTS(BLOCKSIZE)
+		buf.strides[0] = sizeof(uint64_t)
+	else:
+		buf.shape[0] = getsize(block)
+		buf.strides[0] = sizeof(uint16_t)
+	return buf
+
+
+cdef readbytes(fileobj, size_t nbytes):
+	"""Read exactly ``nbytes`` bytes from a file object."""
+	result = fileobj.read(nbytes)
+	while len(result) < nbytes:  # short read, e.g., from a pipe or socket
+		data = fileobj.read(nbytes - len(result))
+		if not data:
+			raise EOFError('unexpected end of file.')
+		result += data
+	return result
+
+
+cdef readfully(fileobj, BlockBuffer buf):
+	"""Fill a block buffer with data from a file object."""
+	cdef size_t nbytes = buf.shape[0] * buf.strides[0]
+	cdef size_t n = fileobj.readinto(buf) or 0
+	while n < nbytes:  # short read; copy remainder
+		data = fileobj.read(nbytes - n)
+		if not data:
+			raise EOFError('unexpected end of file.')
+		memcpy(&((<char *>buf.ptr)[n]), <char *>data, len(data))
+		n += len(data)
+
+
+cdef class RoaringBitmapIterator(object):
+	"""A seekable iterator over a RoaringBitmap; cf. RoaringBitmap.iter().
+
+	Each step and each seek takes a binary search over the keys and
+	within a block, which makes it suitable for skipping through the
+	elements of bitmaps, e.g., for cursor-based pagination or leapfrog
+	joins."""
+	cdef RoaringBitmap ob
+	cdef int i  # index of the current block
+	cdef int low  # the next element in the current block to consider
+	cdef bint reverse
+
+	def __cinit__(self, RoaringBitmap ob, bint reverse=False):
+		self.ob = ob
+		self.reverse = reverse
+		self.i = <int>ob.size - 1 if reverse else 0
+		self.low = BLOCKSIZE - 1 if reverse else 0
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		cdef Block b1
+		cdef int result = -1
+		while True:
+			if self.i < 0 or self.i >= <int>self.ob.size:
+				raise StopIteration
+			if self.reverse:
+				result = -1 if self.low < 0 else block_prevle(
+						self.ob._getblk(self.i, &b1), self.low)
+				if result != -1:
+					self.low = result - 1
+					break
+				self.i -= 1
+				self.low = BLOCKSIZE - 1
+			else:
+				result = -1 if self.low >= BLOCKSIZE else block_nextge(
+						self.ob._getblk(self.i, &b1), self.low)
+				if result != -1:
+					self.low = result + 1
+					break
+				self.i += 1
+				self.low = 0
+		return ((<uint32_t>self.ob.keys[self.i]) << 16) | result
+
+	def seek(self, uint32_t x):
+		"""Move iterator such that the next element will be the smallest
+		element ``>= x`` (if reverse: the largest element ``<= x``)."""
+		cdef int i = self.ob._getindex(highbits(x))
+		if i >= 0:
+			self.i, self.low = i, lowbits(x)
+		elif self.reverse:
+			self.i, self.low = -i - 2, BLOCKSIZE - 1
+		else:
+			self.i, self.low = -i - 1, 0
+
+
 cdef inline RoaringBitmap ensurerb(obj):
 	"""Convert set-like ``obj`` to RoaringBitmap if necessary."""
 	if isinstance(obj, RoaringBitmap):
@@ -1136,6 +2018,29 @@ cdef inline RoaringBitmap ensurerb(obj):
 	return RoaringBitmap(obj)
 
 
+cdef RoaringBitmap rbfromuint32(buf):
+	"""Create a RoaringBitmap from a sequence of unsigned 32-bit
+	integers, which need not be sorted."""
+	cdef RoaringBitmap result = RoaringBitmap()
+	cdef array.array elems
+	cdef Py_buffer buffer
+	cdef char *ptr = NULL
+	cdef Py_ssize_t size = 0
+	cdef size_t length
+	buf = asuint32(buf)
+	length = len(buf)
+	elems = array.clone(uintarray, length, False)
+	if length:
+		if getbufptr(buf, &ptr, &size, &buffer) != 0:
+			raise ValueError('could not get buffer.')
+		memcpy(elems.data.as_uints, ptr, length * sizeof(uint32_t))
+		releasebuf(&buffer)
+	with nogil:
+		length = sortunique32(elems.data.as_uints, length)
+	result._initsorted(elems.data.as_uints, length)
+	return result
+
+
 cdef inline uint16_t highbits(uint32_t x) noexcept nogil:
 	return x >> 16
 
@@ -1144,6 +2049,16 @@ cdef inline uint16_t lowbits(uint32_t x) noexcept nogil:
 	return x & 0xFFFF
 
 
+cdef inline uint32_t hash32(uint32_t x) noexcept nogil:
+	"""Mix the bits of x; the finalizer of MurmurHash3."""
+	x ^= x >> 16
+	x *= 0x85ebca6bU
+	x ^= x >> 13
+	x *= 0xc2b2ae35U
+	x ^= x >> 16
+	return x
+
+
 cdef inline uint32_t min(uint32_t a, uint32_t b) noexcept nogil:
 	return a if a <= b else b
 
@@ -1152,6 +2067,11 @@ cdef inline uint32_t max(uint32_t a, uint32_t b) noexcept nogil:
 	return a if a >= b else b
 
 
+cdef inline size_t bufalign(size_t offset, size_t alignment) noexcept nogil:
+	"""Round ``offset`` up to a multiple of ``alignment``."""
+	return (offset + alignment - 1) // alignment * alignment
+
+
 cdef inline int getbufptr(
 		object obj, char ** ptr, Py_ssize_t * size, Py_buffer * buf):
 	"""Get a pointer from bytes/buffer object ``obj``.
@@ -1231,4 +2151,6 @@ def mmaptests():
 	return True
 
 
-__all__ = ['RoaringBitmap', 'ImmutableRoaringBitmap', 'MultiRoaringBitmap']
+__all__ = ['RoaringBitmap', 'ImmutableRoaringBitmap', 'MultiRoaringBitmap',
+		'MultiRoaringBitmapBuilder', 'UpdatableMultiRoaringBitmap', 'merge_iter',
+		'BitSlicedIndex', 'ShardedMultiRoaringBitmap']
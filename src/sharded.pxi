@@ -0,0 +1,333 @@
+"""A sequence of roaring bitmaps stored in multiple files."""
+
+# Name of the file for shard n in the directory of a sharded collection
+SHARDFILENAME = 'shard%05d.mrb'
+
+
+cdef class ShardedMultiRoaringBitmap(object):
+	"""A sequence of roaring bitmaps stored as a directory of
+	MultiRoaringBitmap files (shards), each loaded with mmap.
+
+	Indices refer to the concatenation of the shards, in order of their
+	filenames. Queries are evaluated on each shard, and the results are
+	merged. With ``nthreads > 1``, the shards are queried in threads that
+	run in parallel while the per-shard methods release the GIL; cf.
+	``MultiRoaringBitmap.intersection()``. New shards can be added without
+	rewriting existing ones.
+
+	>>> smrb = ShardedMultiRoaringBitmap('index/')
+	>>> smrb.add_shard([RoaringBitmap({1, 2}), RoaringBitmap({2, 3})])
+	0
+	>>> smrb.add_shard([RoaringBitmap({2, 5})])
+	2
+	>>> smrb.intersection([0, 1, 2])
+	RoaringBitmap({2})
+	"""
+	cdef readonly object directory
+	cdef list shards  # MultiRoaringBitmap objects
+	cdef list starts  # index of the first bitmap of each shard
+	cdef long size  # the total number of bitmaps
+	cdef public int nthreads
+	cdef object advice
+
+	def __init__(self, directory, int nthreads=1, advice=None):
+		"""
+		:param directory: a directory with shard files named
+			``shard*.mrb``; created if it does not exist.
+		:param nthreads: the number of threads for queries over shards.
+		:param advice: access pattern hint for the shard files;
+			cf. ``MultiRoaringBitmap.fromfile()``."""
+		self.directory = directory
+		self.nthreads = nthreads
+		self.advice = advice
+		self.shards = []
+		self.starts = []
+		self.size = 0
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		for name in sorted(os.listdir(directory)):
+			if name.startswith('shard') and name.endswith('.mrb'):
+				self._append(MultiRoaringBitmap.fromfile(
+						os.path.join(directory, name), advice))
+
+	cdef _append(self, MultiRoaringBitmap mrb):
+		self.shards.append(mrb)
+		self.starts.append(self.size)
+		self.size += len(mrb)
+
+	def add_shard(self, list init):
+		"""Write a new shard with the given bitmaps to the directory.
+
+		:param init: a list of set-like objects; cf. MultiRoaringBitmap.
+		:returns: the index of the first new bitmap.
+
+		The shard is numbered one higher than the highest numbered shard
+		file in the directory, so that it comes last even if shards have
+		been removed."""
+		cdef int n = 0
+		for name in os.listdir(self.directory):
+			number = name[5:len(name) - 4]
+			if (name.startswith('shard') and name.endswith('.mrb')
+					and number.isdigit() and int(number) >= n):
+				n = int(number) + 1
+		filename = os.path.join(self.directory, SHARDFILENAME % n)
+		if os.path.exists(filename):
+			raise ValueError('shard already exists: %r' % filename)
+		MultiRoaringBitmap(init, filename=filename).close()
+		self._append(MultiRoaringBitmap.fromfile(filename, self.advice))
+		return self.starts[len(self.starts) - 1]
+
+	def numshards(self):
+		"""Return the number of shards."""
+		return len(self.shards)
+
+	def close(self):
+		"""Close all shard files."""
+		for mrb in self.shards:
+			mrb.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, _type, _value, _traceback):
+		self.close()
+
+	def __len__(self):
+		return self.size
+
+	cdef int _shard(self, long i):
+		"""Return the shard with bitmap i, assuming i is a valid index."""
+		return bisect.bisect_right(self.starts, i) - 1
+
+	cpdef get(self, long i):
+		"""Return bitmap `i` as an ``ImmutableRoaringBitmap``, or ``None`` if
+		`i` is an invalid index."""
+		cdef int n
+		if i < 0 or i >= self.size:
+			return None
+		n = self._shard(i)
+		return (<MultiRoaringBitmap>self.shards[n]).get(i - self.starts[n])
+
+	def cardinality(self, long i):
+		"""Return the number of elements in bitmap `i`;
+		cf. ``MultiRoaringBitmap.cardinality()``."""
+		cdef int n
+		if i < 0 or i >= self.size:
+			raise IndexError('index %d out of range 0..%d' % (i, self.size))
+		n = self._shard(i)
+		return self.shards[n].cardinality(i - self.starts[n])
+
+	def bounds(self, long i):
+		"""Return the smallest and largest element of bitmap `i`;
+		cf. ``MultiRoaringBitmap.bounds()``."""
+		cdef int n
+		if i < 0 or i >= self.size:
+			raise IndexError('index %d out of range 0..%d' % (i, self.size))
+		n = self._shard(i)
+		return self.shards[n].bounds(i - self.starts[n])
+
+	def __getitem__(self, i):
+		"""Like self.get(), but handle negative indices, slices and raise
+		IndexError for invalid index."""
+		if isinstance(i, slice):
+			return [self[n] for n in range(*i.indices(len(self)))]
+		elif not isinstance(i, (int, long)):
+			raise TypeError('Expected integer index or slice object.')
+		elif i < 0:
+			i += len(self)
+		result = self.get(i)
+		if result is None:
+			raise IndexError
+		return result
+
+	def warmup(self, indices=None, bint touch=False):
+		"""Load the pages of the given bitmaps into memory;
+		cf. ``MultiRoaringBitmap.warmup()``."""
+		if indices is None:
+			for mrb in self.shards:
+				mrb.warmup(None, touch)
+			return
+		for n, local, _ in self._group(indices):
+			self.shards[n].warmup(local, touch)
+
+	def __iter__(self):
+		for mrb in self.shards:
+			for rb in mrb:
+				yield rb
+
+	cdef list _group(self, indices):
+		"""Group indices by shard.
+
+		:returns: a list of tuples ``(n, local, positions)`` for each shard n
+			with at least one index; ``local`` has the indices relative to
+			the shard, ``positions`` the corresponding positions in
+			``indices``.
+		:raises IndexError: if an invalid index is encountered."""
+		cdef dict groups = {}
+		cdef int n
+		for pos, i in enumerate(indices):
+			if i < 0 or i >= self.size:
+				raise IndexError('index %d out of range 0..%d' % (
+						i, self.size))
+			n = self._shard(i)
+			if n not in groups:
+				groups[n] = ([], [])
+			groups[n][0].append(i - self.starts[n])
+			groups[n][1].append(pos)
+		return [(n, local, positions)
+				for n, (local, positions) in sorted(groups.items())]
+
+	def _fanout(self, func, list args):
+		"""Return ``[func(*a) for a in args]``, computed with up to
+		``nthreads`` threads."""
+		cdef int numthreads = self.nthreads
+		results = [None] * len(args)
+		errors = []
+
+		def work(int first):
+			try:
+				for n in range(first, len(args), numthreads):
+					results[n] = func(*args[n])
+			except Exception as err:
+				errors.append(err)
+
+		if numthreads > len(args):
+			numthreads = len(args)
+		if numthreads <= 1:
+			return [func(*a) for a in args]
+		threads = [threading.Thread(target=work, args=(a, ))
+				for a in range(numthreads)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		if errors:
+			raise errors[0]
+		return results
+
+	def intersection(self, list indices,
+			uint32_t start=0, uint32_t stop=0xffffffffUL,
+			limit=None, offset=0):
+		"""Compute intersection of given a list of indices of roaring bitmaps
+		in this collection; cf. ``MultiRoaringBitmap.intersection()``.
+
+		:returns: the intersection as a mutable RoaringBitmap.
+			Returns ``None`` when an invalid index is encountered or an empty
+			result is obtained."""
+		cdef RoaringBitmap result
+		try:
+			groups = self._group(indices)
+		except IndexError:
+			return None
+		if not groups:
+			return None
+		if limit is not None or offset:
+			return andlimit([self.get(i) for i in indices],
+					start, stop, limit, offset) or None
+		results = self._fanout(
+				lambda n, local, _: self.shards[n].intersection(
+					local, start, stop),
+				groups)
+		if any([a is None for a in results]):
+			return None
+		results.sort(key=len)
+		if len(results) == 1:
+			return results[0]
+		result = rb_and(results[0], results[1])
+		for rb in results[2:]:
+			if not result:
+				break
+			rb_iand(result, rb)
+		return result or None
+
+	def evaluate(self, expr, uint32_t start=0, uint32_t stop=0xffffffffUL):
+		"""Evaluate a boolean query over the bitmaps in this collection;
+		cf. ``MultiRoaringBitmap.evaluate()``."""
+		return (self.shards[0] if self.shards else MultiRoaringBitmap([])
+				).evaluate(self._rewrite(expr), start, stop)
+
+	def _rewrite(self, expr):
+		"""Replace indices in a query expression with bitmaps."""
+		if isinstance(expr, (int, long)):
+			if expr < 0 or expr >= len(self):
+				raise IndexError('index %d out of range 0..%d' % (
+						expr, len(self)))
+			return self.get(expr)
+		elif isinstance(expr, tuple) and len(expr) >= 2:
+			return expr[:1] + tuple([self._rewrite(a) for a in expr[1:]])
+		return expr
+
+	def jaccard_dist_single(self, RoaringBitmap rb):
+		"""Compute the Jaccard distances for `rb` with all roaring bitmaps
+		in this collection; cf. ``MultiRoaringBitmap.jaccard_dist_single()``.
+		"""
+		cdef array.array result = array.clone(dblarray, 0, False)
+		for a in self._fanout(lambda mrb: mrb.jaccard_dist_single(rb),
+				[(mrb, ) for mrb in self.shards]):
+			result.extend(a)
+		return result
+
+	def intersection_len_single(self, rb, indices=None, topk=None):
+		"""Compute ``len(rb & self[i])`` for all bitmaps ``i`` in this
+		collection, or those in ``indices``;
+		cf. ``MultiRoaringBitmap.intersection_len_single()``."""
+		return self._lensingle('intersection_len_single', rb, indices, topk)
+
+	def union_len_single(self, rb, indices=None, topk=None):
+		"""Compute ``len(rb | self[i])``;
+		cf. ``intersection_len_single()``."""
+		return self._lensingle('union_len_single', rb, indices, topk)
+
+	def difference_len_single(self, rb, indices=None, topk=None):
+		"""Compute ``len(rb - self[i])``;
+		cf. ``intersection_len_single()``."""
+		return self._lensingle('difference_len_single', rb, indices, topk)
+
+	def find_subsets(self, rb):
+		"""Return the indices of bitmaps that are a subset of ``rb``;
+		cf. ``MultiRoaringBitmap.find_subsets()``."""
+		return self._find('find_subsets', rb)
+
+	def find_supersets(self, rb):
+		"""Return the indices of bitmaps that are a superset of ``rb``;
+		cf. ``MultiRoaringBitmap.find_supersets()``."""
+		return self._find('find_supersets', rb)
+
+	def find_intersecting(self, rb):
+		"""Return the indices of bitmaps that intersect with ``rb``;
+		cf. ``MultiRoaringBitmap.find_intersecting()``."""
+		return self._find('find_intersecting', rb)
+
+	def _find(self, method, rb):
+		cdef RoaringBitmap result = RoaringBitmap()
+		rb = ensurerb(rb)
+		for start, a in zip(self.starts, self._fanout(
+				lambda mrb: getattr(mrb, method)(rb),
+				[(mrb, ) for mrb in self.shards])):
+			result.update([start + i for i in a])
+		return result
+
+	def _lensingle(self, method, rb, indices, topk):
+		cdef array.array result
+		rb = ensurerb(rb)
+		if indices is None:
+			result = array.clone(longarray, 0, False)
+			for a in self._fanout(
+					lambda mrb: getattr(mrb, method)(rb),
+					[(mrb, ) for mrb in self.shards]):
+				result.extend(a)
+			indices = range(len(self))
+		else:
+			indices = list(indices)
+			result = array.clone(longarray, len(indices), False)
+			groups = self._group(indices)
+			for (_, _, positions), a in zip(groups, self._fanout(
+					lambda n, local, _: getattr(self.shards[n], method)(
+						rb, local),
+					groups)):
+				for pos, cnt in zip(positions, a):
+					result[pos] = cnt
+		if topk is None:
+			return result
+		return heapq.nsmallest(topk, zip(indices, result),
+				key=lambda x: (-x[1], x[0]))
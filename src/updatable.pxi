@@ -0,0 +1,233 @@
+"""A MultiRoaringBitmap with updates kept in memory."""
+
+
+cdef class UpdatableMultiRoaringBitmap(object):
+	"""A sequence of roaring bitmaps that can be updated, consisting of a
+	read-only MultiRoaringBitmap with in-memory additions and deletions.
+
+	For each updated bitmap, the elements that are added or removed are
+	stored as RoaringBitmaps; they are kept disjoint with (respectively,
+	a subset of) the original bitmap. Queries with ``evaluate()`` and
+	``intersection()`` are evaluated on the combination of the original
+	bitmaps and the updates, without creating the updated bitmaps.
+	Use ``compact()`` to write the updated bitmaps to a new file.
+
+	>>> umrb = UpdatableMultiRoaringBitmap(mrb)
+	>>> umrb.add(0, 9)
+	>>> umrb.discard(0, 1)
+	>>> umrb[0]
+	RoaringBitmap({0, 2, 9})
+	"""
+	cdef readonly MultiRoaringBitmap base
+	cdef dict added  # index => RoaringBitmap with added elements
+	cdef dict removed  # index => RoaringBitmap with removed elements
+	cdef uint32_t size  # the number of bitmaps, including appended ones
+
+	def __init__(self, MultiRoaringBitmap base):
+		"""
+		:param base: the original bitmaps; will not be modified."""
+		self.base = base
+		self.added = {}
+		self.removed = {}
+		self.size = len(base)
+
+	def __len__(self):
+		return self.size
+
+	cdef _check(self, long i):
+		if i < 0 or i >= self.size:
+			raise IndexError('index %d out of range 0..%d' % (i, self.size))
+
+	cdef _original(self, long i):
+		"""Return original bitmap i; empty for appended bitmaps."""
+		if i >= len(self.base):
+			return EMPTYIRB
+		return self.base.get(i)
+
+	cdef _cleanup(self, long i):
+		"""Remove empty updates of bitmap i."""
+		if i in self.added and not self.added[i]:
+			del self.added[i]
+		if i in self.removed and not self.removed[i]:
+			del self.removed[i]
+
+	def add(self, long i, uint32_t elem):
+		"""Add element to bitmap i."""
+		self._check(i)
+		if i in self.removed and elem in self.removed[i]:
+			self.removed[i].discard(elem)
+			self._cleanup(i)
+		elif elem not in self._original(i):
+			self.added.setdefault(i, RoaringBitmap()).add(elem)
+
+	def discard(self, long i, uint32_t elem):
+		"""Remove element from bitmap i, if it is present."""
+		self._check(i)
+		if i in self.added and elem in self.added[i]:
+			self.added[i].discard(elem)
+			self._cleanup(i)
+		elif elem in self._original(i):
+			self.removed.setdefault(i, RoaringBitmap()).add(elem)
+
+	def update(self, long i, *iterables):
+		"""Add elements of each iterable to bitmap i."""
+		cdef RoaringBitmap other, tmp
+		self._check(i)
+		for a in iterables:
+			other = ensurerb(a)
+			if i in self.removed:
+				self.removed[i] -= other
+			tmp = self.added.setdefault(i, RoaringBitmap())
+			tmp |= other - self._original(i)
+		self._cleanup(i)
+
+	def difference_update(self, long i, *iterables):
+		"""Remove elements of each iterable from bitmap i."""
+		cdef RoaringBitmap other, tmp
+		self._check(i)
+		for a in iterables:
+			other = ensurerb(a)
+			if i in self.added:
+				self.added[i] -= other
+			tmp = self.removed.setdefault(i, RoaringBitmap())
+			tmp |= other & self._original(i)
+		self._cleanup(i)
+
+	def append(self, iterable=None):
+		"""Add a new bitmap; return its index."""
+		self.size += 1
+		if iterable is not None:
+			self.update(self.size - 1, iterable)
+		return self.size - 1
+
+	def ismodified(self, long i):
+		"""Return True if bitmap i has been updated or appended."""
+		self._check(i)
+		return i in self.added or i in self.removed
+
+	cpdef get(self, long i):
+		"""Return bitmap `i` as an ``ImmutableRoaringBitmap`` if it has not
+		been updated, as a new RoaringBitmap with the updates applied
+		otherwise, or ``None`` if `i` is an invalid index."""
+		cdef RoaringBitmap result
+		if i < 0 or i >= self.size:
+			return None
+		elif i not in self.added and i not in self.removed:
+			return self._original(i)
+		result = rb_sub(self._original(i), self.removed[i]) if (
+				i in self.removed) else RoaringBitmap(self._original(i))
+		if i in self.added:
+			rb_ior(result, self.added[i])
+		return result
+
+	def __getitem__(self, i):
+		"""Like self.get(), but handle negative indices, slices and raise
+		IndexError for invalid index."""
+		if isinstance(i, slice):
+			return [self[n] for n in range(*i.indices(self.size))]
+		elif not isinstance(i, (int, long)):
+			raise TypeError('Expected integer index or slice object.')
+		elif i < 0:
+			i += self.size
+		result = self.get(i)
+		if result is None:
+			raise IndexError
+		return result
+
+	def _rewrite(self, expr):
+		"""Replace indices of updated bitmaps in a query expression with
+		subexpressions that apply the updates."""
+		if isinstance(expr, (int, long)):
+			self._check(expr)
+			if expr not in self.added and expr not in self.removed:
+				return expr if expr < len(self.base) else RoaringBitmap()
+			result = expr if expr < len(self.base) else RoaringBitmap()
+			if expr in self.removed:
+				result = ('andnot', result, self.removed[expr])
+			if expr in self.added:
+				result = ('or', result, self.added[expr])
+			return result
+		elif isinstance(expr, tuple) and len(expr) >= 2:
+			return expr[:1] + tuple([self._rewrite(a) for a in expr[1:]])
+		return expr
+
+	def evaluate(self, expr, uint32_t start=0, uint32_t stop=0xffffffffUL):
+		"""Evaluate a boolean query over the updated bitmaps.
+
+		Cf. ``MultiRoaringBitmap.evaluate()``."""
+		return self.base.evaluate(self._rewrite(expr), start, stop)
+
+	def intersection(self, list indices,
+			uint32_t start=0, uint32_t stop=0xffffffffUL,
+			limit=None, offset=0):
+		"""Compute intersection of given a list of indices of bitmaps.
+
+		Cf. ``MultiRoaringBitmap.intersection()``.
+		:returns: the intersection as a mutable RoaringBitmap.
+			Returns ``None`` when an invalid index is encountered or an empty
+			result is obtained."""
+		if not indices or any(i < 0 or i >= self.size for i in indices):
+			return None
+		if limit is not None or offset:
+			return andlimit([self.get(i) for i in indices],
+					start, stop, limit, offset) or None
+		result = self.evaluate(('and', ) + tuple(indices), start, stop)
+		return result or None
+
+	def compact(self, filename, bint metadata=False):
+		"""Write the updated bitmaps to a new file, and use it as the base
+		of this object, discarding the in-memory updates. Identical bitmaps
+		are stored only once.
+
+		:param filename: the file to write; overwritten if it already
+			exists. Cannot be the file of the current base, which is mapped
+			into memory.
+		:param metadata: if True, store a summary of each bitmap;
+			cf. ``MultiRoaringBitmap()``.
+		:returns: the new base, a MultiRoaringBitmap loaded with mmap.
+
+		The previous base is not closed, since bitmaps obtained from it may
+		still be in use; it remains the responsibility of whoever opened it.
+		The new base should be closed by the caller when no longer needed,
+		e.g., with ``umrb.base.close()``."""
+		cdef array.array offsets = array.clone(uintarray, self.size, False)
+		cdef array.array sizes = array.clone(uintarray, self.size, True)
+		cdef size_t offset = mrbheadersize(self.size)
+		cdef array.array metas = None
+		cdef RowMeta *meta = NULL
+		cdef dict seen = {}  # digest => offset of identical bitmap
+		cdef uint32_t i
+		if (self.base._file is not None and os.path.exists(filename)
+				and os.path.samestat(
+					os.fstat(self.base._file), os.stat(filename))):
+			raise ValueError('cannot compact into the file of the current '
+					'base: %r' % filename)
+		if metadata:
+			metas = array.clone(chararray, self.size * sizeof(RowMeta), True)
+			meta = <RowMeta *>metas.data.as_chars
+		with open(filename, 'wb') as out:
+			out.seek(offset)
+			for i in range(self.size):
+				offsets.data.as_uints[i] = offset
+				rb = self.get(i)
+				if rb:
+					if metadata:
+						rowmeta(rb, &(meta[i]))
+					state = rb.__getstate__()
+					sizes.data.as_uints[i] = len(state)
+					key = hashlib.sha1(state).digest()
+					if key in seen:
+						offsets.data.as_uints[i] = seen[key]
+						continue
+					offset = writerow(out, offset, state)
+					offsets.data.as_uints[i] = seen[key] = offset
+					offset += len(state)
+			if metadata:
+				offset = writemrbmeta(out, offset, metas)
+			out.seek(0)
+			writemrbheader(out, self.size, offsets, sizes,
+					offset if metadata else 0)
+		self.base = MultiRoaringBitmap.fromfile(filename)
+		self.added.clear()
+		self.removed.clear()
+		return self.base
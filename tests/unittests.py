@@ -1,18 +1,25 @@
 """Unit tests for roaringbitmap"""
 from __future__ import division, absolute_import, unicode_literals
+import io
+import os
 import sys
 import array
 import pytest
 import pickle
+import struct
 import tempfile
+import shutil
 from random import seed, choice, sample, randint
+from bisect import bisect_left, bisect_right
 try:
 	import faulthandler
 	faulthandler.enable()
 except ImportError:
 	pass
 from roaringbitmap import (RoaringBitmap, ImmutableRoaringBitmap,
-		MultiRoaringBitmap, bitcounttests, aligned_malloc_tests, mmaptests)
+		MultiRoaringBitmap, MultiRoaringBitmapBuilder,
+		UpdatableMultiRoaringBitmap, ShardedMultiRoaringBitmap, BitSlicedIndex,
+		merge_iter, bitcounttests, aligned_malloc_tests, mmaptests)
 PY2 = sys.version_info[0] == 2
 if PY2:
 	range = xrange
@@ -182,6 +189,20 @@ class Test_roaringbitmap(object):
 			assert len(rb) == 0, name
 			assert rb == ref, name
 
+	def test_add_many(self, single):
+		for name, data in single:
+			ref = set(data[::2])
+			rb = RoaringBitmap(data[::2])
+			extra = data[1::2] + data[:10]
+			rb.add_many(array.array(b'I' if PY2 else 'I', extra[::-1]))
+			ref.update(extra)
+			assert rb == ref, name
+			rb.discard_many(data[::3] + [(1 << 32) - 1])
+			ref.difference_update(data[::3])
+			assert rb == ref, name
+			rb.add_many([])
+			assert rb == ref, name
+
 	def test_pop(self):
 		rb = RoaringBitmap([60748, 28806, 54664, 28597, 58922, 75684, 56364,
 			67421, 52608, 55686, 10427, 48506, 64363, 14506, 73077, 59035,
@@ -204,6 +225,46 @@ class Test_roaringbitmap(object):
 				assert a not in rb, name
 			rb._checkconsistency()
 
+	def test_directory(self):
+		# wide bitmap with one element in each of 5000 blocks
+		rb = RoaringBitmap(range(0, 10000 << 16, 2 << 16))
+		ref = set(rb)
+		size = rb.__sizeof__()
+		for a in range(0, 10000 << 16, 1 << 16):
+			assert (a in rb) == (a in ref)
+		assert rb.__sizeof__() == size + 2 * (1 << 16)  # directory built
+		for a in range(1 << 16, 4000 << 16, 6 << 16):
+			rb.add(a)
+			ref.add(a)
+			rb.discard(a + (1 << 16))
+			ref.discard(a + (1 << 16))
+		seed(42)
+		for _ in range(3000):
+			a = randint(0, 12000) << 16
+			if a in ref:
+				rb.discard(a)
+				ref.discard(a)
+			else:
+				rb.add(a)
+				ref.add(a)
+			assert (a in rb) == (a in ref)
+		rb.add(0xffffffff)
+		rb.discard(0xffffffff)
+		rb.add(0xfffffffe)
+		ref.add(0xfffffffe)
+		assert rb.__sizeof__() > size + 2 * (1 << 16)  # still in use
+		for a in range(0, 10001 << 16, 1 << 16):
+			assert (a in rb) == (a in ref)
+		for a in range(0, 10001 << 16, 99 << 16):
+			assert rb.rank(a) == len([b for b in ref if b <= a])
+		assert rb == RoaringBitmap(sorted(ref))
+		rb._checkconsistency()
+		rb &= RoaringBitmap(range(0, 4000 << 16, 1 << 16))
+		assert rb.__sizeof__() < size  # directory discarded
+		irb = ImmutableRoaringBitmap(rb)
+		for a in range(0, 5000 << 16, 1 << 16):
+			assert (a in irb) == (a in ref and a < 4000 << 16)
+
 	def test_eq(self, single):
 		for name, data in single:
 			ref, ref2 = set(data), set(data)
@@ -221,6 +282,134 @@ class Test_roaringbitmap(object):
 			rb = RoaringBitmap(data)
 			assert list(iter(rb)) == sorted(set(data)), name
 
+	def test_iterinverted(self):
+		rb = RoaringBitmap(range(1 << 17))
+		rb.discard(65536 + 453)
+		assert list(rb) == [a for a in range(1 << 17) if a != 65536 + 453]
+
+	def test_iter_blocks(self, single):
+		def elements(key, state, view):
+			if state == 'dense':
+				return [key << 16 | n for n in range(1 << 16)
+						if view[n >> 6] >> (n & 63) & 1]
+			elif state == 'positive':
+				return [key << 16 | n for n in view]
+			return [key << 16 | n for n in sorted(
+					set(range(1 << 16)) - set(view))]
+
+		data = sorted({elem for _, d in single for elem in d}
+				| set(range(5 << 16, 6 << 16))  # full block
+				| set(range(7 << 16, 8 << 16, 3)))  # dense block
+		for rb in (RoaringBitmap(data), ImmutableRoaringBitmap(data)):
+			blocks = list(rb.iter_blocks())
+			assert [key for key, _, _ in blocks] == sorted(
+					set(a >> 16 for a in data))
+			assert {state for _, state, _ in blocks} == {
+					'positive', 'dense', 'inverted'}
+			assert [a for block in blocks for a in elements(*block)] == list(
+					rb)
+			view = blocks[0][2]
+			assert view.readonly
+			assert view.format == 'H' and view.itemsize == 2
+		del rb
+		assert elements(*blocks[0]) == [a for a in data if a < 1 << 16]
+		rb = RoaringBitmap([1, 5])
+		blocks = rb.iter_blocks()
+		_, _, view = next(blocks)
+		with pytest.raises(TypeError):
+			view[0] = 2
+		for mutate in (rb.clear, lambda: rb.add(2), lambda: rb.discard(5),
+				lambda: rb.update([7])):
+			with pytest.raises(BufferError):
+				mutate()
+		del blocks
+		with pytest.raises(BufferError):
+			rb.clear()
+		assert view.tolist() == [1, 5]
+		del view
+		rb.clear()
+		assert rb == RoaringBitmap()
+
+	def test_bitset(self, single):
+		def bitset(data, start, stop):
+			result = bytearray((stop - start + 7) // 8)
+			for a in data:
+				if start <= a < stop:
+					result[(a - start) >> 3] |= 1 << ((a - start) & 7)
+			return result
+
+		for name, data in single:
+			rb = RoaringBitmap(data)
+			bits = rb.to_bitset()
+			assert bits == bitset(data, 0, max(data) + 1 if data else 0), name
+			assert RoaringBitmap.from_bitset(bits) == rb, name
+			assert RoaringBitmap.from_bitset(b'ab' + bytes(bits), 2) == rb
+			for start, stop in ((8, 1000), (4096, 70001), (65536, 1 << 20)):
+				assert rb.to_bitset(start, stop) == bitset(data, start, stop)
+		rb = RoaringBitmap(list(range(1 << 16, 3 << 16)) + [5 << 16])
+		irb = ImmutableRoaringBitmap.from_bitset(rb.to_bitset())
+		assert isinstance(irb, ImmutableRoaringBitmap) and irb == rb
+		out = bytearray(b'\xff' * 9000)
+		assert rb.to_bitset(1 << 16, (1 << 16) + 8001, out) is out
+		assert out[:1000] == b'\xff' * 1000 and out[1000] == 1
+		assert out[1001:] == b'\xff' * 7999
+		with pytest.raises(ValueError):
+			rb.to_bitset(3)
+		with pytest.raises(ValueError):
+			rb.to_bitset(0, 100, bytearray(5))
+
+	def test_ranges(self, single):
+		def runs(data):
+			result = []
+			for a in sorted(set(data)):
+				if result and result[-1][1] == a:
+					result[-1][1] += 1
+				else:
+					result.append([a, a + 1])
+			return [tuple(a) for a in result]
+
+		for name, data in single:
+			rb = RoaringBitmap(data)
+			ref = runs(data)
+			assert list(rb.iter_ranges()) == ref, name
+			assert list(ImmutableRoaringBitmap(rb).iter_ranges()) == ref, name
+			starts = array.array(b'I' if PY2 else 'I', [a for a, _ in ref])
+			stops = array.array(b'I' if PY2 else 'I', [b for _, b in ref])
+			assert RoaringBitmap.from_ranges(starts, stops) == rb, name
+		# runs crossing blocks, bitmap/array blocks, the largest element
+		rb = RoaringBitmap(list(range(60000, 140000)) + list(range(
+				200000, 220000, 3)) + [(1 << 32) - 2, (1 << 32) - 1])
+		assert list(rb.iter_ranges()) == runs(rb)
+		assert list(rb.iter_ranges())[-1] == ((1 << 32) - 2, 1 << 32)
+		# ranges that are empty, overlapping or adjacent
+		rb = RoaringBitmap.from_ranges(
+				[1, 5, 9, 9, 10, 70000, 1 << 20],
+				[4, 5, 12, 10, 15, 65536 * 5, (1 << 20) + 5000])
+		assert list(rb.iter_ranges()) == [
+				(1, 4), (9, 15), (70000, 65536 * 5), (1 << 20, (1 << 20) + 5000)]
+		assert len(rb) == 3 + 6 + 65536 * 5 - 70000 + 5000
+		irb = ImmutableRoaringBitmap.from_ranges([0], [1 << 16])
+		assert isinstance(irb, ImmutableRoaringBitmap) and len(irb) == 1 << 16
+		assert RoaringBitmap.from_ranges([], []) == RoaringBitmap()
+		with pytest.raises(ValueError):
+			RoaringBitmap.from_ranges([5, 1], [6, 2])
+		with pytest.raises(ValueError):
+			RoaringBitmap.from_ranges([5, 1], [6])
+		# buffers that are not unsigned 32-bit integers are converted
+		def arr(typecode, data):
+			return array.array(typecode.encode('ascii') if PY2 else typecode,
+					data)
+		assert RoaringBitmap.from_ranges(
+				arr('I', [5, 70000]), arr('I', [7, 70001])) == RoaringBitmap(
+				[5, 6, 70000])
+		assert RoaringBitmap.from_ranges(
+				arr('i', [5, 70000]), arr('i', [7, 70001])) == RoaringBitmap(
+				[5, 6, 70000])
+		with pytest.raises(OverflowError):
+			RoaringBitmap.from_ranges(arr('i', [-5]), arr('i', [7]))
+		with pytest.raises(TypeError):
+			RoaringBitmap.from_ranges(arr('f', [5]), arr('f', [7]))
+
 	def test_reversed(self, single):
 		for name, data in single:
 			rb = RoaringBitmap(data)
@@ -291,6 +480,87 @@ class Test_roaringbitmap(object):
 			rb, rb2 = RoaringBitmap(data1), RoaringBitmap(data2)
 			assert ref - ref2 == set(rb - rb2), name
 
+	def test_xorinverted(self):
+		a = RoaringBitmap([5, 700, 40000])
+		b = RoaringBitmap(sorted(set(range(1 << 16)) - {3, 700}))
+		ref = set(range(1 << 16)) - {3, 5, 40000}
+		assert a ^ b == ref
+		assert b ^ a == ref
+		a ^= b
+		assert a == ref
+
+	def test_binaryops_threads(self):
+		import threading
+		seed(42)
+		data = [sorted(sample(range(1 << 23), 100000)) for _ in range(3)]
+		rbs = [RoaringBitmap(a) for a in data]
+		refs = [set(a) for a in data]
+		errors = []
+		# in-place operations on a shared target hold the GIL
+		shared = RoaringBitmap()
+
+		def work():
+			for rb in rbs:
+				shared.ior_and(rb, rbs[0])
+				shared.update(rb)
+				shared.difference_update(rbs[0])
+			for i in range(len(rbs)):
+				for j in range(len(rbs)):
+					rb, rb2 = rbs[i], rbs[j]
+					ref, ref2 = refs[i], refs[j]
+					if (rb & rb2 != ref & ref2 or rb | rb2 != ref | ref2
+							or rb - rb2 != ref - ref2
+							or rb ^ rb2 != ref ^ ref2):
+						errors.append((i, j))
+
+		threads = [threading.Thread(target=work) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		assert not errors
+		assert shared == (rbs[1] | rbs[2]) - rbs[0]
+
+	def test_binaryops_modify_threads(self):
+		import threading
+		a = RoaringBitmap(range(0, 1 << 23, 7))
+		b = RoaringBitmap(range(0, 1 << 23, 5))
+		d = RoaringBitmap(range(0, 1 << 23, 3)) - a
+		refs = [a & b, (a | d) & b]
+		results = []
+		done = []
+
+		def retry(method, arg):
+			while True:
+				try:
+					return method(arg)
+				except BufferError:  # a is an operand in the other thread
+					pass
+
+		def modify():  # toggle a between two states
+			while not done:
+				retry(a.update, d)
+				retry(a.difference_update, d)
+				retry(a.add, 1)
+				retry(a.discard, 1)
+
+		thread = threading.Thread(target=modify)
+		thread.start()
+		for _ in range(50):
+			results.append(a & b)
+		done.append(True)
+		thread.join()
+		assert all(res == refs[0] or res == refs[1] for res in results)
+
+	def test_subinverted(self):
+		a = RoaringBitmap(range(1 << 17))
+		b = RoaringBitmap(range(0, 1 << 17, 200))
+		ref = set(range(1 << 17)) - set(range(0, 1 << 17, 200))
+		assert a - b == ref
+		a -= b
+		a._checkconsistency()
+		assert a == ref
+
 	def test_subset(self, pair):
 		for name, data1, data2 in pair:
 			ref, ref2 = set(data1), set(data2)
@@ -346,6 +616,11 @@ class Test_roaringbitmap(object):
 		assert x.clamp(0, 0x00060006) == a | b
 		assert x.clamp(0, 0x00050006) == a | b
 		assert x.clamp(0, 0x00050005) == a | RoaringBitmap([0x00030003])
+		assert x.clamp(0x00020000, 0x00030004) == RoaringBitmap([0x00030003])
+		assert x.clamp(0x00020000, 0x00030000) == RoaringBitmap()
+		assert x.clamp(0x00040000, 0x00040010) == RoaringBitmap()
+		y = RoaringBitmap([0x00010001, 0x00090009])
+		assert y.clamp(0x00030000, 0x00050000) == RoaringBitmap()
 
 	def test_aggregateand(self, multi):
 		ref = set(multi[0])
@@ -363,6 +638,23 @@ class Test_roaringbitmap(object):
 		rb._checkconsistency()
 		assert rb == ref
 
+	def test_intersection_limit(self, multi):
+		ref = sorted(set(multi[0]).intersection(*[set(a) for a in multi[1:3]]))
+		rbs = [RoaringBitmap(a) for a in multi[:3]]
+		for offset, limit in ((0, 0), (0, 1), (0, 20), (3, 20),
+				(len(ref) - 2, 20), (len(ref), 5), (5, None), (0, 1 << 20)):
+			exp = ref[offset:] if limit is None else ref[offset:offset + limit]
+			rb = rbs[0].intersection(*rbs[1:], limit=limit, offset=offset)
+			rb._checkconsistency()
+			assert list(rb) == exp, (offset, limit)
+		assert list(rbs[0].intersection(limit=3, offset=1)) == sorted(
+				set(multi[0]))[1:4]
+		# full blocks and an inverted block
+		a = RoaringBitmap(range(3 << 16))
+		b = RoaringBitmap(range(5, 1 << 17, 2))
+		assert list(a.intersection(b, limit=4, offset=32766)) == [
+				65537, 65539, 65541, 65543]
+
 	def test_andlen(self, pair):
 		for name, data1, data2 in pair:
 			ref, ref2 = set(data1), set(data2)
@@ -377,6 +669,31 @@ class Test_roaringbitmap(object):
 			assert len(ref | ref2) == rb.union_len(rb2), name
 			assert len(rb | rb2) == rb.union_len(rb2), name
 
+	def test_fused(self, single, pair):
+		for name, data1, data2 in pair:
+			a, b = RoaringBitmap(data1), RoaringBitmap(data2)
+			ia, ib = ImmutableRoaringBitmap(data1), ImmutableRoaringBitmap(data2)
+			ref1, ref2 = set(data1), set(data2)
+			for name3, data3 in single:
+				ref, what = set(data3), name + ':' + name3
+				rb = RoaringBitmap(data3)
+				rb.ior_and(a, b)
+				rb._checkconsistency()
+				assert set(rb) == ref | (ref1 & ref2), what
+				rb = RoaringBitmap(data3)
+				rb.ior_andnot(ia, ib)
+				assert set(rb) == ref | (ref1 - ref2), what
+				rb = RoaringBitmap(data3)
+				rb.iand_or(a, ib)
+				assert set(rb) == ref & (ref1 | ref2), what
+				assert RoaringBitmap(data3).and_andnot_len(a, ib) == len(
+						ref & ref1 - ref2), what
+		rb = RoaringBitmap(data2)
+		rb.ior_andnot(a, rb)
+		assert rb == a | b
+		with pytest.raises(ValueError):
+			ia.ior_and(a, b)
+
 	def test_jaccard_dist(self, pair):
 		for name, data1, data2 in pair:
 			if len(data1) == 0 and len(data2) == 0:
@@ -418,6 +735,33 @@ class Test_roaringbitmap(object):
 				else:
 					assert rb.rank(rb.select(i) + 1) - 1 == i, name
 
+	def test_nextge_prevle(self, single):
+		for name, data in single:
+			ref = sorted(set(data))
+			rb = RoaringBitmap(data)
+			for x in [0, 1 << 16, (1 << 32) - 1] + [randint(0, max(ref or [0]))
+					+ randint(-1, 1) for _ in range(20)]:
+				x = max(x, 0)
+				i = bisect_left(ref, x)
+				assert rb.next_ge(x) == (ref[i] if i < len(ref) else None), (
+						name, x)
+				i = bisect_right(ref, x)
+				assert rb.prev_le(x) == (ref[i - 1] if i else None), (name, x)
+
+	def test_iter_seek(self, single):
+		for name, data in single:
+			ref = sorted(set(data))
+			rb = RoaringBitmap(data)
+			assert list(rb.iter()) == ref, name
+			assert list(rb.iter(reverse=True)) == ref[::-1], name
+			x = ref[len(ref) // 2] + 1 if ref else 0
+			assert list(rb.iter(start=x)) == [a for a in ref if a >= x], name
+			assert list(rb.iter(start=x, reverse=True)) == [
+					a for a in ref if a <= x][::-1], name
+			it = rb.iter()
+			it.seek(x)
+			assert next(it, None) == rb.next_ge(x), name
+
 	def test_rank2(self):
 		rb = RoaringBitmap(range(0, 100000, 7))
 		rb.update(range(100000, 200000, 1000))
@@ -434,6 +778,41 @@ class Test_roaringbitmap(object):
 				assert rb.select(k) == k * gap
 			gap *= 2
 
+	def test_sample(self, single):
+		for name, data in single:
+			ref = set(data)
+			rb = RoaringBitmap(data)
+			for k in (0, 1, 100, len(ref)):
+				if k > len(ref):
+					continue
+				result = rb.sample(k, seed=42)
+				result._checkconsistency()
+				assert len(result) == k, name
+				assert result <= ref, name
+				assert result == rb.sample(k, seed=42), name
+			with pytest.raises(ValueError):
+				rb.sample(len(ref) + 1)
+		rb = RoaringBitmap(range(5, 1 << 20, 3))
+		assert set(rb.sample(5000)) <= set(rb)
+		mrb = MultiRoaringBitmap([rb])
+		assert set(mrb[0].sample(100, seed=1)) == set(rb.sample(100, seed=1))
+
+	def test_subsample(self, single):
+		for name, data in single:
+			rb = RoaringBitmap(data)
+			half = rb.subsample(0.5, seed=3)
+			half._checkconsistency()
+			assert half <= rb, name
+			assert rb.subsample(0.1, seed=3) <= half, name
+			assert rb.subsample(1) == rb, name
+			assert len(rb.subsample(0)) == 0, name
+		rb = RoaringBitmap(range(1 << 20))
+		assert 0.45 < len(rb.subsample(0.5)) / len(rb) < 0.55
+		assert rb.subsample(0.3, 7) & RoaringBitmap(range(1000)) == (
+				RoaringBitmap(range(1000)).subsample(0.3, 7))
+		with pytest.raises(ValueError):
+			rb.subsample(1.5)
+
 	def test_select_issue15(self):
 		rb = RoaringBitmap(range(0x10000, 0x1ffff + 1))
 		assert rb[0] == 0x10000
@@ -457,6 +836,83 @@ class Test_roaringbitmap(object):
 			rb._checkconsistency()
 			assert rb_unpickled == rb, name
 
+	def test_stream(self, single):
+		class ShortReads(io.BytesIO):  # like a pipe or socket
+			def read(self, n=-1):
+				return io.BytesIO.read(self, min(n, 1000))
+
+			def readinto(self, buf):
+				return 0
+
+		out = io.BytesIO()
+		nbytes = 0
+		for name, data in single:
+			rb = RoaringBitmap(data)
+			nbytes += rb.write_to(out)
+			assert out.tell() == nbytes, name
+			assert ImmutableRoaringBitmap(rb).write_to(io.BytesIO()) == (
+					len(rb.__getstate__())), name
+		assert out.getvalue() == b''.join(
+				RoaringBitmap(data).__getstate__().tobytes()
+				for _, data in single)
+		for inp in (io.BytesIO(out.getvalue()), ShortReads(out.getvalue())):
+			for name, data in single:
+				rb = RoaringBitmap.read_from(inp)
+				rb._checkconsistency()
+				assert rb == RoaringBitmap(data), name
+			assert inp.read() == b''
+		irb = ImmutableRoaringBitmap.read_from(io.BytesIO(out.getvalue()))
+		assert isinstance(irb, ImmutableRoaringBitmap)
+		assert irb == RoaringBitmap(single[0][1])
+		data = RoaringBitmap(range(0, 200000, 3)).__getstate__().tobytes()
+		for n in (3, 100, len(data) // 2, len(data) - 1):
+			with pytest.raises(EOFError):
+				RoaringBitmap.read_from(io.BytesIO(data[:n]))
+
+		class Mutating(io.BytesIO):  # modifies the set while writing it
+			def write(self, buf):
+				rb.clear()
+
+		rb = RoaringBitmap(range(0, 200000, 3))
+		with pytest.raises(BufferError):
+			rb.write_to(Mutating())
+		assert rb == RoaringBitmap(range(0, 200000, 3))
+		rb.clear()
+
+		class Keeping(io.BytesIO):  # keeps the buffers it is given
+			def write(self, buf):
+				self.bufs.append(buf)
+
+		rb = RoaringBitmap(range(0, 200000, 3))
+		out = Keeping()
+		out.bufs = []
+		rb.write_to(out)
+		with pytest.raises(BufferError):
+			rb.add(1)
+		assert b''.join(bytes(memoryview(buf)) for buf in out.bufs) == data
+		del out
+		rb.add(1)
+
+		def corrupt(data, offset, fmt, value):
+			data = bytearray(RoaringBitmap(data).__getstate__().tobytes())
+			struct.pack_into(fmt, data, offset, value)
+			return io.BytesIO(bytes(data))
+
+		# header: number of blocks, keys, blocks with capacity at offset 12
+		for inp in (
+				corrupt([1, 2, 3], 4 + 2 + 12, '=H', 1),
+				corrupt([1, 2, 3], 4 + 2 + 12, '=H', 65535),
+				corrupt([1, 2, 3], 4 + 2 + 8, '=I', 0),
+				corrupt([1, 2, 3], 4 + 2 + 8, '=I', 65535),
+				corrupt([1, 2, 3], 4 + 2 + 16 + 2, '=H', 1),  # [1, 1, 3]
+				corrupt([1, 1 << 16], 4, '=H', 1),  # keys [1, 1]
+				corrupt([1, 1 << 16, 2 << 16], 4, '=H', 2),  # keys [2, 1, 2]
+				corrupt(range(0, 65536, 3), 4 + 2 + 8, '=I', 5000),
+				corrupt([1, 2, 3], 4 + 2, '=Q', 1 << 40),  # buffer offset
+				corrupt([1, 2, 3], 4 + 2, '=Q', 4 + 2 + 16 + 32)):
+			with pytest.raises(ValueError):
+				RoaringBitmap.read_from(inp)
+
 	def test_invalid(self):
 		with pytest.raises(TypeError):
 			rb = RoaringBitmap([1, 2, 'a'])
@@ -605,6 +1061,34 @@ class Test_immutablerb(object):
 			assert rb_unpickled == rb, name
 			assert type(rb) == ImmutableRoaringBitmap, name
 
+	def test_oldlayout(self):
+		# pickle states written by earlier versions, which padded the header
+		# and each block to a multiple of 32 bytes; trailing padding omitted.
+		fixtures = [
+				([7], 64,
+					'01000000000020000000000000000100000001000100000000000000'
+					'0000000007'),
+				([1, 2, 3, 65537], 128,
+					'02000000000001004000000000000000030000000300010060000000'
+					'00000000010000000100010000000000000000000000000000000000'
+					'00000000000000000100020003000000000000000000000000000000'
+					'00000000000000000000000001'),
+				([n for n in range(1 << 16) if n != 5], 64,
+					'0100000000002000000000000000ffff000001000200000000000000'
+					'0000000005')]
+		for data, size, state in fixtures:
+			old = ImmutableRoaringBitmap.__new__(ImmutableRoaringBitmap)
+			old.__setstate__(array.array(b'B' if PY2 else 'B',
+					bytearray.fromhex(state.ljust(2 * size, '0'))))
+			new = ImmutableRoaringBitmap(data)
+			assert old.__sizeof__() > new.__sizeof__()
+			assert list(old) == data
+			assert old == new and new == old and not old != new
+			assert old == RoaringBitmap(data)
+			assert hash(old) == hash(new)
+			assert len({old, new}) == 1
+			assert old != ImmutableRoaringBitmap(data[1:])
+
 	def test_and(self, pair):
 		for name, data1, data2 in pair:
 			ref, ref2 = set(data1), set(data2)
@@ -746,6 +1230,18 @@ class Test_multirb(object):
 		mrb = MultiRoaringBitmap([ImmutableRoaringBitmap(a) for a in multi])
 		res2 = mrb.intersection(list(range(len(mrb))))
 		assert res1 == res2
+		for indices in ([0, 1, 2], [3, 0, 2, 1], [5, 6, 7, 8, 9]):
+			ref = set(multi[indices[0]]).intersection(
+					*[set(multi[i]) for i in indices[1:]])
+			assert mrb.intersection(indices) == (
+					RoaringBitmap(ref) if ref else None)
+		orig = [RoaringBitmap(range(a, 200 << 16, b))
+				for a, b in ((0, 3), (1, 2), (0, 5), (2, 7), (0, 1))]
+		mrb = MultiRoaringBitmap(orig)
+		assert mrb.intersection([4, 2, 0, 1, 3]) == RoaringBitmap(
+				range(135, 200 << 16, 210))
+		assert mrb.intersection([0, 1, 2, 3], 1000, 5000) == RoaringBitmap(
+				range(1185, 5000, 210))
 
 	def test_jaccard(self, multi):
 		mrb = MultiRoaringBitmap([ImmutableRoaringBitmap(a) for a in multi])
@@ -771,6 +1267,26 @@ class Test_multirb(object):
 		assert res1 == ref1
 		assert res2 == ref2
 
+	def test_similarity_matrix(self, multi):
+		mrb = MultiRoaringBitmap([ImmutableRoaringBitmap(a) for a in multi])
+		rows = array.array(b'L' if PY2 else 'L', [0, 6, 8, 3])
+		cols = array.array(b'L' if PY2 else 'L', [1, 7, 6])
+		res = mrb.similarity_matrix(rows, cols, 'jaccard_dist')
+		ref = array.array(b'd' if PY2 else 'd', [mrb[i].jaccard_dist(mrb[j])
+				for i in rows for j in cols])
+		assert res == ref
+		res = mrb.similarity_matrix(rows, metric='intersection', nthreads=2)
+		ref = [len(mrb[i] & mrb[j]) for i in rows for j in rows]
+		assert list(res) == ref
+		out = array.array(b'd' if PY2 else 'd', [0] * len(rows) ** 2)
+		assert mrb.similarity_matrix(rows, rows, 'union', out=out) is out
+		assert list(out) == [len(mrb[i] | mrb[j]) for i in rows for j in rows]
+		# explicit cols equal to rows: symmetric, same result as cols=None
+		assert mrb.similarity_matrix(rows, list(rows), 'cosine') == (
+				mrb.similarity_matrix(rows, metric='cosine'))
+		with pytest.raises(ValueError):
+			mrb.similarity_matrix(rows, metric='foo')
+
 	def test_clamp(self, multi):
 		a, b = sorted(sample(multi[0], 2))
 		ref = set.intersection(
@@ -780,6 +1296,37 @@ class Test_multirb(object):
 		assert a <= rb.min() and rb.max() < b
 		assert ref == rb
 
+	def test_intersection_limit(self, multi):
+		mrb = MultiRoaringBitmap([RoaringBitmap(x) for x in multi])
+		ref = sorted(set.intersection(*[set(x) for x in multi[:3]]))
+		for offset, limit in ((0, 10), (7, 10), (0, None), (len(ref), 10)):
+			exp = ref[offset:] if limit is None else ref[offset:offset + limit]
+			rb = mrb.intersection([0, 1, 2], limit=limit, offset=offset)
+			assert (list(rb) if rb else []) == exp
+		a, b = ref[2], ref[len(ref) - 2]
+		rb = mrb.intersection([0, 1, 2], a, b, limit=5, offset=1)
+		assert list(rb) == [x for x in ref if a <= x < b][1:6]
+		assert mrb.intersection([0, len(mrb)], limit=5) is None
+
+	def test_evaluate(self, multi):
+		sets = [set(a) for a in multi]
+		mrb = MultiRoaringBitmap([RoaringBitmap(a) for a in multi])
+		ref = ((sets[0] & sets[2]) | sets[5]) - (sets[1] | sets[3])
+		expr = ('andnot', ('or', ('and', 0, 2), 5), 1, 3)
+		res = mrb.evaluate(expr)
+		res._checkconsistency()
+		assert res == ref
+		assert mrb.evaluate(('-', ('&', 0, 2), ('|', 1, 3))) == (
+				(sets[0] & sets[2]) - (sets[1] | sets[3]))
+		assert mrb.evaluate(expr, 500, 1500) == {
+				a for a in ref if 500 <= a < 1500}
+		assert mrb.evaluate(('and', 0, ('andnot', 1, 0))) == set()
+		assert mrb.evaluate(4) == mrb[4]
+		with pytest.raises(IndexError):
+			mrb.evaluate(('and', 0, len(mrb)))
+		with pytest.raises(ValueError):
+			mrb.evaluate(('xor', 0, 1))
+
 	def test_serialize(self, multi):
 		orig = [RoaringBitmap(a) for a in multi]
 		mrb = MultiRoaringBitmap(orig)
@@ -795,6 +1342,336 @@ class Test_multirb(object):
 				rb3._checkconsistency()
 				assert type(rb3) == ImmutableRoaringBitmap
 
+	def test_dedup(self, multi):
+		orig = [RoaringBitmap(a) for a in multi[:10]]
+		orig += [RoaringBitmap(multi[1]), None, RoaringBitmap(multi[3])] * 5
+		mrb = MultiRoaringBitmap(orig)
+		mrb2 = MultiRoaringBitmap(orig, dedup=False)
+		assert mrb == mrb2
+		assert mrb.bufsize() < mrb2.bufsize()
+		assert mrb2.dedupratio() == 1
+		assert mrb.dedupratio() > 1.5
+		assert mrb.getsize(1) == mrb.getsize(10) == mrb.getsize(22)
+		assert mrb.intersection([1, 22]) == orig[1]
+		with tempfile.NamedTemporaryFile(delete=False) as tmp:
+			MultiRoaringBitmap(orig, filename=tmp.name).close()
+			mrb3 = MultiRoaringBitmap.fromfile(tmp.name)
+			assert mrb3 == mrb
+			assert mrb3.bufsize() == mrb.bufsize()
+			assert pickle.loads(pickle.dumps(mrb3)) == mrb
+			mrb3.close()
+
+	def test_metadata(self, multi):
+		orig = [RoaringBitmap(a) for a in multi]
+		orig[2] = RoaringBitmap()
+		orig[3] = RoaringBitmap(range(5 << 16, 7 << 16))
+		orig[4] = RoaringBitmap([3, 100 << 16, 0xffffffff])
+		mrb = MultiRoaringBitmap(orig)
+		assert not mrb.hasmetadata()
+		with tempfile.NamedTemporaryFile(delete=False) as tmp:
+			MultiRoaringBitmap(orig, filename=tmp.name, metadata=True).close()
+			mmrb = MultiRoaringBitmap.fromfile(tmp.name)
+			assert mmrb.hasmetadata()
+			assert mmrb == orig
+			assert mmrb.bufsize() > mrb.bufsize()
+			for i, rb in enumerate(orig):
+				assert mmrb.cardinality(i) == mrb.cardinality(i) == len(rb)
+				assert mmrb.bounds(i) == mrb.bounds(i) == (
+						(rb.min(), rb.max()) if rb else None)
+			for indices in ([0, 1], [1, 3], [4, 0], [0, 5, 6, 1]):
+				assert mmrb.intersection(indices) == mrb.intersection(indices)
+				assert mmrb.intersection(indices, 500, 1000) == (
+						mrb.intersection(indices, 500, 1000))
+			assert mmrb.intersection([3, 4]) is None
+			assert mmrb.intersection([0, 4], 4, 0xffffffff) is None
+			query = RoaringBitmap([5, 7, 1234, 5 << 16, 0xffffffff])
+			assert mmrb.jaccard_dist_single(query) == (
+					mrb.jaccard_dist_single(query))
+			for method in ('intersection_len_single', 'union_len_single'):
+				assert getattr(mmrb, method)(query) == (
+						getattr(mrb, method)(query))
+			assert pickle.loads(pickle.dumps(mmrb)).hasmetadata()
+			mmrb.close()
+			umrb = UpdatableMultiRoaringBitmap(mrb)
+			umrb.add(2, 17)
+			mmrb = umrb.compact(tmp.name, metadata=True)
+			assert mmrb.hasmetadata() and mmrb.bounds(2) == (17, 17)
+			mmrb.close()
+			builder = MultiRoaringBitmapBuilder(tmp.name)
+			builder.add(array.array(b'I' if PY2 else 'I', [0, 3, 0]),
+					[1, 70000, 2])
+			mmrb = builder.finish(size=5, metadata=True)
+			assert [mmrb.cardinality(i) for i in range(5)] == [2, 0, 0, 1, 0]
+			assert mmrb.bounds(0) == (1, 2) and mmrb.bounds(3) == (
+					70000, 70000)
+			mmrb.close()
+		with pytest.raises(IndexError):
+			mrb.cardinality(len(mrb))
+
+	def test_find(self, multi):
+		orig = [RoaringBitmap(a) for a in multi[:20]]
+		orig += [RoaringBitmap(), RoaringBitmap(multi[0][:5]),
+				RoaringBitmap(range(1 << 16, 3 << 16)),
+				RoaringBitmap([multi[0][0], 1 << 20]),
+				RoaringBitmap(multi[0][:5] + [70000])]
+		query = RoaringBitmap(multi[0][:5] + list(range(1 << 16, 3 << 16)))
+		for metadata in (False, True):
+			mrb = MultiRoaringBitmap(orig, metadata=metadata)
+			for q in (query, orig[0], orig[21], orig[22], RoaringBitmap()):
+				assert mrb.find_subsets(q) == RoaringBitmap(
+						i for i, rb in enumerate(orig) if rb <= q)
+				assert mrb.find_supersets(q) == RoaringBitmap(
+						i for i, rb in enumerate(orig) if rb >= q)
+				assert mrb.find_intersecting(q) == RoaringBitmap(
+						i for i, rb in enumerate(orig) if rb & q)
+		assert 22 in mrb.find_subsets(query)
+		assert list(MultiRoaringBitmap([]).find_supersets(query)) == []
+
+	def test_cache(self, multi):
+		orig = [RoaringBitmap(a) for a in multi]
+		orig[9] = RoaringBitmap([1 << 20])
+		mrb = MultiRoaringBitmap(orig)
+		assert mrb.cache_info() is None
+		mrb.enable_cache()
+		ref = mrb.intersection([0, 1, 2])
+		assert mrb.intersection([2, 0, 1]) == ref
+		res = mrb.intersection([1, 0, 2, 2])
+		res.add(1 << 25)  # results are mutable copies
+		assert mrb.intersection([0, 1, 2]) == ref
+		info = mrb.cache_info()
+		assert (info.hits, info.misses, info.entries) == (3, 1, 1)
+		# extend cached intersection
+		assert mrb.intersection([0, 1, 2, 3]) == ref & orig[3]
+		assert mrb.cache_info().partialhits == 1
+		assert mrb.intersection([1, 3]) == orig[1] & orig[3]
+		assert mrb.intersection([0, 1, 3, 5]) == (
+				orig[0] & orig[1] & orig[3] & orig[5] or None)
+		assert mrb.cache_info().partialhits == 2
+		assert mrb.intersection([0, 9]) is None
+		assert mrb.intersection([0, 9, 3]) is None
+		assert mrb.intersection([0, 1], 100, 1000) == (
+				orig[0] & orig[1]).clamp(100, 1000)
+		query = ('or', ('and', 0, 1), ('andnot', 2, 3))
+		ref = (orig[0] & orig[1]) | (orig[2] - orig[3])
+		assert mrb.evaluate(query) == ref
+		assert mrb.evaluate(('or', ('andnot', 2, 3), ('and', 1, 0))) == ref
+		assert mrb.cache_info().hits == 4
+		assert mrb.evaluate(('and', 0, orig[1])) == orig[0] & orig[1]
+		# small budget: results are evicted
+		mrb.enable_cache(maxbytes=4000)
+		for i in range(len(orig) - 1):
+			assert mrb.intersection([i, i + 1]) == (
+					orig[i] & orig[i + 1] or None)
+			assert mrb.cache_info().nbytes <= 4000
+		assert mrb.cache_info().entries < len(orig) - 1
+		for i in range(len(orig) - 2):
+			assert mrb.intersection([i, i + 1, i + 2]) == (
+					orig[i] & orig[i + 1] & orig[i + 2] or None)
+		mrb.clear_cache()
+		assert mrb.cache_info().entries == 0
+		mrb.enable_cache(0)
+		assert mrb.cache_info() is None
+
+	def test_tiny(self):
+		rows = [[n * 3] if n % 3 else list(range(n, n + 20, 2))
+				for n in range(200)]
+		for n in range(5, 200, 40):  # interleave dense bitmaps
+			rows[n] = list(range(n, n + 10000, 2))
+		orig = [RoaringBitmap(a) for a in rows]
+		assert ImmutableRoaringBitmap([7]).__sizeof__() == 24
+		mrb = MultiRoaringBitmap(orig)
+		assert mrb == orig
+		assert mrb.bufsize() < 40 * len(rows) + 5 * 10000
+		header = array.array(b'I' if PY2 else 'I')
+		header.frombytes(mrb.__getstate__()[:4 * (1 + 2 * len(rows))])
+		offsets = header[1:1 + len(rows)]
+		assert all(a % 8 == 0 for a in offsets)
+		assert all(offsets[n] % 32 == 0 for n in range(5, 200, 40))
+		for n in range(5, 200, 40):
+			for m in (n + 1, n + 2):
+				assert mrb.intersection([n, m]) == (orig[n] & orig[m] or None)
+		indices = array.array(b'L' if PY2 else 'L', [0, 5, 45])
+		assert list(mrb.jaccard_dist(indices, indices[::-1])) == [
+				orig[0].jaccard_dist(orig[45]), 0, orig[45].jaccard_dist(orig[0])]
+		with tempfile.NamedTemporaryFile() as tmp:
+			builder = MultiRoaringBitmapBuilder(tmp.name)
+			pairs = [(n, a) for n, rb in enumerate(orig) for a in rb]
+			builder.add([n for n, _ in pairs], [a for _, a in pairs])
+			mrb2 = builder.finish()
+			assert mrb2 == orig
+			assert mrb2.bufsize() == mrb.bufsize()
+			mrb2.close()
+		with tempfile.NamedTemporaryFile() as tmp:
+			umrb = UpdatableMultiRoaringBitmap(mrb)
+			umrb.add(0, 1)
+			mrb3 = umrb.compact(tmp.name)
+			assert mrb3[1:] == orig[1:] and mrb3[0] == orig[0] | {1}
+			assert mrb3.bufsize() == mrb.bufsize()
+			mrb3.close()
+
+	def test_fromfile_advice(self, multi):
+		orig = [RoaringBitmap(a) for a in multi]
+		with tempfile.NamedTemporaryFile(delete=False) as tmp:
+			MultiRoaringBitmap(orig, filename=tmp.name).close()
+			for kwargs in ({'advice': 'random'},
+					{'advice': 'sequential', 'hugepages': True},
+					{'populate': True}):
+				mrb = MultiRoaringBitmap.fromfile(tmp.name, **kwargs)
+				mrb.warmup([3, 1, 2, 1])
+				mrb.warmup(touch=True)
+				assert mrb == orig
+				mrb.close()
+			with pytest.raises(ValueError):
+				MultiRoaringBitmap.fromfile(tmp.name, advice='fast')
+		mrb = MultiRoaringBitmap(orig)
+		mrb.warmup(range(len(mrb)), touch=True)
+		with pytest.raises(IndexError):
+			mrb.warmup([len(mrb)])
+
+	def test_builder(self, multi):
+		orig = [RoaringBitmap(a) for a in multi]
+		orig[3] = RoaringBitmap()
+		pairs = [(n, a) for n, rb in enumerate(orig) for a in rb]
+		pairs += pairs[:100]  # duplicates
+		seed(42)
+		pairs.sort(key=lambda _: randint(0, 1 << 30))
+		with tempfile.NamedTemporaryFile(delete=False) as tmp:
+			# small maxmemory to force spilling of sorted runs
+			builder = MultiRoaringBitmapBuilder(tmp.name, maxmemory=8000)
+			for n in range(0, len(pairs), 1000):
+				builder.add(
+						array.array(b'I' if PY2 else 'I',
+							[a for a, _ in pairs[n:n + 1000]]),
+						[b for _, b in pairs[n:n + 1000]])
+			mrb = builder.finish(size=len(orig) + 2)
+			assert len(mrb) == len(orig) + 2
+			assert mrb[:len(orig)] == orig
+			assert len(mrb[-1]) == 0
+			for rb in mrb:
+				rb._checkconsistency()
+			mrb.close()
+
+	def test_updatable(self, multi):
+		orig = [RoaringBitmap(a) for a in multi]
+		ref = [set(a) for a in multi]
+		umrb = UpdatableMultiRoaringBitmap(MultiRoaringBitmap(orig))
+		umrb.add(0, 2001)
+		ref[0].add(2001)
+		umrb.discard(1, multi[1][0])
+		ref[1].discard(multi[1][0])
+		umrb.update(2, range(1500, 2500))
+		ref[2].update(range(1500, 2500))
+		umrb.difference_update(3, range(0, 1000))
+		ref[3].difference_update(range(0, 1000))
+		assert umrb.append([7, 8]) == len(orig)
+		ref.append({7, 8})
+		assert not umrb.ismodified(4) and umrb.ismodified(3)
+		assert umrb[:] == [RoaringBitmap(a) for a in ref]
+		assert umrb.evaluate(('andnot', ('or', 0, 2), 1, 3)) == (
+				(ref[0] | ref[2]) - ref[1] - ref[3])
+		assert umrb.intersection([0, 1, 2, len(orig)]) == (
+				ref[0] & ref[1] & ref[2] & ref[-1] or None)
+		umrb.append(sorted(ref[4]))
+		ref.append(ref[4])
+		with tempfile.NamedTemporaryFile(delete=False) as tmp:
+			mrb = umrb.compact(tmp.name)
+			assert mrb is umrb.base
+			assert mrb == [RoaringBitmap(a) for a in ref]
+			assert mrb.dedupratio() > 1
+			assert not umrb.ismodified(3)
+			umrb.add(0, 5)
+			with pytest.raises(ValueError):  # would truncate mmap'ed file
+				umrb.compact(tmp.name)
+			assert mrb == [RoaringBitmap(a) for a in ref]
+			mrb.close()
+
+	def test_iter_union(self, multi):
+		orig = [RoaringBitmap(a) for a in multi]
+		orig[1] = RoaringBitmap(range(1 << 16, 3 << 16))  # full blocks
+		orig[3] = RoaringBitmap()
+		mrb = MultiRoaringBitmap(orig)
+		indices = [0, 1, 3, 5, 5]
+		ref = set().union(*[orig[i] for i in indices])
+		assert list(mrb.iter_union(indices)) == sorted(ref)
+		counts = list(mrb.iter_union(indices, counts=True))
+		assert [a for a, _ in counts] == sorted(ref)
+		assert all(cnt == sum(a in orig[i] for i in indices)
+				for a, cnt in counts)
+		assert list(merge_iter(*orig)) == sorted(set().union(*orig))
+		assert list(merge_iter()) == []
+		with pytest.raises(IndexError):
+			mrb.iter_union([0, len(orig)])
+		# sources cannot be modified until the iterator is done
+		a, b = RoaringBitmap(orig[0]), RoaringBitmap(orig[2])
+		it = merge_iter(a, b)
+		first = next(it)
+		for modify in (lambda: a.__ior__(orig[4]), lambda: a.add(1 << 30),
+				lambda: b.discard(orig[2][0]), a.clear, b.pop):
+			with pytest.raises(BufferError):
+				modify()
+		assert [first] + list(it) == sorted(set(orig[0]) | set(orig[2]))
+		a |= orig[4]
+		it = merge_iter(a, b)
+		next(it)
+		del it
+		b.clear()
+
+	def test_len_single(self, multi):
+		orig = [RoaringBitmap(a) for a in multi]
+		orig[3] = RoaringBitmap()
+		mrb = MultiRoaringBitmap(orig)
+		query = RoaringBitmap(multi[0][:100] + multi[5][:50])
+		assert list(mrb.intersection_len_single(query)) == [
+				len(query & a) for a in orig]
+		assert list(mrb.union_len_single(query, [2, 3])) == [
+				len(query | orig[2]), len(query)]
+		assert list(mrb.difference_len_single(query)) == [
+				len(query - a) for a in orig]
+		top = mrb.intersection_len_single(query, topk=2)
+		assert top == sorted([(n, len(query & a)) for n, a in enumerate(orig)],
+				key=lambda x: (-x[1], x[0]))[:2]
+		with pytest.raises(IndexError):
+			mrb.intersection_len_single(query, [len(orig)])
+
+	def test_sharded(self, multi):
+		orig = [RoaringBitmap(a) for a in multi]
+		mrb = MultiRoaringBitmap(orig)
+		query = RoaringBitmap(multi[0][:100] + multi[5][:50])
+		tmpdir = tempfile.mkdtemp()
+		try:
+			smrb = ShardedMultiRoaringBitmap(tmpdir, nthreads=2)
+			assert smrb.add_shard(orig[:4]) == 0
+			assert smrb.add_shard(orig[4:]) == 4
+			smrb.close()
+			smrb = ShardedMultiRoaringBitmap(tmpdir, nthreads=2)
+			assert smrb.numshards() == 2
+			assert list(smrb) == orig
+			assert smrb[5] == orig[5]
+			for indices in ([1, 2], [1, 5], [0, 3, 4, 7]):
+				assert smrb.intersection(indices) == mrb.intersection(indices)
+			assert smrb.intersection([0, len(orig)]) is None
+			assert smrb.jaccard_dist_single(query) == mrb.jaccard_dist_single(
+					query)
+			assert smrb.intersection_len_single(query, [5, 0, 6]) == (
+					mrb.intersection_len_single(query, [5, 0, 6]))
+			assert smrb.intersection_len_single(query, topk=3) == (
+					mrb.intersection_len_single(query, topk=3))
+			assert smrb.evaluate(('or', 1, ('and', 2, 6))) == (
+					orig[1] | (orig[2] & orig[6]))
+			assert smrb.find_intersecting(query) == mrb.find_intersecting(
+					query)
+			smrb.close()
+			os.remove(os.path.join(tmpdir, 'shard00000.mrb'))
+			smrb = ShardedMultiRoaringBitmap(tmpdir)
+			assert smrb.add_shard(orig[:2]) == len(orig) - 4
+			assert smrb.add_shard(orig[2:3]) == len(orig) - 2
+			assert sorted(os.listdir(tmpdir)) == [
+					'shard00001.mrb', 'shard00002.mrb', 'shard00003.mrb']
+			assert list(smrb) == orig[4:] + orig[:3]
+			smrb.close()
+		finally:
+			shutil.rmtree(tmpdir)
+
 	def test_multi1(self):
 		for_multi = []
 		for i in range(5):
@@ -831,3 +1708,64 @@ class Test_multirb(object):
 		assert mrb == mrb2
 		assert mrb != orig[1:]
 		assert mrb != mrb3
+
+
+class Test_bsi(object):
+	def test_bsi(self):
+		seed(42)
+		rows = sample(range(1 << 20), 1000)
+		values = [randint(0, 5000) for _ in rows]
+		ref = dict(zip(rows, values))
+		bsi = BitSlicedIndex.fromarrays(rows, values)
+		assert len(bsi) == len(rows)
+		assert bsi[rows[0]] == values[0]
+		filt = RoaringBitmap(rows[:500])
+		for a in (0, 100, 2500, 5000, 9999):
+			assert set(bsi.lt(a)) == {r for r, v in ref.items() if v < a}
+			assert set(bsi.le(a)) == {r for r, v in ref.items() if v <= a}
+			assert set(bsi.eq(a)) == {r for r, v in ref.items() if v == a}
+			assert set(bsi.ge(a, filt)) == {r for r in rows[:500]
+					if ref[r] >= a}
+		assert set(bsi.between(100, 2500)) == {
+				r for r, v in ref.items() if 100 <= v <= 2500}
+		assert bsi.sum() == sum(values)
+		assert bsi.sum(filt) == sum(values[:500])
+		assert bsi.min(filt) == min(values[:500])
+		assert bsi.max() == max(values)
+		assert bsi.min(RoaringBitmap()) is None
+		top = bsi.topk(10)
+		assert len(top) == 10
+		assert min(ref[r] for r in top) >= sorted(values)[-10]
+		bsi[rows[0]] = 1 << 20
+		assert bsi.max() == 1 << 20
+		del bsi[rows[0]]
+		assert rows[0] not in bsi
+		with tempfile.NamedTemporaryFile(delete=False) as tmp:
+			bsi.tofile(tmp.name)
+			bsi2 = BitSlicedIndex.fromfile(tmp.name)
+			assert bsi2.sum() == bsi.sum()
+			assert bsi2.lt(2500) == bsi.lt(2500)
+			bsi2.close()
+		with pytest.raises(ValueError):
+			BitSlicedIndex.fromarrays([1, 1], [2, 3])
+		# values that need all 32 slices
+		big = [1 << 31, (1 << 31) + 5, (1 << 32) - 1]
+		bsi = BitSlicedIndex()
+		for row, value in enumerate(big):
+			bsi[row + 3] = value
+		assert bsi.bitdepth == 32
+		assert [bsi[row + 3] for row in range(3)] == big
+		bsi[3] = 7
+		assert bsi[3] == 7
+		assert bsi.max() == (1 << 32) - 1 and bsi.sum() == 7 + sum(big[1:])
+		assert set(bsi.ge(1 << 31)) == {4, 5}
+		assert set(bsi.eq((1 << 32) - 1)) == {5}
+		assert set(bsi.lt(1 << 32)) == {3, 4, 5}
+		bsi2 = BitSlicedIndex.fromarrays([0, 1, 2], big)
+		assert bsi2.bitdepth == 32 and bsi2.min() == 1 << 31
+		with pytest.raises(OverflowError):
+			BitSlicedIndex.fromarrays(array.array(b'i' if PY2 else 'i', [1, 2]),
+					array.array(b'i' if PY2 else 'i', [-2, 3]))
+		with pytest.raises(TypeError):
+			BitSlicedIndex.fromarrays(array.array(b'I' if PY2 else 'I', [1, 2]),
+					array.array(b'f' if PY2 else 'f', [2, 3]))